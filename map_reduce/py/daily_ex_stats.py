@@ -2,13 +2,14 @@
 
 """Hive reducer script to compute daily exercise stats."""
 
-import collections
 import datetime
 import json
 import sys
 
 # global string var representing the date partition we're working with
 g_dt = None
+# and g_dt as a datetime
+g_as_of_date = None
 
 """Declare the filter modes which can be used to cross-section the data.
 
@@ -34,52 +35,89 @@ everything_mode = ['everything']
 super_modes = everything_mode + user_modes
 sub_modes = everything_mode + topic_modes + topic_user_modes + user_modes
 
+# Each mode's bit in the masks returned by user_day_mode_mask().
+mode_bits = dict((mode, 1 << i) for (i, mode) in
+                 enumerate(everything_mode + topic_modes + topic_user_modes +
+                           user_modes))
 
-def compute(sub_mode, plogs):
-    # dict of dicts, keyed by exercise name, then stat name
-    ex_stats = collections.defaultdict(lambda: collections.defaultdict(int))
+# The (super_mode, sub_mode) pairs to output, in order, with the mask of the
+# two modes, and which of compute()'s stats to output for the pair.
+mode_pairs = [(super_mode, sub_mode,
+               mode_bits[super_mode] | mode_bits[sub_mode],
+               sub_mode if sub_mode in topic_modes else None)
+              for super_mode in super_modes
+              for sub_mode in sub_modes]
+
+stat_names = ['users', 'user_exercises', 'problems', 'correct', 'profs',
+              'prof_prob_count', 'first_attempts', 'hint_probs', 'time_taken']
+
+
+def compute(plogs):
+    """Compute the per-exercise stats of plogs, for each topic_mode filter.
+
+    Returns a dict keyed by 'true' and 'false' (stats over only the plogs
+    with that topic_mode) and None (stats over all plogs).  Each value is a
+    dict of exercise name to the list of its stats, in stat_names order,
+    plus the stats over all exercises under 'ALL'.
+    """
+    ex_stats = {'true': {}, 'false': {}, None: {}}
 
     for plog in plogs:
         ex = plog['exercise']
 
-        if sub_mode in topic_modes:
-            # this type of filter is decided on a per-problem basis
-            if plog.get('topic_mode') != (sub_mode == 'true'):
-                continue
-
-        if ex not in ex_stats:
-            ex_stats[ex]['users'] = 1
-
-        stats = ex_stats[ex]
-        stats['user_exercises'] = stats['users']
-        stats['problems'] += 1
-        stats['correct'] += plog['correct']
-        stats['profs'] += plog['earned_proficiency']
-        if plog['earned_proficiency']:
-            stats['prof_prob_count'] += int(plog['problem_number'])
-        stats['first_attempts'] += (plog['problem_number'] == 1)
-        stats['hint_probs'] += plog['hint_used']
-        stats['time_taken'] += max(0, min(600, int(plog['time_taken'])))
+        # the topic_mode filters are decided on a per-problem basis
+        topic_mode = plog.get('topic_mode')
+        if topic_mode == True:
+            filtered_stats = (ex_stats[None], ex_stats['true'])
+        elif topic_mode == False:
+            filtered_stats = (ex_stats[None], ex_stats['false'])
+        else:
+            filtered_stats = (ex_stats[None],)
+
+        correct = plog['correct']
+        earned_proficiency = plog['earned_proficiency']
+        if earned_proficiency:
+            prof_prob_count = int(plog['problem_number'])
+        else:
+            prof_prob_count = 0
+        first_attempt = (plog['problem_number'] == 1)
+        hint_used = plog['hint_used']
+        time_taken = max(0, min(600, int(plog['time_taken'])))
+
+        for stats_by_ex in filtered_stats:
+            stats = stats_by_ex.get(ex)
+            if stats is None:
+                stats = stats_by_ex[ex] = [1, 1, 0, 0, 0, 0, 0, 0, 0]
+            stats[2] += 1
+            stats[3] += correct
+            stats[4] += earned_proficiency
+            stats[5] += prof_prob_count
+            stats[6] += first_attempt
+            stats[7] += hint_used
+            stats[8] += time_taken
 
     # merge all individual exercise stats into the global/aggregated stat set
-    if ex_stats:
-        for ex in ex_stats.keys():
-            for stat in ex_stats[ex]:
-                ex_stats['ALL'][stat] += ex_stats[ex][stat]
-        # but we need to correct the user count-- de-dupe it
-        ex_stats['ALL']['users'] = 1
+    for stats_by_ex in ex_stats.itervalues():
+        if stats_by_ex:
+            all_stats = [0] * len(stat_names)
+            for stats in stats_by_ex.values():
+                for i, stat in enumerate(stats):
+                    all_stats[i] += stat
+            # but we need to correct the user count-- de-dupe it
+            all_stats[0] = 1
+            stats_by_ex['ALL'] = all_stats
 
     return ex_stats
 
 
-def output(super_mode, sub_mode, ex_stats):
-    for ex, stats in ex_stats.iteritems():
-        stat_names = ['users', 'user_exercises', 'problems', 'correct',
-                'profs', 'prof_prob_count', 'first_attempts', 'hint_probs',
-                'time_taken']
-        output_str = "\t".join([super_mode, sub_mode, ex]) + "\t"
-        output_str += "\t".join([str(stats[s]) for s in stat_names]) + "\n"
-        sys.stdout.write(output_str)
+def output_lines(stats_by_ex):
+    """Return the output lines for one of compute()'s sets of stats.
+
+    Each line is missing the super_mode and sub_mode columns, which the
+    caller prepends.
+    """
+    return ["%s\t%s\n" % (ex, "\t".join([str(stat) for stat in stats]))
+            for ex, stats in stats_by_ex.iteritems()]
 
 
 def num_topic_plogs(plogs):
@@ -91,7 +129,12 @@ def num_topic_plogs(plogs):
     return sum(topic_modes)
 
 
-def user_day_matches_mode(plog_stats, user_info, mode):
+def user_day_matches_mode(plog_stats, user_info, as_of_date, mode):
+    """Return whether a user-day matches mode.
+
+    user_info is the user's parsed userdata json, or None if we don't have
+    it.  as_of_date is the datetime of the day.
+    """
     num_plogs, num_topic_plogs = plog_stats
 
     if mode in topic_user_modes:
@@ -109,16 +152,11 @@ def user_day_matches_mode(plog_stats, user_info, mode):
 
     elif mode in user_modes:
 
-        as_of_date = datetime.datetime.strptime(g_dt, '%Y-%m-%d')
-
         if user_info is None:
             # if we don't have user_info, don't pretend we can decide on
             # modes other than 'unknown'
             return mode == 'unknown'
 
-        # we've delayed as long as possible.. it's time to parse the json
-        user_info = json.loads(user_info[1])
-
         if mode == 'unknown':
             return user_info is None  # always False, due to preceeding lines
         elif mode == 'old':
@@ -162,38 +200,46 @@ def user_day_matches_mode(plog_stats, user_info, mode):
     return True
 
 
+def user_day_mode_mask(plog_stats, user_info, as_of_date):
+    """Return the bitmask (see mode_bits) of the modes a user-day matches."""
+    mask = 0
+    for mode, bit in mode_bits.iteritems():
+        if user_day_matches_mode(plog_stats, user_info, as_of_date, mode):
+            mask |= bit
+    return mask
+
+
 def process_user_day(user_info, plogs):
     """Compute statistics over plogs for each comination of filter modes."""
 
+    if user_info is not None:
+        user_info = json.loads(user_info[1])
+
     plog_stats = (len(plogs), num_topic_plogs(plogs))
+    mask = user_day_mode_mask(plog_stats, user_info, g_as_of_date)
 
     # The stats will only differ based on whether the sub_mode is
     # 'true', 'false', or some other value (in which case all plogs) are
-    # counted.  So for performance, pre-compute those three summaries.
-    ex_stats = {}
-    ex_stats['true'] = compute(sub_mode='true', plogs=plogs)
-    ex_stats['false'] = compute(sub_mode='false', plogs=plogs)
-    ex_stats[None] = compute(sub_mode='everything', plogs=plogs)
-
-    # Now, as we iterate through pair of filter modes, we only have to pick
+    # counted.  So for performance, compute those three summaries at once,
+    # and as we iterate through pair of filter modes, we only have to pick
     # 1 of the 3 pre-computed options to output.
-    for super_mode in super_modes:
-        for sub_mode in sub_modes:
-            if (user_day_matches_mode(plog_stats, user_info, super_mode) and
-                    user_day_matches_mode(plog_stats, user_info, sub_mode)):
-                # Choose the right pre-computed stats for this mode pair
-                if sub_mode in topic_modes:
-                    output(super_mode, sub_mode, ex_stats[sub_mode])
-                else:
-                    output(super_mode, sub_mode, ex_stats[None])
+    lines = dict((key, output_lines(stats_by_ex))
+                 for key, stats_by_ex in compute(plogs).iteritems())
+    output = []
+    for super_mode, sub_mode, pair_mask, stats_key in mode_pairs:
+        if mask & pair_mask == pair_mask:
+            prefix = "%s\t%s\t" % (super_mode, sub_mode)
+            output.extend([prefix + line for line in lines[stats_key]])
+    sys.stdout.write("".join(output))
 
 
 def main():
     if len(sys.argv) <= 1:
         print >> sys.stderr, "Usage: %s <dt>" % sys.argv[0]
         exit(1)
-    global g_dt
+    global g_dt, g_as_of_date
     g_dt = sys.argv[1]
+    g_as_of_date = datetime.datetime.strptime(g_dt, '%Y-%m-%d')
 
     user_info = None
     prev_user = None
@@ -0,0 +1,52 @@
+import os
+import StringIO
+import sys
+import unittest
+
+import daily_ex_stats
+
+
+_TESTDATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'testdata')
+
+
+class DailyExStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_argv = sys.argv
+        self.orig_stdin = sys.stdin
+        self.orig_stdout = sys.stdout
+        self.orig_stderr = sys.stderr
+
+    def tearDown(self):
+        sys.argv = self.orig_argv
+        sys.stdin = self.orig_stdin
+        sys.stdout = self.orig_stdout
+        sys.stderr = self.orig_stderr
+
+    def run_reducer(self, dt, input_filename):
+        sys.argv = ['daily_ex_stats.py', dt]
+        sys.stdin = open(os.path.join(_TESTDATA_DIR, input_filename))
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            daily_ex_stats.main()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdin.close()
+
+    def test_recorded_output(self):
+        # daily_ex_stats_output.txt was recorded from the reducer as it was
+        # before process_user_day was restructured to compute mode bitmasks.
+        # The input covers every super_mode and sub_mode, users without
+        # user_info, and an unparseable ProblemLog.
+        with open(os.path.join(_TESTDATA_DIR,
+                               'daily_ex_stats_output.txt')) as f:
+            expected = f.read()
+        actual = self.run_reducer('2012-10-01', 'daily_ex_stats_input.txt')
+        self.assertEqual(expected.splitlines(), actual.splitlines())
+        self.assertEqual(expected, actual)
+
+
+if __name__ == '__main__':
+    unittest.main()
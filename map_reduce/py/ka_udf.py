@@ -5,10 +5,90 @@
    Example:
        python ka_udf.py split topic_string_keys "<tab>" key,title 0
 """
-import codecs
+import collections
 import json
+import os
 import sys
-sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+
+
+# Input is read (and so output is written) in blocks of about this many bytes.
+_BLOCK_SIZE = 1 << 20
+
+_JSON_WHITESPACE = ' \t\n\r'
+
+_json_scan_once = json.JSONDecoder().scan_once
+
+
+def _read_blocks(f):
+    """Yield the lines of f as lists of about _BLOCK_SIZE bytes of lines."""
+    while True:
+        lines = f.readlines(_BLOCK_SIZE)
+        if not lines:
+            return
+        yield lines
+
+
+def _write_lines(f, lines):
+    """Write a batch of output lines to f, encoded as UTF-8 all at once."""
+    data = ''.join(lines)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    f.write(data)
+    del lines[:]
+
+
+def _quote_fields(names):
+    """Return the (name, json-quoted name) pairs _load_fields takes.
+
+    Returns None if some name would not be written verbatim by json.dumps,
+    in which case _load_fields always does a full json.loads.
+    """
+    quoted_fields = []
+    for name in names:
+        quoted = json.dumps(name)
+        if quoted[1:-1] != name:
+            return None
+        quoted_fields.append((name, quoted))
+    return quoted_fields
+
+
+def _load_fields(line, quoted_fields):
+    """Return a dict with (at least) the given top-level fields of line.
+
+    line is a json object, as written by json.dumps.  When it is flat (no
+    nested objects, as for most datastore entities), the fields are found
+    by searching the text, and only their values are decoded.  Otherwise
+    this is just json.loads(line).
+    """
+    if quoted_fields is None or line[:1] != '{' or line.count('{') != 1:
+        return json.loads(line)
+
+    doc = {}
+    for (name, quoted) in quoted_fields:
+        # A quoted name preceded by '{' or ',' and followed by ':' can only
+        # be a key; the last one wins, as with json.loads.
+        pos = line.rfind(quoted)
+        while pos != -1:
+            before = pos - 1
+            while line[before] in _JSON_WHITESPACE:
+                before -= 1
+            value_pos = pos + len(quoted)
+            while (value_pos < len(line) and
+                   line[value_pos] in _JSON_WHITESPACE):
+                value_pos += 1
+            if line[before] in '{,' and line[value_pos:value_pos + 1] == ':':
+                value_pos += 1
+                while (value_pos < len(line) and
+                       line[value_pos] in _JSON_WHITESPACE):
+                    value_pos += 1
+                try:
+                    doc[name] = _json_scan_once(line, value_pos)[0]
+                except StopIteration:
+                    # Malformed; let json.loads say where.
+                    return json.loads(line)
+                break
+            pos = line.rfind(quoted, 0, pos)
+    return doc
 
 
 def split(split_field, delimiter, selected, 
@@ -25,30 +105,33 @@ def split(split_field, delimiter, selected,
     if delimiter == '<tab>':
         # Have to do this to get around hive oddness
         delimiter = '\t'
-    for line in sys.stdin:
-        line = line.strip()
-        doc = json.loads(line)
-
-        if split_field not in doc and not split_field_required:
-            continue
-
-        split_f = doc[split_field]
-        exploded = split_f.split(delimiter)
-        selected_fields = []
-        selected_keys = selected.split(",")
-        for key in selected_keys:
-            if key in doc:
-                data = doc[key]
-                selected_fields.append(data)
-            else:
-                selected_fields.append("")
-        if output_json:
-            selected_fields.append(line)
-        f_delim = '\t'
-        selected_str = f_delim.join(selected_fields)
-        for key in exploded:
-            output = "%s\t%s\n" % (key, selected_str)
-            sys.stdout.write(output)
+    selected_keys = selected.split(",")
+    quoted_fields = _quote_fields([split_field] + selected_keys)
+    f_delim = '\t'
+    output = []
+    for lines in _read_blocks(sys.stdin):
+        for line in lines:
+            line = line.strip()
+            doc = _load_fields(line, quoted_fields)
+
+            if split_field not in doc and not split_field_required:
+                continue
+
+            split_f = doc[split_field]
+            exploded = split_f.split(delimiter)
+            selected_fields = []
+            for key in selected_keys:
+                if key in doc:
+                    data = doc[key]
+                    selected_fields.append(data)
+                else:
+                    selected_fields.append("")
+            if output_json:
+                selected_fields.append(line)
+            selected_str = f_delim.join(selected_fields)
+            for key in exploded:
+                output.append("%s\t%s\n" % (key, selected_str))
+        _write_lines(sys.stdout, output)
 
 
 def explode(key_fields, explode_field):
@@ -60,27 +143,30 @@ def explode(key_fields, explode_field):
             def\tghi\t2
             def\tghi\t3
     """
-    for line in sys.stdin:
-        line = line.strip()
-        doc = json.loads(line)
-        exploded = None
-        if explode_field in doc:
-            exploded = doc[explode_field]
-        selected_keys = key_fields.split(",")
-        selected_fields = []
-        for key in selected_keys:
-            if key in doc:
-                data = str(doc[key])
-                selected_fields.append(data)
-            else:
-                selected_fields.append("")
-        f_delim = '\t'
-        selected_str = f_delim.join(selected_fields)
-        if not exploded:
-            continue
-        for value in exploded:
-            output = "%s\t%s\n" % (selected_str, value)
-            sys.stdout.write(output)
+    selected_keys = key_fields.split(",")
+    quoted_fields = _quote_fields([explode_field] + selected_keys)
+    f_delim = '\t'
+    output = []
+    for lines in _read_blocks(sys.stdin):
+        for line in lines:
+            line = line.strip()
+            doc = _load_fields(line, quoted_fields)
+            exploded = None
+            if explode_field in doc:
+                exploded = doc[explode_field]
+            selected_fields = []
+            for key in selected_keys:
+                if key in doc:
+                    data = str(doc[key])
+                    selected_fields.append(data)
+                else:
+                    selected_fields.append("")
+            selected_str = f_delim.join(selected_fields)
+            if not exploded:
+                continue
+            for value in exploded:
+                output.append("%s\t%s\n" % (selected_str, value))
+        _write_lines(sys.stdout, output)
 
 
 def rank(key_field_index, rank_field_index, reverse=True, delimiter="\t"):
@@ -91,50 +177,76 @@ def rank(key_field_index, rank_field_index, reverse=True, delimiter="\t"):
     rank appended as the last column.  Note that the ranks start at 1 for the 
     top value.
     """
+    output = []
+
     def process_group(lines):
         lines.sort(key=lambda l: l[rank_field_index], reverse=reverse)
         for i, vals in enumerate(lines, start=1):
             vals.append(str(i))
-            sys.stdout.write("\t".join(vals) + "\n")
+            output.append("\t".join(vals) + "\n")
 
     prev_key = None
     group = []
-    for line in sys.stdin:
-        line = line.strip().split(delimiter)
-        
-        key = line[key_field_index]
-        if key != prev_key:
-            process_group(group)
-            group = []
+    for lines in _read_blocks(sys.stdin):
+        for line in lines:
+            line = line.strip().split(delimiter)
+
+            key = line[key_field_index]
+            if key != prev_key:
+                process_group(group)
+                group = []
 
-        group.append(line)
-        prev_key = key
+            group.append(line)
+            prev_key = key
+        _write_lines(sys.stdout, output)
 
     process_group(group)
+    _write_lines(sys.stdout, output)
 
 
-def ip_to_country(ip_field_index, delimiter="\t"):
+def ip_to_country(ip_field_index, delimiter="\t", cache_size=100000):
     """This reducer takes lines of delimited values with an ip address string
     in column <ip_field_index>.  It outputs the same lines while appending
     a new column that contains the country code, or "NULL" if the country
     can't be determined.
 
+    The countries of the most recently seen <cache_size> addresses are
+    cached, since request logs see the same addresses over and over.
+
     NOTE: the hive caller must ADD FILE for both pygeoip.py and the database.
+    If it also adds a GeoIP.ranges file (made with `pygeoip.py
+    --save-country-ranges GeoIP.dat GeoIP.ranges`), that is used instead
+    of the database, which is faster still.
     """
     sys.path.append(".")
     import pygeoip
-    
-    geo_ip = pygeoip.Database('GeoIP.dat')
-
-    for line in sys.stdin:
-        line = line.strip().split(delimiter)
-        ip = line[ip_field_index]
-        try: 
-            country = geo_ip.lookup(ip).country or "NULL"
-        except:
-            country = "NULL"
-        line.append(country)
-        sys.stdout.write("\t".join(line) + "\n")
+
+    if os.path.exists('GeoIP.ranges'):
+        country_code = pygeoip.CountryRanges.load('GeoIP.ranges').country_code
+    else:
+        geo_ip = pygeoip.Database('GeoIP.dat', use_mmap=True)
+        country_code = lambda ip: geo_ip.lookup(ip).country
+
+    cache = collections.OrderedDict()
+    output = []
+    for lines in _read_blocks(sys.stdin):
+        for line in lines:
+            line = line.strip().split(delimiter)
+            ip = line[ip_field_index]
+            try:
+                country = cache.pop(ip)
+            except KeyError:
+                try: 
+                    country = country_code(ip) or "NULL"
+                except:
+                    country = "NULL"
+                if len(cache) >= cache_size:
+                    cache.popitem(last=False)
+            # (Re-)insert as the most recently used entry.
+            cache[ip] = country
+            line.append(country)
+            output.append("\t".join(line) + "\n")
+        _write_lines(sys.stdout, output)
 
 
 def main():
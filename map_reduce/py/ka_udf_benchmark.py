@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""Benchmark a ka_udf.py function on a captured Hive input file.
+
+The input file is replayed through the function, given the same arguments
+as on the ka_udf.py command line, with the output discarded, and the best
+time over a few runs is reported.  Capture the input of a TRANSFORM step
+with e.g. `INSERT OVERWRITE LOCAL DIRECTORY` on the query feeding it.
+
+For split and explode, every input line is also checked to decode to the
+same fields with ka_udf's lazy json parsing as with json.loads.
+
+Example:
+    ka_udf_benchmark.py -r 5 topics.json split topic_string_keys "<tab>" \\
+        key,title 0
+"""
+
+import json
+import optparse
+import os
+import sys
+import time
+
+import ka_udf
+
+
+def check_lazy_json(input_filename, field_names):
+    """Return the number of lines _load_fields decodes differently."""
+    quoted_fields = ka_udf._quote_fields(field_names)
+    mismatches = 0
+    with open(input_filename) as f:
+        for line in f:
+            line = line.strip()
+            doc = json.loads(line)
+            lazy_doc = ka_udf._load_fields(line, quoted_fields)
+            for name in field_names:
+                if doc.get(name) != lazy_doc.get(name):
+                    mismatches += 1
+                    if mismatches <= 10:
+                        print >> sys.stderr, "MISMATCH on %s: %s" % (name,
+                                                                     line)
+                    break
+    return mismatches
+
+
+def time_udf(input_filename, udf_args, repeat):
+    """Return the best time over repeat runs of ka_udf.py udf_args."""
+    best = None
+    for _ in xrange(repeat):
+        sys.argv = ["ka_udf.py"] + udf_args
+        sys.stdin = open(input_filename)
+        sys.stdout = open(os.devnull, "w")
+        start = time.time()
+        try:
+            ka_udf.main()
+        except SystemExit, e:
+            if e.code:
+                raise
+        finally:
+            elapsed = time.time() - start
+            sys.stdin.close()
+            sys.stdout.close()
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage="%prog [options] <input file> <func_name> <extra args>",
+            description="Benchmark a ka_udf.py function on a Hive input")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="number of timed runs of the function")
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("Please specify an input file and a function")
+    input_filename, udf_args = args[0], args[1:]
+
+    mismatches = 0
+    if udf_args[0] == "split" and len(udf_args) >= 4:
+        mismatches = check_lazy_json(input_filename,
+                                     [udf_args[1]] + udf_args[3].split(","))
+    elif udf_args[0] == "explode" and len(udf_args) == 3:
+        mismatches = check_lazy_json(input_filename,
+                                     [udf_args[2]] + udf_args[1].split(","))
+
+    with open(input_filename) as f:
+        num_lines = sum(1 for _ in f)
+    num_bytes = os.path.getsize(input_filename)
+
+    elapsed = max(time_udf(input_filename, udf_args, options.repeat), 1e-9)
+    print "%d lines, %d lazy json mismatches" % (num_lines, mismatches)
+    print "%s: %.3fs (%.0f lines/sec, %.1f MB/sec)" % (
+        udf_args[0], elapsed, num_lines / elapsed, num_bytes / elapsed / 1e6)
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,13 @@ from GAE to json encoded datastore hosted on Amazon S3. The data on S3 can then
 Input is a collection of protocol buffers taken from stdin. Each protocol
 buffer is an entity from GAE such as an entity from UserData, ProblemLog,
 VideoLog and etc.
+Input may also be a stream of length-prefixed protocol buffers (see
+write_length_prefixed), which is processed as it is read rather than loaded
+all at once like a pickle.
 Output is a series of lines piped to stdout:
 username<tab>json_encoded_entities
+With --workers N, entities are converted by N processes, and output in the
+same order as the input.
 Check out https://sites.google.com/a/khanacademy.org/forge/technical/data_n/running-emr-elastic-mapreduce-on-the-khan-academy-data
 for more information about running EMR at the Khan Academy
 
@@ -15,10 +20,14 @@ TODO(yunfang): Consider moving the primary functions here to a library
                as the pb_to_dict process doesn't really happen in hive
 """
 
+import collections
 import datetime
+import itertools
 import json
+import multiprocessing
 import optparse
 import pickle
+import struct
 import sys
 import time
 
@@ -30,6 +39,10 @@ from google.appengine.api import users
 from google.appengine.datastore import entity_pb
 
 
+# Header of each record of the length-prefixed input format: the length of
+# the protobuf that follows, as a 4-byte big-endian unsigned int.
+_LENGTH_PREFIX = struct.Struct('>I')
+
 _serialize_blacklists = {
         "Scratchpad": ['latest_revision_cache'],
         "ScratchpadRevision": ['image_url']}
@@ -44,6 +57,14 @@ def get_cmd_line_args():
                      help="field corresponding to the reducer key")
     parser.add_option("-p", "--parent", default=None,
                      help="including parent key in the json dump")
+    parser.add_option("-f", "--input_format", default="pickle",
+                     choices=["pickle", "length_prefixed"],
+                     help="pickle (a pickled list of protobufs) or "
+                          "length_prefixed (see write_length_prefixed)")
+    parser.add_option("-w", "--workers", type="int", default=1,
+                     help="number of processes converting entities")
+    parser.add_option("-c", "--chunk_size", type="int", default=500,
+                     help="entities sent to a worker at a time")
     # TODO(yunfang): Output a warning with unknown args
     options, _ = parser.parse_args()
     return options
@@ -62,9 +83,7 @@ def apply_transform(doc):
           isinstance(doc, users.User)):
         return str(doc)
     elif isinstance(doc, datetime.datetime):
-        if doc.year < 1970:
-            return 0
-        return time.mktime(doc.timetuple())
+        return _datetime_to_timestamp(doc)
     elif isinstance(doc, basestring):
         if isinstance(doc, str):
             doc = unicode(doc, errors='replace')
@@ -73,6 +92,12 @@ def apply_transform(doc):
     return doc
 
 
+def _datetime_to_timestamp(value):
+    if value.year < 1970:
+        return 0
+    return time.mktime(value.timetuple())
+
+
 def pb_to_dict(pb, parent=None):
     """Convert a protocol buffer to a json-serializable dictionary"""
     entity = datastore.Entity._FromPb(entity_pb.EntityProto(pb))
@@ -113,14 +138,194 @@ def pre_process_entity_dict(kind, document):
                 del document[prop]
 
 
+# Kinds whose properties need pre_process_entity_dict to see the raw values.
+_slow_path_kinds = frozenset(["_GAEBingoIdentityRecord"])
+
+# The same epoch datastore_types uses to convert GD_WHEN int64 values.
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+
+def _utf8_string_value(value):
+    return unicode(value, 'utf-8').replace("\n", "\\n")
+
+
+def _byte_string_value(value):
+    return unicode(value, errors='replace').replace("\n", "\\n")
+
+
+def _when_value(value):
+    return _datetime_to_timestamp(_EPOCH + datetime.timedelta(
+        microseconds=value))
+
+
+# Conversions straight from a raw protobuf value to the json-serializable
+# value apply_transform would produce, keyed by the property's meaning.
+# These give the same result as datastore_types.FromPropertyPb followed by
+# apply_transform, without building the intermediate datastore types.
+_string_conversions = {
+    0: _utf8_string_value,
+    entity_pb.Property.TEXT: _utf8_string_value,
+    entity_pb.Property.BLOB: _byte_string_value,
+    entity_pb.Property.BYTESTRING: _byte_string_value,
+}
+_int64_conversions = {
+    0: long,
+    entity_pb.Property.GD_WHEN: _when_value,
+}
+
+
+def _property_to_json_value(prop):
+    """Convert a Property protobuf to a json-serializable value."""
+    pbval = prop.value()
+    meaning = prop.meaning()
+    if pbval.has_stringvalue():
+        convert = _string_conversions.get(meaning)
+        if convert:
+            return convert(pbval.stringvalue())
+    elif pbval.has_int64value():
+        convert = _int64_conversions.get(meaning)
+        if convert:
+            return convert(pbval.int64value())
+    elif pbval.has_booleanvalue():
+        if not meaning:
+            return bool(pbval.booleanvalue())
+    elif pbval.has_doublevalue():
+        if not meaning:
+            return pbval.doublevalue()
+    # Anything less common (users, references, points, ratings, ...) goes
+    # through the regular datastore conversion.
+    return apply_transform(datastore_types.FromPropertyPb(prop))
+
+
+def fast_pb_to_dict(pb, parent=None):
+    """Convert a protocol buffer to a json-serializable dictionary.
+
+    This produces the same dictionary as pb_to_dict -- down to the key order,
+    so json.dumps gives byte-identical output -- but walks the EntityProto
+    properties directly instead of building a datastore.Entity and then
+    transforming it with apply_transform.
+    """
+    proto = entity_pb.EntityProto(pb)
+    path = proto.key().path()
+    if (not path.element_size() or
+            path.element(path.element_size() - 1).type() in _slow_path_kinds):
+        return pb_to_dict(pb, parent)
+
+    # Build the dict the same way datastore.Entity._FromPb does, so that
+    # the final key order matches.
+    values = {}
+    for prop_list in (proto.property_list(), proto.raw_property_list()):
+        for prop in prop_list:
+            value = _property_to_json_value(prop)
+            name = prop.name()
+            cur_value = values.get(name)
+            if cur_value is None:
+                values[name] = [value] if prop.multiple() else value
+            elif prop.multiple() and isinstance(cur_value, list):
+                cur_value.append(value)
+            else:
+                # Corrupt entity; let the regular path raise about it.
+                return pb_to_dict(pb, parent)
+    entity = {}
+    for name, value in values.iteritems():
+        entity[name.decode('utf-8')] = value
+    document = dict(entity)
+
+    key = datastore_types.Key._FromPb(proto.key())
+    pre_process_entity_dict(key.kind(), document)
+
+    document['key'] = str(key)
+    if parent and key.parent():
+        document['parent'] = str(key.parent())
+    return document
+
+
+def write_length_prefixed(f, pbs):
+    """Write protobufs to f in the length-prefixed input format."""
+    for pb in pbs:
+        f.write(_LENGTH_PREFIX.pack(len(pb)))
+        f.write(pb)
+
+
+def read_length_prefixed(f):
+    """Yield the protobufs written to f by write_length_prefixed."""
+    while True:
+        header = f.read(_LENGTH_PREFIX.size)
+        if not header:
+            return
+        if len(header) < _LENGTH_PREFIX.size:
+            raise ValueError("Truncated length prefix")
+        (length,) = _LENGTH_PREFIX.unpack(header)
+        pb = f.read(length)
+        if len(pb) < length:
+            raise ValueError("Truncated protobuf: expected %d bytes, got %d" %
+                             (length, len(pb)))
+        yield pb
+
+
+def pb_to_line(pb, key, parent):
+    """Convert a protocol buffer to a key<tab>json output line."""
+    document = fast_pb_to_dict(pb, parent)
+    json_str = json.dumps(document)
+    return "%s\t%s" % (document[key], json_str)
+
+
+# The (key, parent) options of a worker process, set by _init_worker.
+_worker_options = None
+
+
+def _init_worker(key, parent):
+    global _worker_options
+    _worker_options = (key, parent)
+
+
+def _pbs_to_lines(pbs):
+    key, parent = _worker_options
+    return [pb_to_line(pb, key, parent) for pb in pbs]
+
+
+def parallel_pbs_to_lines(pbs, key, parent, workers, chunk_size):
+    """Yield the output lines of pbs, converted by a pool of processes.
+
+    pbs is consumed chunk_size entities at a time, with at most two chunks
+    per worker in flight, so a streaming input is never read far ahead of
+    the output.  Lines are yielded in input order.
+    """
+    pool = multiprocessing.Pool(workers, _init_worker, (key, parent))
+    try:
+        pbs = iter(pbs)
+        pending = collections.deque()
+        while True:
+            chunk = list(itertools.islice(pbs, chunk_size))
+            if chunk:
+                pending.append(pool.apply_async(_pbs_to_lines, (chunk,)))
+            if pending and (not chunk or len(pending) >= 2 * workers):
+                for line in pending.popleft().get():
+                    yield line
+            elif not chunk:
+                break
+        pool.close()
+    finally:
+        pool.terminate()
+
+
 def main():
     """Map step for the protobuf loading. Input is read from stdin."""
     options = get_cmd_line_args()
-    entity_list = pickle.load(sys.stdin)
-    for pb in entity_list:
-        document = pb_to_dict(pb, options.parent)
-        json_str = json.dumps(document)
-        print "%s\t%s" % (document[options.key], json_str)
+    if options.input_format == "length_prefixed":
+        entity_list = read_length_prefixed(sys.stdin)
+    else:
+        entity_list = pickle.load(sys.stdin)
+
+    if options.workers > 1:
+        lines = parallel_pbs_to_lines(entity_list, options.key,
+                                      options.parent, options.workers,
+                                      options.chunk_size)
+    else:
+        lines = (pb_to_line(pb, options.key, options.parent)
+                 for pb in entity_list)
+    for line in lines:
+        print line
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""Micro-benchmark of load_pbufs_to_hive.fast_pb_to_dict against pb_to_dict.
+
+Input is a recorded sample of entities: a pickled list of protocol buffers,
+optionally gzipped, such as the .pickle.gz archives written by
+gae_download.py or the output of fetch_entities.py.  Every entity is
+converted with both functions, the json output is checked to be
+byte-identical, and the time each conversion takes is reported.
+
+Example:
+    load_pbufs_to_hive_benchmark.py -r 5 \\
+        ~/kabackup/daily_new/2012-10-01/ProblemLog/*.pickle.gz
+"""
+
+import gzip
+import json
+import optparse
+import pickle
+import sys
+import time
+
+import load_pbufs_to_hive
+
+
+def load_sample(filenames):
+    entity_list = []
+    for filename in filenames:
+        if filename.endswith('.gz'):
+            f = gzip.open(filename, 'rb')
+        else:
+            f = open(filename, 'rb')
+        entity_list += pickle.load(f)
+        f.close()
+    return entity_list
+
+
+def time_conversion(convert, entity_list, parent, repeat):
+    """Return the best time over repeat runs to convert entity_list."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for pb in entity_list:
+            json.dumps(convert(pb, parent))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage="%prog [options] <pickle files>",
+            description="Benchmark fast_pb_to_dict against pb_to_dict")
+    parser.add_option("-p", "--parent", default=None,
+                      help="including parent key in the json dump")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="number of timed runs of each conversion")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("Please specify at least one pickle file")
+
+    entity_list = load_sample(args)
+
+    mismatches = 0
+    for pb in entity_list:
+        expected = json.dumps(load_pbufs_to_hive.pb_to_dict(pb,
+                                                            options.parent))
+        actual = json.dumps(load_pbufs_to_hive.fast_pb_to_dict(
+                pb, options.parent))
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print >> sys.stderr, "MISMATCH:\n  %s\n  %s" % (expected,
+                                                                actual)
+
+    slow = time_conversion(load_pbufs_to_hive.pb_to_dict, entity_list,
+                           options.parent, options.repeat)
+    fast = time_conversion(load_pbufs_to_hive.fast_pb_to_dict, entity_list,
+                           options.parent, options.repeat)
+
+    n = max(len(entity_list), 1)
+    print "%d entities, %d mismatches" % (len(entity_list), mismatches)
+    print "pb_to_dict:      %.3fs (%.1f us/entity)" % (slow, 1e6 * slow / n)
+    print "fast_pb_to_dict: %.3fs (%.1f us/entity)" % (fast, 1e6 * fast / n)
+    print "speedup:         %.2fx" % (slow / max(fast, 1e-9))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
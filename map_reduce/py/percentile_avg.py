@@ -64,8 +64,32 @@ Use two additional columns as a key:
                   get_json_object(json, '$.live' )
    ) t;
 
+Streaming mode:
+ By default all of the input is read into memory before any averages are
+ computed.  If the rows for each key are contiguous in the input (e.g. with
+ CLUSTER BY instead of DISTRIBUTE BY above), pass -s to process one key at
+ a time instead.  The keys are then output in the order they're input,
+ rather than sorted.  For keys with very many rows, -a N additionally
+ bounds the memory used per key: past N rows, the values are summarized
+ with a QuantileSketch, and an approximate trimmed average is output.
+
+ ADD FILE s3://ka-mapreduce/code/[BRANCH]/py/percentile_avg.py;
+ SELECT TRANSFORM (
+       get_json_object(json, '$.seconds_per_fast_problem' ),
+       get_json_object(json, '$.author' )
+     )
+     USING 'python percentile_avg.py -l 0.1 -u 0.9 -s -a 1000000'
+     AS avg, key
+ FROM
+   (SELECT exercise.json as json,
+           get_json_object(exercise.json, '$.author') as author
+    FROM exercise
+    CLUSTER BY author
+   ) t;
+
 """
 
+import array
 import numpy as np
 import optparse
 import re
@@ -76,8 +100,20 @@ def get_cmd_line_options():
     parser = optparse.OptionParser()
     parser.add_option("-l", "--lower_bound", type=float, default=0.1)
     parser.add_option("-u", "--upper_bound", type=float, default=0.9)
+    parser.add_option("-s", "--streaming", action="store_true",
+                      default=False,
+                      help="process one key at a time; the rows for each "
+                           "key must be contiguous in the input")
+    parser.add_option("-a", "--approximate_above", type=int, default=None,
+                      help="with --streaming, approximate the average of "
+                           "keys with more than this many rows")
     options, _ = parser.parse_args()
-    return options.lower_bound, options.upper_bound
+    if options.approximate_above is not None:
+        if not options.streaming:
+            parser.error("--approximate_above requires --streaming")
+        if options.approximate_above < 2:
+            parser.error("--approximate_above must be at least 2")
+    return options
 
 
 NAN_REGEX = re.compile(r'(^$|\\N)')
@@ -97,12 +133,200 @@ def decompose_line(line):
         # additional columns
         key = line_split[1]
     # turn empty lines and Hive NaNs into "nan"
-    val = NAN_REGEX.sub('nan', val)
+    if not val or '\\N' in val:
+        val = NAN_REGEX.sub('nan', val)
     return val, key
 
 
+def trimmed_mean(x, lower_bound, upper_bound):
+    """Return the mean of the values of x between the percentile bounds."""
+    # sort it
+    x = np.sort(x)
+
+    # average the data only between the appropriate percentiles.  the
+    # "if" statements deal with insufficient data.  The behavior if
+    # there are only one or two valid rows is inconsistent with that
+    # if there's more data, but I think it's better than returning
+    # NaNs if there's not enough data
+    percentiles = np.arange(x.shape[0], dtype=float)
+    if x.shape[0] > 2:
+        percentiles = percentiles / np.max(percentiles)
+    elif x.shape[0] == 2:
+        percentiles[0] = 0.49999
+        percentiles[1] = 0.50001
+    elif x.shape[0] == 1:
+        percentiles[0] = 0.5
+    # x_gd holds the elements in x which fall within the allowed percentile
+    # range
+    x_gd = x[(percentiles >= lower_bound) & (percentiles <= upper_bound)]
+    # if there are any elements in the allowed percentile range, average
+    # over them, otherwise NaN
+    if x_gd.shape[0] > 0:
+        return np.mean(x_gd)
+    return np.nan
+
+
+def print_avg(avg, key):
+    if not np.isfinite(avg):
+        # use Hive's NaN string
+        print r'\N',
+    else:
+        # display the average within the selected percentile range
+        print avg,
+    # and print out the current key
+    print "\t%s" % key
+
+
+class QuantileSketch(object):
+    """A mergeable, bounded-size summary of a stream of values.
+
+    This is a simple KLL-style sketch: values are kept in levels, where
+    each value in level i stands for 2 ** i of the input values.  When a
+    level grows past max_level_size values, it is sorted and every other
+    value is promoted to the next level up, so memory is
+    O(max_level_size * log(n / max_level_size)).  Two sketches can be
+    combined with merge(), e.g. to summarize a key split across reducers.
+    """
+
+    def __init__(self, max_level_size):
+        self.max_level_size = max_level_size
+        self.levels = [np.empty(0)]
+        # Which of each pair of values is promoted alternates, so that
+        # promotion is unbiased on average.
+        self._offset = 0
+
+    def add(self, values):
+        """Add a numpy array of values to the sketch."""
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compact()
+
+    def merge(self, other):
+        """Add all the values summarized by another sketch to this one."""
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate((self.levels[level], values))
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values.shape[0] > self.max_level_size:
+                values = np.sort(values)
+                # With an odd number of values, one stays at this level.
+                num_kept = values.shape[0] % 2
+                self.levels[level] = values[values.shape[0] - num_kept:]
+                promoted = values[self._offset:values.shape[0] - num_kept:2]
+                self._offset = 1 - self._offset
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate(
+                    (self.levels[level + 1], promoted))
+            level += 1
+
+    def trimmed_mean(self, lower_bound, upper_bound):
+        """Approximate trimmed_mean() of all the values added."""
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.ones(v.shape[0]) * 2 ** level
+                                  for level, v in enumerate(self.levels)])
+        order = np.argsort(values)
+        values = values[order]
+        weights = weights[order]
+        if values.shape[0] <= 2:
+            return trimmed_mean(values, lower_bound, upper_bound)
+
+        # The percentile of each value is that of the middle of the run of
+        # input values it stands for, as in trimmed_mean().
+        positions = np.cumsum(weights) - (weights + 1) / 2.0
+        percentiles = positions / (weights.sum() - 1)
+        in_range = (percentiles >= lower_bound) & (percentiles <= upper_bound)
+        if not in_range.any():
+            return np.nan
+        return np.average(values[in_range], weights=weights[in_range])
+
+
+def summarize_group(values, sketch, lower_bound, upper_bound):
+    """Return the trimmed mean of one key's values, or None if none are valid.
+
+    values is an array.array('d') of the key's values not yet added to
+    sketch, which is None unless the key has too many values to average
+    exactly.
+    """
+    x = np.frombuffer(values, dtype=float) if values else np.empty(0)
+    # throw out any rows with non-finite values
+    x = x[np.isfinite(x)]
+    if sketch is None:
+        if x.shape[0] == 0:
+            return None
+        return trimmed_mean(x, lower_bound, upper_bound)
+
+    sketch.add(x)
+    if not any(v.shape[0] for v in sketch.levels):
+        return None
+    return sketch.trimmed_mean(lower_bound, upper_bound)
+
+
+def streaming_main(options):
+    """Output the trimmed average of each run of rows with the same key.
+
+    The averages are only output once all the input has been read, so that
+    an unparseable value gives just Hive's NaN, as in the default mode.
+    """
+    lower_bound = options.lower_bound
+    upper_bound = options.upper_bound
+    approximate_above = options.approximate_above
+
+    # (avg, key) of each key with valid data, in input order
+    avgs = []
+    prev_key = None
+    values = array.array('d')
+    sketch = None
+    for line in sys.stdin:
+        val, key = decompose_line(line)
+        if key != prev_key:
+            if prev_key is not None:
+                avg = summarize_group(values, sketch, lower_bound, upper_bound)
+                if avg is not None:
+                    avgs.append((avg, prev_key))
+            prev_key = key
+            values = array.array('d')
+            sketch = None
+
+        try:
+            values.append(float(val))
+        except ValueError:
+            print >>sys.stderr, \
+                "percentile_avg.py could not convert first input column to float"
+            # and return NaN to Hive
+            print r'\N'
+            return
+
+        if approximate_above and len(values) > approximate_above:
+            if sketch is None:
+                sketch = QuantileSketch(approximate_above)
+            x = np.frombuffer(values, dtype=float)
+            sketch.add(x[np.isfinite(x)])
+            values = array.array('d')
+
+    if prev_key is not None:
+        avg = summarize_group(values, sketch, lower_bound, upper_bound)
+        if avg is not None:
+            avgs.append((avg, prev_key))
+
+    # if there was no valid data, output Hive's NaN
+    if not avgs:
+        print r'\N'
+    for avg, key in avgs:
+        print_avg(avg, key)
+
+
 def main():
-    lower_bound, upper_bound = get_cmd_line_options()
+    options = get_cmd_line_options()
+    if options.streaming:
+        streaming_main(options)
+        return
+    lower_bound, upper_bound = options.lower_bound, options.upper_bound
 
     # load in the data, stripping linefeeds, and converting empty
     # lines and \N to nan
@@ -157,40 +381,8 @@ def main():
             end_ind = unq_inds[ii + 1]
         # get the values data for just this key
         x = vals[start_ind:end_ind]
-        # sort it
-        x = np.sort(x)
-
-        # average the data only between the appropriate percentiles.  the
-        # "if" statements deal with insufficient data.  The behavior if
-        # there are only one or two valid rows is inconsistent with that
-        # if there's more data, but I think it's better than returning
-        # NaNs if there's not enough data
-        percentiles = np.arange(x.shape[0], dtype=float)
-        if x.shape[0] > 2:
-            percentiles = percentiles / np.max(percentiles)
-        elif x.shape[0] == 2:
-            percentiles[0] = 0.49999
-            percentiles[1] = 0.50001
-        elif x.shape[0] == 1:
-            percentiles[0] = 0.5
-        # x_gd holds the elements in x which fall within the allowed percentile
-        # range
-        x_gd = x[(percentiles >= lower_bound) & (percentiles <= upper_bound)]
-        # if there are any elements in the allowed percentile range, average
-        # over them, otherwise NaN
-        if x_gd.shape[0] > 0:
-            avg = np.mean(x_gd)
-        else:
-            avg = np.nan
-
-        if not np.isfinite(avg):
-            # use Hive's NaN string
-            print r'\N',
-        else:
-            # display the average within the selected percentile range
-            print avg,
-        # and print out the current key
-        print "\t%s" % key
+        avg = trimmed_mean(x, lower_bound, upper_bound)
+        print_avg(avg, key)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,76 @@
+import StringIO
+import sys
+import unittest
+
+import percentile_avg
+
+
+class PercentileAvgTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_argv = sys.argv
+        self.orig_stdin = sys.stdin
+        self.orig_stdout = sys.stdout
+        self.orig_stderr = sys.stderr
+
+    def tearDown(self):
+        sys.argv = self.orig_argv
+        sys.stdin = self.orig_stdin
+        sys.stdout = self.orig_stdout
+        sys.stderr = self.orig_stderr
+
+    def run_reducer(self, args, lines):
+        sys.argv = ['percentile_avg.py'] + args
+        sys.stdin = StringIO.StringIO(''.join('%s\n' % l for l in lines))
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        percentile_avg.main()
+        return sys.stdout.getvalue()
+
+    def assert_modes_match(self, lines):
+        expected = self.run_reducer([], lines)
+        self.assertEqual(expected, self.run_reducer(['-s'], lines))
+        self.assertEqual(expected, self.run_reducer(['-s', '-a', '100'],
+                                                    lines))
+
+    def test_keyed(self):
+        # The rows for each key are contiguous, and the keys sorted, so
+        # streaming outputs the keys in the same order.
+        lines = ['%s\ta\t1' % v for v in [5, 1, 3, 2, 4, 100, -50, 2.5]]
+        lines += ['\\N\tb\t1', '\tb\t1', '7\tb\t1', '8\tb\t2']
+        lines += ['\\N\tc\t1']
+        lines += ['%s\td\t1' % v for v in range(20)]
+        self.assert_modes_match(lines)
+
+    def test_no_key(self):
+        self.assert_modes_match(['%s' % v for v in range(10)])
+
+    def test_no_valid_data(self):
+        self.assert_modes_match([])
+        self.assert_modes_match(['\\N\ta', '\ta'])
+
+    def test_unparseable(self):
+        # Only Hive's NaN is output, even for the keys before the bad value.
+        lines = ['1\ta', '2\ta', '3\tb', 'x\tc', '4\td']
+        self.assertEqual('\\N\n', self.run_reducer([], lines))
+        self.assert_modes_match(lines)
+
+    def test_approximate(self):
+        lines = ['%s\ta' % ((v * 7919) % 10000) for v in range(10000)]
+        lines += ['%s\tb' % v for v in range(50)]
+        exact = self.run_reducer(['-s'], lines).splitlines()
+        approximate = self.run_reducer(['-s', '-a', '200'],
+                                       lines).splitlines()
+        self.assertEqual(len(exact), 2)
+        self.assertEqual(len(approximate), 2)
+        # Key a is approximated; key b has few enough rows to be exact.
+        (exact_avg, key) = exact[0].split('\t')
+        (approximate_avg, approximate_key) = approximate[0].split('\t')
+        self.assertEqual(key, approximate_key)
+        self.assertAlmostEqual(float(exact_avg), float(approximate_avg),
+                               delta=0.02 * float(exact_avg))
+        self.assertEqual(exact[1], approximate[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,8 +75,11 @@ table definition to contain them:
   instance        # 00c61b117c5f1f26699563074cdd44e841096e
 """
 
+import collections
 import json
 import re
+import sre_constants
+import sre_parse
 import sys
 import urlparse
 
@@ -180,6 +183,11 @@ def route_for_url(route_map, url, method):
         # No match in the wsgi route table?  Also a 404.
         return url_path
 
+    return _route_name(app_yaml_module, wsgi_regexp, method)
+
+
+def _route_name(app_yaml_module, wsgi_regexp, method):
+    """The string route_for_url() returns for a matching wsgi regexp."""
     regexp = wsgi_regexp.pattern
     # Clean up the regexp a little bit.
     if regexp.startswith('^') and regexp.endswith('$'):
@@ -191,6 +199,113 @@ def route_for_url(route_map, url, method):
     return '%s:%s' % (app_yaml_module, regexp)
 
 
+def _literal_prefix(regexp):
+    """Return a string that every url regexp.search() matches starts with.
+
+    This is the run of literal characters after a leading '^', or the
+    empty string if the regexp isn't anchored that way (and so could match
+    any url).
+    """
+    if regexp.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+    try:
+        parsed = list(sre_parse.parse(regexp.pattern, regexp.flags))
+    except (sre_constants.error, TypeError):
+        return ''
+    if not parsed or parsed[0] != (sre_constants.AT,
+                                   sre_constants.AT_BEGINNING):
+        return ''
+    prefix = []
+    for (op, av) in parsed[1:]:
+        # Stop at non-ascii characters too, since the url paths are byte
+        # strings and the regexps (from json) are usually unicode.
+        if op != sre_constants.LITERAL or av >= 128:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+class _PrefixIndex(object):
+    """Finds the first of a list of regexps that matches a url path.
+
+    Each regexp is filed under its literal prefix (see _literal_prefix), so
+    only the regexps whose prefix the url path starts with -- usually a
+    handful -- are tried, still in their original order.
+    """
+
+    def __init__(self, regexps):
+        self._by_prefix = collections.defaultdict(list)
+        for (i, regexp) in enumerate(regexps):
+            self._by_prefix[_literal_prefix(regexp)].append((i, regexp))
+        self._prefix_lengths = sorted(set(len(prefix)
+                                          for prefix in self._by_prefix))
+
+    def candidates(self, url_path):
+        """Return (index, regexp) pairs that may match url_path, in order."""
+        candidates = []
+        for length in self._prefix_lengths:
+            if length > len(url_path):
+                break
+            candidates.extend(self._by_prefix.get(url_path[:length], ()))
+        candidates.sort()
+        return candidates
+
+
+class RouteIndex(object):
+    """A faster, caching equivalent of route_for_url() for one route_map.
+
+    Usage:
+        route_index = RouteIndex(route_map)
+        route_index.route_for_url(url, method)
+    gives the same result as route_for_url(route_map, url, method).
+    """
+
+    def __init__(self, route_map, cache_size=10000):
+        self._route_map = route_map
+        self._app_yaml_index = _PrefixIndex(
+            [app_yaml_info[0] for app_yaml_info in route_map])
+        self._wsgi_indices = [
+            _PrefixIndex([wsgi_info[0] for wsgi_info in app_yaml_info[2:]])
+            for app_yaml_info in route_map]
+        self._app_yaml_modules = [
+            re.sub(r'\.[^.]+$', '', app_yaml_info[1])
+            for app_yaml_info in route_map]
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def route_for_url(self, url, method):
+        """See route_for_url()."""
+        url_path = urlparse.urlparse(url).path
+        key = (url_path, method)
+        try:
+            route = self._cache.pop(key)
+        except KeyError:
+            route = self._lookup(url_path, method)
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        # (Re-)insert as the most recently used entry.
+        self._cache[key] = route
+        return route
+
+    def _lookup(self, url_path, method):
+        for (i, app_yaml_regexp) in self._app_yaml_index.candidates(url_path):
+            if app_yaml_regexp.search(url_path):
+                break
+        else:   # for/else
+            return url_path
+
+        app_yaml_info = self._route_map[i]
+        for (j, wsgi_regexp) in self._wsgi_indices[i].candidates(url_path):
+            methods = app_yaml_info[2 + j][2:]
+            if ((not methods or method in methods) and
+                wsgi_regexp.search(url_path)):
+                break
+        else:   # for/else
+            return url_path
+
+        return _route_name(self._app_yaml_modules[i], wsgi_regexp, method)
+
+
 def convert_stats_route_map_strings_to_regexps(route_map):
     """Convert re-strings in ka.org/stats/route_map output to re objects."""
     for app_yaml_info in route_map:
@@ -219,8 +334,16 @@ class RequestLogIterator:
 
     def _set_next_line(self):
         try:
-            self.next_line = self._iter.next()
-            self.next_match = _LOG_MATCHER.match(self.next_line)
+            line = self._iter.next()
+            self.next_line = line
+            # Only run the (expensive) regexp on likely request logs: they
+            # start with the (non-space) ip address, and have the 'ms=' and
+            # 'instance=' fields.  This rules out nearly all app logs.
+            if (line[:1].isspace() or 'ms=' not in line
+                    or 'instance=' not in line):
+                self.next_match = None
+            else:
+                self.next_match = _LOG_MATCHER.match(line)
         except StopIteration:
             self.next_line = self.sentinel
             self.next_match = None
@@ -253,8 +376,9 @@ def main(input_file, route_map):
             by route_map.py:generate_route_map(), or by
             http://www.khanacademy.org/stats/route_map (but with the
             regexp strings converted to actual regexps).  This is
-            passed as-is to route_for_url().
+            used to build a RouteIndex to look up url routes.
     """
+    route_index = RouteIndex(route_map)
 
     for (request_log_line, request_log_match, app_log_lines) in (
          RequestLogIterator(input_file)):
@@ -274,12 +398,15 @@ def main(input_file, route_map):
 
         # Map the URL to its route.
         sorted_fields.append(('url_route',
-                              route_for_url(route_map,
+                              route_index.route_for_url(
                                   request_log_match.group('url'),
                                   request_log_match.group('method'))))
 
         # Add the bingo_id and kalog if it exists in the app logs
         for line in app_log_lines:
+            # Cheaper than the regexp, and true of very few app logs.
+            if 'KALOG;' not in line:
+                continue
             kalog_match = _KA_LOG_MATCHER.match(line)
             if kalog_match:
                 
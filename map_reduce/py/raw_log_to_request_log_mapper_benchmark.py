@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Benchmark RouteIndex.route_for_url against the linear route_for_url.
+
+Replays the request logs in a sample of raw logs (such as a day of logs
+from fetch_logs.py, sampled with e.g. `awk 'NR % 100 == 0'`) through both
+route lookups, checks that they agree, and reports lookups/sec for each.
+
+Example:
+    raw_log_to_request_log_mapper_benchmark.py route_map_file.json \\
+        < sampled_logs.txt
+"""
+
+import json
+import sys
+import time
+
+import raw_log_to_request_log_mapper as mapper
+
+
+def main(route_map_filename, input_file):
+    with open(route_map_filename) as f:
+        route_map = json.load(f)
+        mapper.convert_stats_route_map_strings_to_regexps(route_map)
+
+    requests = []
+    for line in input_file:
+        match = mapper._LOG_MATCHER.match(line)
+        if match:
+            requests.append((match.group('url'), match.group('method')))
+    if not requests:
+        sys.exit("No request logs found in the input")
+
+    start = time.time()
+    expected = [mapper.route_for_url(route_map, url, method)
+                for (url, method) in requests]
+    linear_secs = time.time() - start
+
+    route_index = mapper.RouteIndex(route_map)
+    start = time.time()
+    actual = [route_index.route_for_url(url, method)
+              for (url, method) in requests]
+    index_secs = time.time() - start
+
+    mismatches = [(request, e, a) for (request, e, a)
+                  in zip(requests, expected, actual) if e != a]
+    for ((url, method), e, a) in mismatches[:10]:
+        print >> sys.stderr, "MISMATCH: %s %s\n  %s\n  %s" % (method, url,
+                                                             e, a)
+
+    print "%d requests, %d distinct (path, method), %d mismatches" % (
+        len(requests), len(set(requests)), len(mismatches))
+    print "route_for_url:            %.0f lookups/sec" % (
+        len(requests) / max(linear_secs, 1e-9))
+    print "RouteIndex.route_for_url: %.0f lookups/sec" % (
+        len(requests) / max(index_secs, 1e-9))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit("Usage: %s <route_map_file.json> < logs" % sys.argv[0])
+    main(sys.argv[1], sys.stdin)
@@ -0,0 +1,99 @@
+import unittest
+
+import raw_log_to_request_log_mapper as mapper
+
+
+# Modeled on the output of http://www.khanacademy.org/stats/route_map
+_ROUTE_MAP = [
+    [u"^/_ah/queue/deferred.*", u"deferred.application",
+        [u"^/_ah/queue/deferred_problemlog$", u"DeferredProblemLog", u"POST"],
+        [u".*", u"TaskHandler"]],
+    [u"^/api/.*", u"api.main.application",
+        [u"^/api/v1/user/exercises/([^/]+)/problems/(\\d+)/attempt$",
+            u"attempt", u"POST", u"PUT"],
+        [u"^/api/v1/user/exercises/([^/]+)$", u"user_exercise", u"GET"],
+        [u"^/api/v1/user/topic/precache/(.+)$", u"precache"],
+        [u"^/api/v1/(?i)USER$", u"user"],
+        [u"/v1/", u"v1_catchall"]],
+    [u"(?i)^/ADMIN", u"admin.application",
+        [u"^/admin/(.*)$", u"admin"]],
+    [u"^/images/", u"static_images",
+        [u"\\.png$", u"png"]],
+    [u"^/(?:math|science)/|^/humanities/", u"main.application",
+        [u"^/(?:math|science)/.*/v/([^/]*)$", u"video", u"GET"],
+        [u"^/(?:math|science)/.*/e/([^/]*)$", u"exercise", u"GET"],
+        [u"^/humanities/", u"humanities"]],
+    [u".*\\.ico$", u"favicon.application",
+        [u".*", u"favicon"]],
+    [u"^/$", u"main.application",
+        [u"^\\/$", u"homepage", u"GET", u"HEAD"]],
+]
+
+_URLS = [
+    "/",
+    "/?utm=1",
+    "/favicon.ico",
+    "/images/featured-actions/campbells-soup.png",
+    "/images/thing.jpg",
+    "/_ah/queue/deferred_problemlog",
+    "/_ah/queue/deferred_other",
+    "/api/v1/user/exercises/addition_1/problems/1/attempt",
+    "/api/v1/user/exercises/addition_1",
+    "/api/v1/user/topic/precache/addition/e/addition_1?casing=camel",
+    "/api/v1/user",
+    "/api/v1/USER",
+    "/api/v2/user",
+    "/api/v1/videos",
+    "/admin/backfill",
+    "/Admin/backfill",
+    "/math/arithmetic/addition/v/basic-addition",
+    "/science/chemistry/e/moles",
+    "/humanities/art",
+    "/math",
+    "/not/found",
+    "http://www.khanacademy.org/math/algebra/v/solving?x=y",
+    "",
+]
+
+
+class RouteIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.route_map = [list(app_yaml_info) for app_yaml_info in _ROUTE_MAP]
+        for app_yaml_info in self.route_map:
+            for i in range(2, len(app_yaml_info)):
+                app_yaml_info[i] = list(app_yaml_info[i])
+        mapper.convert_stats_route_map_strings_to_regexps(self.route_map)
+
+    def test_same_routes_as_route_for_url(self):
+        route_index = mapper.RouteIndex(self.route_map)
+        for method in ('GET', 'POST', 'PUT', 'HEAD'):
+            for url in _URLS:
+                self.assertEqual(
+                    mapper.route_for_url(self.route_map, url, method),
+                    route_index.route_for_url(url, method),
+                    "%s %s" % (method, url))
+
+    def test_cache_eviction(self):
+        route_index = mapper.RouteIndex(self.route_map, cache_size=3)
+        for _ in range(3):
+            for url in _URLS:
+                self.assertEqual(
+                    mapper.route_for_url(self.route_map, url, 'GET'),
+                    route_index.route_for_url(url, 'GET'))
+        self.assertEqual(3, len(route_index._cache))
+
+    def test_literal_prefix(self):
+        prefix = lambda regexp: mapper._literal_prefix(
+            mapper.re.compile(regexp))
+        self.assertEqual('/api/', prefix(r'^/api/.*'))
+        self.assertEqual('/api/v1/', prefix(r'^\/api\/v1\/(\d+)'))
+        self.assertEqual('/ap', prefix(r'^/api?'))
+        self.assertEqual('', prefix(r'/api/'))
+        self.assertEqual('/', prefix(r'^/a|^/b'))
+        self.assertEqual('', prefix(r'^/a|/b'))
+        self.assertEqual('', prefix(r'(?i)^/api'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,11 +23,15 @@ Emits lines of the following format:
 Where score represents the similiarity score for use in a suggestion algorithm.
 Note that scores may not necessarily be symmetric - this will represent
 video_j's score after having watched video_i.
+
+--num_best sets how many videos are emitted for each video (default
+NUM_BEST), and --score selects the score, from SCORE_FUNCTIONS.
 """
 
 
 import heapq
 import math
+import optparse
 import sys
 
 
@@ -43,20 +47,33 @@ _IN = sys.stdin  # For unit testing.
 _OUT = sys.stdout
 
 
-def emit_best_pairs(video_key, scored_pairs):
+def emit_best_pairs(video_key, best_pairs):
     """Emit a video and its computed best pairs of videos.
     Arguments:
         video_key - a string for the video key these pairs belong to
-        scored_pairs - a list of [vid1, vid2, score] values
+        best_pairs - a min-heap of (score, -index, vid2) values, as kept by
+            add_scored_pair
     """
     if not video_key:
         return
 
-    best_pairs = heapq.nlargest(NUM_BEST,
-                                scored_pairs,
-                                key=lambda scored_pair: scored_pair[2])
-    for vid1, vid2, score in best_pairs:
-        _OUT.write(DELIMITER.join([vid1, vid2, str(score)]) + '\n')
+    best_pairs.sort(reverse=True)
+    _OUT.write(''.join('%s%s%s%s%s\n' % (video_key, DELIMITER, vid2,
+                                         DELIMITER, str(score))
+                       for (score, _, vid2) in best_pairs))
+
+
+def add_scored_pair(best_pairs, num_best, scored_pair):
+    """Add a (score, -index, vid2) to the min-heap best_pairs, keeping only
+    the num_best highest scoring.
+
+    Among pairs with the same score, the first ones seen are kept, as
+    heapq.nlargest would.
+    """
+    if len(best_pairs) < num_best:
+        heapq.heappush(best_pairs, scored_pair)
+    elif scored_pair > best_pairs[0]:
+        heapq.heapreplace(best_pairs, scored_pair)
 
 
 def compute_score(preceed_count, succeed_count, video1_count, video2_count):
@@ -64,9 +81,52 @@ def compute_score(preceed_count, succeed_count, video1_count, video2_count):
             (math.sqrt(video1_count) * math.sqrt(video2_count)))
 
 
-def main():
+def compute_jaccard_score(preceed_count, succeed_count,
+                          video1_count, video2_count):
+    """The fraction of users who watched either video that watched both."""
+    cooccurrence_count = preceed_count + succeed_count
+    return (float(cooccurrence_count) /
+            (video1_count + video2_count - cooccurrence_count))
+
+
+def compute_conditional_score(preceed_count, succeed_count,
+                              video1_count, video2_count):
+    """The fraction of users who watched video1 that also watched video2."""
+    return float(preceed_count + succeed_count) / video1_count
+
+
+# The scoring functions that can be selected with --score.
+SCORE_FUNCTIONS = {
+    'cosine': compute_score,
+    'jaccard': compute_jaccard_score,
+    'conditional': compute_conditional_score,
+}
+
+
+def get_cmd_line_options():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--num_best", type="int", default=NUM_BEST,
+                      help="The maximum number of correlated videos to "
+                           "emit for each video.  Defaults to %default.")
+    parser.add_option("-s", "--score", type="choice",
+                      choices=sorted(SCORE_FUNCTIONS), default="cosine",
+                      help="The similarity score to rank videos by, one of "
+                           "%s.  Defaults to %%default."
+                           % ", ".join(sorted(SCORE_FUNCTIONS)))
+    options, extra_args = parser.parse_args()
+    if extra_args:
+        parser.error("Unknown arguments %s" % extra_args)
+    if options.num_best < 1:
+        parser.error("--num_best must be at least 1")
+    return options
+
+
+def main(num_best=NUM_BEST, score_function=compute_score):
     last_video = None
-    scored_pairs = []
+    # Only the num_best best pairs of the current video are kept, so memory
+    # use doesn't grow with the number of videos it co-occurs with.
+    best_pairs = []
+    index = 0
 
     for line in _IN:
         if not line:
@@ -94,18 +154,19 @@ def main():
             continue
 
         if last_video != vid1_key:
-            emit_best_pairs(last_video, scored_pairs)
-            scored_pairs = []
+            emit_best_pairs(last_video, best_pairs)
+            best_pairs = []
 
         # TODO(benkomalo): do we have to re-normalize after pruning?
-        score = compute_score(preceed_count, succeed_count,
-                              video1_count, video2_count)
-        scored_pairs.append([vid1_key, vid2_key, score])
+        score = score_function(preceed_count, succeed_count,
+                               video1_count, video2_count)
+        index += 1
+        add_scored_pair(best_pairs, num_best, (score, -index, vid2_key))
         last_video = vid1_key
 
-    emit_best_pairs(last_video, scored_pairs)
+    emit_best_pairs(last_video, best_pairs)
 
 
 if __name__ == '__main__':
-    main()
-
+    options = get_cmd_line_options()
+    main(options.num_best, SCORE_FUNCTIONS[options.score])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Benchmark video_recommendation_pruner.py on a large generated matrix.
+
+The input is test_one_video_paired_with_lots from
+video_recommendation_pruner_test.py scaled up: each of --videos videos is
+paired with --fan_out other videos, the i'th of them watched i times after
+it.  The pruner's output is checked against holding every pair of a video
+and taking heapq.nlargest (as the pruner used to), and the rows/sec of
+both are reported.
+
+Example:
+    video_recommendation_pruner_benchmark.py --videos 20 --fan_out 50000
+"""
+
+import StringIO
+import heapq
+import optparse
+import sys
+import time
+
+import video_recommendation_pruner as pruner
+
+
+def generate_input(num_videos, fan_out):
+    lines = []
+    for v in xrange(num_videos):
+        for i in xrange(1, fan_out + 1):
+            # The counts repeat, so that there are ties for the best pairs.
+            lines.append("vid%s\tothervid%s\t0\t%s\t%s\t1\n"
+                         % (v, i, i % 1000, fan_out))
+    return lines
+
+
+def nlargest_pruner(lines, num_best, score_function):
+    """Return the pruner's output, computed by holding all of each video's
+    pairs and then taking the num_best best.
+
+    """
+    output = []
+    last_video = None
+    scored_pairs = []
+    for line in lines + [None]:
+        if line is None:
+            vid1_key = None
+        else:
+            (vid1_key, vid2_key, preceed_count, succeed_count,
+             video1_count, video2_count) = line.rstrip().split("\t")
+        if last_video != vid1_key and last_video:
+            for (vid1, vid2, score) in heapq.nlargest(
+                    num_best, scored_pairs, key=lambda pair: pair[2]):
+                output.append("\t".join([vid1, vid2, str(score)]) + "\n")
+            scored_pairs = []
+        if line is None:
+            break
+        score = score_function(int(preceed_count), int(succeed_count),
+                               int(video1_count), int(video2_count))
+        scored_pairs.append([vid1_key, vid2_key, score])
+        last_video = vid1_key
+    return "".join(output)
+
+
+def run_pruner(lines, num_best, score_function):
+    orig_in, orig_out = pruner._IN, pruner._OUT
+    pruner._IN = lines
+    pruner._OUT = StringIO.StringIO()
+    try:
+        pruner.main(num_best, score_function)
+        return pruner._OUT.getvalue()
+    finally:
+        pruner._IN, pruner._OUT = orig_in, orig_out
+
+
+def main():
+    parser = optparse.OptionParser(
+        description="Benchmark video_recommendation_pruner.py")
+    parser.add_option("--videos", type="int", default=20,
+                      help="number of videos to prune the pairs of")
+    parser.add_option("--fan_out", type="int", default=50000,
+                      help="number of pairs for each video")
+    parser.add_option("-n", "--num_best", type="int", default=pruner.NUM_BEST)
+    parser.add_option("-s", "--score", type="choice",
+                      choices=sorted(pruner.SCORE_FUNCTIONS),
+                      default="cosine")
+    options, _ = parser.parse_args()
+
+    lines = generate_input(options.videos, options.fan_out)
+    score_function = pruner.SCORE_FUNCTIONS[options.score]
+
+    start = time.time()
+    expected = nlargest_pruner(lines, options.num_best, score_function)
+    nlargest_secs = time.time() - start
+
+    start = time.time()
+    actual = run_pruner(lines, options.num_best, score_function)
+    heap_secs = time.time() - start
+
+    print "%d rows, %d videos" % (len(lines), options.videos)
+    print "all pairs + nlargest: %.0f rows/sec" % (
+        len(lines) / max(nlargest_secs, 1e-9))
+    print "bounded heap:         %.0f rows/sec" % (
+        len(lines) / max(heap_secs, 1e-9))
+
+    if expected != actual:
+        print >> sys.stderr, "MISMATCH between the pruner and nlargest"
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,14 @@ where
     indicator_i is 1 iff the user watched video_i before video_j,
 and indicator_j is 1 iff the user watched video_j before video_i
 
+With --combine, the 4-tuples are instead summed over all the users seen by
+this reducer, and for every pair of videos watched by at least one user,
+(video_i, video_j, count_i, count_j)
+is output, where count_i (count_j) is the sum of indicator_i (indicator_j).
+This output is much smaller, and sums up to the same totals.  At most
+--max_pairs pairs are held in memory; when there are more, the counts so
+far are output, so a pair may be output more than once.
+
 For more information on this project and a higher-level overview of what's
 happening, see:
 https://sites.google.com/a/khanacademy.org/forge/technical/data_n/collaborative-filtering-with-emr
@@ -31,21 +39,42 @@ https://sites.google.com/a/khanacademy.org/forge/technical/data_n/collaborative-
 """
 
 
-import itertools
+import bisect
+import optparse
 import sys
 
 
 _out = sys.stdout  # For testing purposes
 _in = sys.stdin  # For testing purposes
 
+# Default for the most video pairs to hold in memory with --combine.
+_MAX_COMBINED_PAIRS = 2000000
+
+
+def get_cmd_line_options():
+    parser = optparse.OptionParser()
+    parser.add_option("-c", "--combine", action="store_true", default=False,
+                      help="output counts summed over all users, instead of "
+                           "one line per user per pair of videos")
+    parser.add_option("-m", "--max_pairs", type="int",
+                      default=_MAX_COMBINED_PAIRS,
+                      help="with --combine, the most video pairs to hold in "
+                           "memory before outputting their counts")
+    options, _ = parser.parse_args()
+    return options
 
-def output_tab_delimited(s1, s2, i1, i2):
-    """Write given strs and ints to outfile specified above (tab-delimited), 2x
-    (the second time, we change order, as necessary for output to be correct.)
 
+def sort_by_timestamp(videos):
+    """Given a list of tuples of (video, timestamp), return a list of the
+    videos, and a list of their timestamps as floats, sorted by timestamp.
+
+    The sort is stable, so videos with the same timestamp stay in order.
     """
-    _out.write("%s\t%s\t%d\t%d\n" % (s1, s2, i1, i2))
-    _out.write("%s\t%s\t%d\t%d\n" % (s2, s1, i2, i1))
+    timestamped = sorted([(float(timestamp), video)
+                          for (video, timestamp) in videos],
+                         key=lambda timestamped_video: timestamped_video[0])
+    return ([video for (_, video) in timestamped],
+            [timestamp for (timestamp, _) in timestamped])
 
 
 def emit_reducer_output(videos):
@@ -53,15 +82,96 @@ def emit_reducer_output(videos):
     output the 4-tuples for that user, as defined above.
 
     """
-    for (vid_i, vid_j) in itertools.combinations(videos, 2):
-        if float(vid_i[1]) < float(vid_j[1]):
-            i_before_j = 1
-        else:
-            i_before_j = 0
-        output_tab_delimited(vid_i[0], vid_j[0], i_before_j, 1 - i_before_j)
+    if len(videos) <= 1:
+        return
+    (videos, timestamps) = sort_by_timestamp(videos)
+
+    for i, vid_i in enumerate(videos):
+        # Every video after vid_i was watched after it, except for any with
+        # the same timestamp, which count as having been watched before it.
+        same_time_end = bisect.bisect_right(timestamps, timestamps[i], i + 1)
+        lines = []
+        for vid_j in videos[i + 1:same_time_end]:
+            lines.append("%s\t%s\t0\t1\n%s\t%s\t1\t0\n" %
+                         (vid_i, vid_j, vid_j, vid_i))
+        for vid_j in videos[same_time_end:]:
+            lines.append("%s\t%s\t1\t0\n%s\t%s\t0\t1\n" %
+                         (vid_i, vid_j, vid_j, vid_i))
+        _out.write("".join(lines))
+
+
+class CombinedCounts(object):
+    """The 4-tuples of many users, summed (for --combine).
+
+    counts[video_i][video_j] is the number of users who watched video_i
+    before video_j.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.num_pairs = 0
+
+    def add(self, videos):
+        """Given all videos a user watched (list of tuples of (video,
+        timestamp)), add the user's indicators to the counts.
+
+        """
+        if len(videos) <= 1:
+            return
+        (videos, timestamps) = sort_by_timestamp(videos)
+
+        counts = self.counts
+        for i, vid_i in enumerate(videos):
+            same_time_end = bisect.bisect_right(timestamps, timestamps[i],
+                                                i + 1)
+            for vid_j in videos[i + 1:same_time_end]:
+                row = counts.setdefault(vid_j, {})
+                if vid_i not in row:
+                    self.num_pairs += 1
+                row[vid_i] = row.get(vid_i, 0) + 1
+            row = counts.setdefault(vid_i, {})
+            row_len = len(row)
+            for vid_j in videos[same_time_end:]:
+                row[vid_j] = row.get(vid_j, 0) + 1
+            self.num_pairs += len(row) - row_len
+
+    def emit(self):
+        """Output the summed 4-tuples, and reset the counts."""
+        counts = self.counts
+        no_counts = {}
+        for vid_i, row in counts.iteritems():
+            lines = []
+            for vid_j, count_i in row.iteritems():
+                count_j = counts.get(vid_j, no_counts).get(vid_i, 0)
+                if count_j and vid_j < vid_i:
+                    continue  # Output along with counts[vid_j][vid_i]
+                if vid_i == vid_j:
+                    # Both of the user's lines for this pair are the same.
+                    lines.append("%s\t%s\t%d\t%d\n" %
+                                 (vid_i, vid_j, count_i, count_j))
+                    continue
+                lines.append("%s\t%s\t%d\t%d\n%s\t%s\t%d\t%d\n" %
+                             (vid_i, vid_j, count_i, count_j,
+                              vid_j, vid_i, count_j, count_i))
+            _out.write("".join(lines))
+        self.counts = {}
+        self.num_pairs = 0
+
+
+def process_user(videos, combined_counts, max_pairs):
+    """Emit the 4-tuples for a user's videos, or add them to combined_counts
+    (if not None), emitting those once they have max_pairs video pairs.
+
+    """
+    if combined_counts is None:
+        emit_reducer_output(videos)  # If len(videos) <= 1, this is no-op
+    else:
+        combined_counts.add(videos)
+        if combined_counts.num_pairs >= max_pairs:
+            combined_counts.emit()
 
 
-def main():
+def main(combine=False, max_pairs=_MAX_COMBINED_PAIRS):
     """Get the input, aggregate all videos and timestamps for each user,
     and pass that to the function that emits it in correct format.
 
@@ -69,6 +179,7 @@ def main():
     # Initialize so we can use it later
     last_user = None
     videos = []
+    combined_counts = CombinedCounts() if combine else None
 
     for line in _in:
         if not line:
@@ -77,6 +188,8 @@ def main():
         line = line.rstrip().split("\t")
         if len(line) != 3:
             sys.stderr.write("Malformed input: '%s'!\n" % "\t".join(line))
+            if combined_counts:
+                combined_counts.emit()
             return
 
         (user, video, timestamp) = line
@@ -84,11 +197,15 @@ def main():
         if last_user == user:
             videos.append((video, timestamp))
         else:
-            emit_reducer_output(videos)  # If len(videos) <= 1, this is no-op
+            process_user(videos, combined_counts, max_pairs)
             videos = [(video, timestamp)]
         last_user = user
 
-    emit_reducer_output(videos)  # Make sure we emit for the last user
+    # Make sure we emit for the last user
+    process_user(videos, combined_counts, max_pairs)
+    if combined_counts:
+        combined_counts.emit()
 
 if __name__ == '__main__':
-    main()
+    options = get_cmd_line_options()
+    main(options.combine, options.max_pairs)
@@ -31,11 +31,11 @@ class Utils(unittest.TestCase):
         # Clean this up; we don't need it anymore
         INPUT = []
 
-    def run_reducer(self):
+    def run_reducer(self, combine=False):
         global OUTPUT
         """Make reducer use our input, output files, run it, close them."""
 
-        video_recommendation_reducer.main()
+        video_recommendation_reducer.main(combine)
 
         OUTPUT = OUTPUT.getvalue().split("\n")
         if OUTPUT[-1] == "":
@@ -158,5 +158,24 @@ class VideoRecommenderTest(Utils):
 
         self.generic_test(to_write, expected)
 
+    def test_combine(self):
+        """Test that --combine sums the 4-tuples of all users, with ties."""
+        to_write = [("user1", "video1", "1234123.2344"),
+                    ("user1", "video2", "2232134.1245"),
+                    ("user1", "video3", "2232134.1245"),
+                    ("user2", "video1", "5324352.1345"),
+                    ("user2", "video2", "4513431.1234")]
+
+        expected = self.duplicate(
+                   [("video1", "video2", "1", "1"),
+                    ("video1", "video3", "1", "0"),
+                    ("video2", "video3", "0", "1")])
+
+        self.write_input(to_write)
+        self.run_reducer(combine=True)
+        result = self.read_output()
+        self.assertEqual(len(expected), len(result))
+        self.assertEqual(set(expected), set(result))
+
 if __name__ == "__main__":
     unittest.main()
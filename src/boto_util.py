@@ -6,6 +6,10 @@ See https://github.com/boto/boto for detals.
 import os
 
 
+# How much of an S3 key to read at a time in read_lines.
+READ_SIZE = 1024 * 1024
+
+
 def initialize_creds_from_file(creds_filename=None):
     """Sets up environment variables boto relies on for auth keys.
 
@@ -34,3 +38,21 @@ def initialize_creds(access_key_id, secret):
     os.environ['AWS_ACCESS_KEY_ID'] = access_key_id
     os.environ['AWS_SECRET_ACCESS_KEY'] = secret
 
+
+def read_lines(key, read_size=READ_SIZE):
+    """Yield the lines of an S3 key, reading it read_size bytes at a time.
+
+    Unlike key.get_contents_as_string(), this never holds the whole key in
+    memory.  The lines don't include the trailing newline.
+    """
+    partial_line = ''
+    while True:
+        data = key.read(read_size)
+        if not data:
+            break
+        lines = (partial_line + data).split('\n')
+        partial_line = lines.pop()
+        for line in lines:
+            yield line
+    if partial_line:
+        yield partial_line
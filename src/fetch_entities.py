@@ -5,13 +5,17 @@ that property is the "backup_timestamp" property used
 by backup_model.BackupModel.
 """
 
+import collections
 import datetime as dt
+import itertools
 import optparse
+import os
 import pickle
 import sys
 import time
 import urllib
 import urllib2
+from multiprocessing.pool import ThreadPool
 
 import gae_util
 gae_util.fix_sys_path()
@@ -19,6 +23,9 @@ gae_util.fix_sys_path()
 from google.appengine.api import datastore
 from google.appengine.datastore import entity_pb
 
+sys.path.append(os.path.dirname(__file__) + "/../map_reduce/py")
+import load_pbufs_to_hive
+
 import date_util
 import oauth_util.fetch_url
 
@@ -99,27 +106,197 @@ def attempt_fetch_entities(kind,
     return response
 
 
-def download_entities(kind,
-                      is_ndb,
-                      start_dt, end_dt,
-                      fetch_interval_seconds,
-                      max_entities_per_fetch,
-                      max_attempts_per_fetch,
-                      index_name,
-                      verbose=True):
-    """Downloads all entities between start_dt and end_dt  by
-    repeatedly calling attempt_fetch_entities if necessary.  Multiple calls
-    are only necessary if there are more entities in the time interval
-    than max_entities_per_fecth.
+def _split_interval(start_dt, end_dt, time_delta):
+    """Yields consecutive (start, end) pairs of at most time_delta covering
+    [start_dt, end_dt).
+    """
+    while start_dt < end_dt:
+        next_dt = min(start_dt + time_delta, end_dt)
+        yield (start_dt, next_dt)
+        start_dt = next_dt
 
-    WARNING: because the API call returns entities in [start_dt, end_dt),
-    this, function may return some duplicates in its result.  The caller should
-    de-dupe by .key() of the entities if needed.
 
-    Returns a list of Entities in protocol buffer format.
+def _get_index_value(pb, index_name):
+    """Returns the index_name property of a protobuf'ed entity, or None.
+
+    This works for both db and ndb models. To convert protobufs to
+    ndb models you'd need to import the model and use a ndb
+    ModelAdapter. But here we just need access to the
+    backup_timestamp property (index_name), so deserializing the
+    protobuf into the lower-level Entity will suffice.
     """
+    entity = datastore.Entity._FromPb(entity_pb.EntityProto(pb))
+    return entity.get(index_name)
+
+
+def _get_entity_key(pb):
+    """Returns the encoded datastore key of a protobuf'ed entity."""
+    return entity_pb.EntityProto(pb).key().Encode()
+
+
+def _fetch_interval_pages(pool, fetch, start_dt, end_dt, num_pieces,
+                          max_entities_per_fetch, index_name):
+    """Fetches [start_dt, end_dt) as num_pieces concurrent sub-intervals.
+
+    Returns a list of pages (lists of protobufs) in timestamp order.
+    """
+    time_delta = max((end_dt - start_dt) / num_pieces,
+                     dt.timedelta(microseconds=1))
+    intervals = list(_split_interval(start_dt, end_dt, time_delta))
+    pages = []
+    for interval, response_list in zip(intervals, pool.map(fetch, intervals)):
+        pages.extend(_complete_page(pool, fetch, response_list, interval,
+                                    num_pieces, max_entities_per_fetch,
+                                    index_name))
+    return pages
+
+
+def _drop_seen_entities(pages, seen_keys, timestamp, index_name):
+    """Removes the entities stamped timestamp whose keys are in seen_keys
+    from the start of pages, in place, adding the keys of the rest.
+
+    This relies on the pages being in timestamp order, so only the leading
+    entities stamped timestamp are looked at.
+    """
+    for i, page in enumerate(pages):
+        kept = []
+        for j, pb in enumerate(page):
+            if _get_index_value(pb, index_name) != timestamp:
+                pages[i] = kept + page[j:]
+                return
+            key = _get_entity_key(pb)
+            if key not in seen_keys:
+                seen_keys.add(key)
+                kept.append(pb)
+        pages[i] = kept
+
+
+def _complete_page(pool, fetch, response_list, interval, num_pieces,
+                   max_entities_per_fetch, index_name):
+    """Returns [response_list] followed by the pages for the rest of its
+    sub-interval, if response_list hit the max_entities_per_fetch cap.
+
+    Like download_entity_pages, this relies on the API call returning
+    protobufs in sorted order: the rest of the sub-interval starts at the
+    timestamp of the last entity received, and is itself split into
+    num_pieces and fetched concurrently.  Entities sharing that timestamp
+    are returned by both calls, so they are de-duped by key.  Raises an
+    exception if all of response_list shares the timestamp of the start
+    of the sub-interval, as there is then no way to fetch the rest.
+    """
+    pages = [response_list]
+    if len(response_list) != max_entities_per_fetch:
+        return pages
+
+    interval_start, interval_end = interval
+    last_dt = _get_index_value(response_list[-1], index_name)
+    if last_dt is None or last_dt >= interval_end:
+        return pages
+    if last_dt <= interval_start:
+        raise Exception("At least %s entities have %s %s, so they can't be "
+                        "fetched %s at a time" % (max_entities_per_fetch,
+                                                  index_name, last_dt,
+                                                  max_entities_per_fetch))
+
+    rest = _fetch_interval_pages(pool, fetch, last_dt, interval_end,
+                                 num_pieces, max_entities_per_fetch,
+                                 index_name)
+    seen_keys = set()
+    for pb in reversed(response_list):
+        if _get_index_value(pb, index_name) != last_dt:
+            break
+        seen_keys.add(_get_entity_key(pb))
+    _drop_seen_entities(rest, seen_keys, last_dt, index_name)
+    pages.extend(rest)
+    return pages
+
+
+def _download_entity_pages_concurrently(kind,
+                                        is_ndb,
+                                        start_dt, end_dt,
+                                        fetch_interval_seconds,
+                                        max_entities_per_fetch,
+                                        max_attempts_per_fetch,
+                                        index_name,
+                                        verbose,
+                                        num_threads):
+    """The num_threads > 1 implementation of download_entity_pages.
+
+    Sub-intervals of fetch_interval_seconds are fetched by a pool of
+    num_threads threads, keeping at most num_threads requests in flight
+    ahead of the page being yielded.  Only sub-intervals that hit the
+    max_entities_per_fetch cap are re-split and fetched again.
+    """
+    def fetch(interval):
+        response = attempt_fetch_entities(kind,
+                                          is_ndb,
+                                          interval[0], interval[1],
+                                          max_entities_per_fetch,
+                                          max_attempts_per_fetch,
+                                          index_name,
+                                          verbose)
+        return pickle.loads(response)
+
+    pool = ThreadPool(num_threads)
+    try:
+        intervals = _split_interval(
+            start_dt, end_dt, dt.timedelta(seconds=fetch_interval_seconds))
+        pending = collections.deque()
+        for interval in itertools.islice(intervals, num_threads):
+            pending.append((interval, pool.apply_async(fetch, (interval,))))
+
+        while pending:
+            interval, result = pending.popleft()
+            response_list = result.get()
+            for next_interval in itertools.islice(intervals, 1):
+                pending.append(
+                    (next_interval, pool.apply_async(fetch,
+                                                     (next_interval,))))
+
+            for page in _complete_page(pool, fetch, response_list,
+                                       interval, num_threads,
+                                       max_entities_per_fetch, index_name):
+                yield page
+    finally:
+        pool.terminate()
+
+
+def download_entity_pages(kind,
+                          is_ndb,
+                          start_dt, end_dt,
+                          fetch_interval_seconds,
+                          max_entities_per_fetch,
+                          max_attempts_per_fetch,
+                          index_name,
+                          verbose=True,
+                          num_threads=1):
+    """Downloads all entities between start_dt and end_dt by
+    repeatedly calling attempt_fetch_entities if necessary, yielding the
+    result of each call as soon as it is fetched.
+
+    This is the streaming counterpart of download_entities: callers that
+    process or write out each page before asking for the next one only
+    ever hold max_entities_per_fetch entities in memory, regardless of
+    how many entities are in [start_dt, end_dt).
+
+    If num_threads is greater than 1, up to num_threads sub-intervals are
+    fetched concurrently.  Pages are still yielded in timestamp order, at
+    most about num_threads pages are held in memory at once, and entities
+    at the boundary of a page that hit the max_entities_per_fetch cap are
+    de-duped by key.  Otherwise, the same duplicate caveat as
+    download_entities applies: an entity may show up both at the end of
+    one page and at the start of the next.
+
+    Yields lists of Entities in protocol buffer format.
+    """
+    if num_threads > 1:
+        for page in _download_entity_pages_concurrently(
+                kind, is_ndb, start_dt, end_dt, fetch_interval_seconds,
+                max_entities_per_fetch, max_attempts_per_fetch, index_name,
+                verbose, num_threads):
+            yield page
+        return
 
-    entity_list = []
     interval_start = start_dt
     time_delta = dt.timedelta(seconds=fetch_interval_seconds)
     while interval_start < end_dt:
@@ -132,24 +309,58 @@ def download_entities(kind,
                                           index_name,
                                           verbose)
         response_list = pickle.loads(response)
-        entity_list += response_list
+        # Drop our reference to the raw response before the caller gets
+        # to work on the page so it can be garbage collected.
+        del response
 
         if len(response_list) == max_entities_per_fetch:
             # if we maxed out the number of entities for the fetch, there
             # might still be more so query again from the last timestamp
             # WARNING: this depends on the implementation of the API call
             # returning the protobuffs in sorted order
-            #
-            # This works for both db and ndb models. To convert protobufs to
-            # ndb models you'd need to import the model and use a ndb
-            # ModelAdapter. But here we just need access to the
-            # backup_timestamp property (index_name), so deserializing the
-            # protobuf into the lower-level Entity will suffice.
-            pb = response_list[-1]
-            entity = datastore.Entity._FromPb(entity_pb.EntityProto(pb))
-            if index_name in entity:
-                interval_end = entity[index_name]
+            last_dt = _get_index_value(response_list[-1], index_name)
+            if last_dt is not None:
+                interval_end = last_dt
         interval_start = interval_end
+        yield response_list
+
+
+def download_entities(kind,
+                      is_ndb,
+                      start_dt, end_dt,
+                      fetch_interval_seconds,
+                      max_entities_per_fetch,
+                      max_attempts_per_fetch,
+                      index_name,
+                      verbose=True,
+                      num_threads=1):
+    """Downloads all entities between start_dt and end_dt  by
+    repeatedly calling attempt_fetch_entities if necessary.  Multiple calls
+    are only necessary if there are more entities in the time interval
+    than max_entities_per_fecth.
+
+    WARNING: because the API call returns entities in [start_dt, end_dt),
+    this, function may return some duplicates in its result.  The caller should
+    de-dupe by .key() of the entities if needed.  (See download_entity_pages
+    for the num_threads > 1 behavior.)
+
+    This holds every entity in the time range in memory; use
+    download_entity_pages to process large ranges a page at a time.
+
+    Returns a list of Entities in protocol buffer format.
+    """
+
+    entity_list = []
+    for response_list in download_entity_pages(kind,
+                                               is_ndb,
+                                               start_dt, end_dt,
+                                               fetch_interval_seconds,
+                                               max_entities_per_fetch,
+                                               max_attempts_per_fetch,
+                                               index_name,
+                                               verbose,
+                                               num_threads):
+        entity_list += response_list
     return entity_list
 
 
@@ -175,8 +386,15 @@ def get_cmd_line_args():
     parser.add_option("-r", "--max_retries", default=8,
         help="Maximum # of retries for request attempts before failing. "
              "Defaults to 8.")
+    parser.add_option("-j", "--threads", default=1,
+        help="Number of intervals to fetch concurrently. Defaults to 1.")
     parser.add_option("-o", "--output_file",
         help="Name of the file to output.")
+    parser.add_option("-f", "--format", default="pickle",
+        choices=["pickle", "length_prefixed"],
+        help="Output a pickled list of protobufs (the default), or "
+             "length-prefixed protobufs, which are written as they are "
+             "fetched and can be streamed into load_pbufs_to_hive.py.")
     parser.add_option("-t", "--type",
         help="Entity type to back up")
     parser.add_option("-n", "--ndb", help="Entity is an NDB model",
@@ -190,7 +408,10 @@ def get_cmd_line_args():
         print >> sys.stderr, 'Please specify an entity type to back up'
         exit(1)
     if not options.output_file:
-        options.output_file = options.type + ".pickle"
+        if options.format == "length_prefixed":
+            options.output_file = options.type + ".pbs"
+        else:
+            options.output_file = options.type + ".pickle"
 
     return options
 
@@ -200,19 +421,36 @@ def main():
     end_dt = date_util.from_date_iso(options.end_date)
     start_dt = date_util.from_date_iso(options.start_date)
 
-    entity_list = download_entities(options.type,
-                                    options.is_ndb,
-                                    start_dt, end_dt,
-                                    int(options.interval),
-                                    int(options.max_logs),
-                                    int(options.max_retries),
-                                    options.key)
-
-    with open(options.output_file, 'wb') as f:
-        pickle.dump(entity_list, f)
+    if options.format == "length_prefixed":
+        num_entities = 0
+        with open(options.output_file, 'wb') as f:
+            for entity_list in download_entity_pages(
+                    options.type,
+                    options.is_ndb,
+                    start_dt, end_dt,
+                    int(options.interval),
+                    int(options.max_logs),
+                    int(options.max_retries),
+                    options.key,
+                    num_threads=int(options.threads)):
+                load_pbufs_to_hive.write_length_prefixed(f, entity_list)
+                num_entities += len(entity_list)
+    else:
+        entity_list = download_entities(options.type,
+                                        options.is_ndb,
+                                        start_dt, end_dt,
+                                        int(options.interval),
+                                        int(options.max_logs),
+                                        int(options.max_retries),
+                                        options.key,
+                                        num_threads=int(options.threads))
+
+        with open(options.output_file, 'wb') as f:
+            pickle.dump(entity_list, f)
+        num_entities = len(entity_list)
 
     print >> sys.stderr, ("Downloaded and wrote %d entities.  Exiting." %
-                          len(entity_list))
+                          num_entities)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import datetime
+import pickle
+import unittest
+
+import fetch_entities
+
+
+class TestDownloadEntityPagesConcurrently(unittest.TestCase):
+    """Fetches (timestamp, key) tuples standing in for protobufs from a
+    fake API, which returns them in timestamp order, up to a maximum."""
+
+    def setUp(self):
+        self.entities = []
+        self.orig_attempt_fetch_entities = (
+            fetch_entities.attempt_fetch_entities)
+        self.orig_get_index_value = fetch_entities._get_index_value
+        self.orig_get_entity_key = fetch_entities._get_entity_key
+        fetch_entities.attempt_fetch_entities = self.fake_fetch
+        fetch_entities._get_index_value = lambda pb, index_name: pb[0]
+        fetch_entities._get_entity_key = lambda pb: pb[1]
+
+    def tearDown(self):
+        fetch_entities.attempt_fetch_entities = (
+            self.orig_attempt_fetch_entities)
+        fetch_entities._get_index_value = self.orig_get_index_value
+        fetch_entities._get_entity_key = self.orig_get_entity_key
+
+    def fake_fetch(self, kind, is_ndb, start_dt, end_dt, max_logs,
+                   max_attempts, index_name, verbose=True):
+        entities = sorted(e for e in self.entities
+                          if start_dt <= e[0] < end_dt)
+        return pickle.dumps(entities[:max_logs])
+
+    def download(self, max_entities_per_fetch):
+        start = datetime.datetime(2012, 6, 17)
+        pages = fetch_entities.download_entity_pages(
+            'Foo', False, start, start + datetime.timedelta(hours=1),
+            1200, max_entities_per_fetch, 1, 'backup_timestamp',
+            verbose=False, num_threads=3)
+        return [pb for page in pages for pb in page]
+
+    def add_entities(self, minutes, num_entities):
+        timestamp = (datetime.datetime(2012, 6, 17) +
+                     datetime.timedelta(minutes=minutes))
+        for _ in range(num_entities):
+            self.entities.append((timestamp, len(self.entities)))
+
+    def test_resplit_and_dedup(self):
+        # Pages capped at 4 entities end in the middle of these runs of
+        # entities sharing a timestamp, including in sub-intervals which
+        # are themselves re-split.
+        for minutes in range(0, 60, 3):
+            self.add_entities(minutes, 3)
+        self.add_entities(5, 3)
+        self.add_entities(7, 1)
+        self.assertEquals(self.download(4), sorted(self.entities))
+
+    def test_too_many_entities_at_one_time(self):
+        self.add_entities(1, 1)
+        self.add_entities(5, 4)
+        self.assertRaisesRegexp(Exception, "can't be fetched 4 at a time",
+                                self.download, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
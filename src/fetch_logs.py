@@ -8,7 +8,8 @@ method is more reliable than using the appengine bulk-download tool to
 get logs.
 
 The KA api returns zlib-compressed logs.  We uncompress them and stream
-to stdout.
+to stdout.  With --parallelism N, N time windows are fetched at once, but
+the logs are still written to stdout in time order.
 
 WARNING: AppEngine does not keep logs for all time -- if the
 end_time_t is too long ago, then AppEngine will return empty results.
@@ -17,11 +18,14 @@ This value is probably relative to the number of logs present, so will
 get smaller as time goes on.  You should run this script frequently.
 """
 
+import collections
 import datetime
+import itertools
 import optparse
 import sys
 import time
 import zlib
+from multiprocessing.pool import ThreadPool
 
 import date_util
 import oauth_util.fetch_url
@@ -29,6 +33,9 @@ import oauth_util.fetch_url
 
 LOGS_URL = '/api/v1/fetch_logs/%(start_time_t)s/%(end_time_t)s'
 
+# How much of a compressed response to decompress at a time.
+_DECOMPRESS_CHUNK_SIZE = 256 * 1024
+
 
 def _read_versions(filename):
     """Look for lines 'appengine_versions: v1,v2,...'; return set(v1,v2,...)"""
@@ -85,6 +92,29 @@ def _split_into_headers_and_body(loglines_string):
             loglines_string[pos_after_header_blankline + 2:])
 
 
+def _decompress_lines(compressed):
+    """Decompress a zlib-compressed string into a list of strings.
+
+    Each string ends at a line boundary (except perhaps the last).  The
+    output is built up piece by piece, so unlike zlib.decompress, the
+    decompressed logs are never copied into one big string.
+    """
+    decompressor = zlib.decompressobj()
+    pieces = []
+    partial_line = ''
+    for pos in xrange(0, len(compressed), _DECOMPRESS_CHUNK_SIZE):
+        data = partial_line + decompressor.decompress(
+            buffer(compressed, pos, _DECOMPRESS_CHUNK_SIZE))
+        end = data.rfind('\n') + 1
+        if end:
+            pieces.append(data[:end])
+        partial_line = data[end:]
+    partial_line += decompressor.flush()
+    if partial_line:
+        pieces.append(partial_line)
+    return pieces
+
+
 def _num_requests_in_logs(body):
     """Given a collection of log-lines, return the number of user requests."""
     # We look for text that's likely only in actual loglines, not in
@@ -120,6 +150,10 @@ def get_cmd_line_args():
     parser.add_option("-r", "--max_retries", default=8,
                       help=("Maximum # of retries for request attempts "
                             "before failing. Defaults to 8."))
+    parser.add_option("-p", "--parallelism", type="int", default=1,
+                      help=("Number of time intervals to fetch at once. "
+                            "Logs are still output in time order. "
+                            "Defaults to 1."))
     parser.add_option("-v", "--appengine_version", default=None,
                       help=("If set, the appengine-version (e.g. "
                             "0515-ae96fc55243b) to request the logs from. "
@@ -160,37 +194,101 @@ def fetch_appengine_logs(start_time, end_time, appengine_versions):
         appengine-version in the list.  If appengine can't find any
         logs in that time period corresponding to that version, we'll
         try the next version in the list.  If none of them ever give
-        any output, we return the empty string.  If appengine_versions
-        is the empty list, we just try once, telling appengine to use
-        the current default (live) appengine version.
+        any output, we return no headers and no log lines.  If
+        appengine_versions is the empty list, we just try once, telling
+        appengine to use the current default (live) appengine version.
 
     Returns:
-      A string, the output of the /api/v1/fetch_logs/x/x?... command.
+      The output of the /api/v1/fetch_logs/x/x?... command, decompressed
+      and split as a pair: a string of the header lines, and a list of
+      strings that together are the log lines (see _decompress_lines).
     """
     start_time_t = int(time.mktime(start_time.timetuple()))
     end_time_t = int(time.mktime(end_time.timetuple()))
     url_base = LOGS_URL % {'start_time_t': start_time_t,
                            'end_time_t': end_time_t}
 
-    if not appengine_versions:
-        return oauth_util.fetch_url.fetch_url(url_base)
-
+    appengine_versions = list(appengine_versions) or [None]
     for (i, appengine_version) in enumerate(appengine_versions):
         if appengine_version is None:    # None means 'use the default'
             url = url_base
         else:
             url = url_base + '?appengine_version=%s' % appengine_version
         compressed_retval = oauth_util.fetch_url.fetch_url(url)
-        retval = zlib.decompress(compressed_retval)
-        (_, loglines_as_string) = _split_into_headers_and_body(retval)
-        if loglines_as_string:
-            return retval
+        pieces = _decompress_lines(compressed_retval)
+        del compressed_retval
+        # The headers are far shorter than the first piece, so we only
+        # have to look for them there.
+        if pieces:
+            (headers, pieces[0]) = _split_into_headers_and_body(pieces[0])
+            if not pieces[0]:
+                del pieces[0]
+        if pieces:
+            return (headers, pieces)
+
+        sys.stderr.write('No logs for version %s, trying version %s\n'
+                         % (appengine_version or '[default]',
+                            (appengine_versions + ['<giving up>'])[i + 1]))
+
+    return ('', [])      # We never found a non-empty body, so just bail.
+
+
+def fetch_window(start_dt, end_dt, appengine_versions, max_retries):
+    """Fetch the logs from [start_dt, end_dt), retrying on errors.
 
-        print >>sys.stderr, ('No logs for version %s, trying version %s'
-                             % (appengine_version or '[default]',
-                                (appengine_versions + ['<giving up>'])[i + 1]))
+    Returns the (headers, body pieces) from fetch_appengine_logs, or None
+    if every one of the max_retries attempts failed.
+    """
+    # Each message is written with a single write, since with
+    # --parallelism several windows may be logging at once.
+    sys.stderr.write('[%s] Fetching logs from [%s, %s)...\n' % (
+        datetime.datetime.now(), start_dt, end_dt))
 
-    return ''      # We never found a non-empty body, so just bail.
+    for tries in xrange(max_retries):
+        try:
+            return fetch_appengine_logs(start_dt, end_dt, appengine_versions)
+        except Exception, why:
+            sleep_secs = 2 ** tries
+            sys.stderr.write('ERROR fetching logs from [%s, %s): %s.\n'
+                             'Retrying in %s seconds...\n'
+                             % (start_dt, end_dt, why, sleep_secs))
+            time.sleep(sleep_secs)
+    return None
+
+
+def fetch_windows(windows, appengine_versions, max_retries, parallelism=1):
+    """Yield (start_dt, end_dt, fetch_window result) for each window.
+
+    windows is a list of (start_dt, end_dt) pairs.  With parallelism > 1,
+    that many windows are fetched at once by a pool of threads, so a
+    window that is backing off after an error doesn't hold up the fetches
+    of the windows after it.  Results are always yielded in the order of
+    windows, and at most 2 * parallelism of them are held in memory.
+    """
+    if parallelism <= 1:
+        for (start_dt, end_dt) in windows:
+            yield (start_dt, end_dt, fetch_window(
+                start_dt, end_dt, appengine_versions, max_retries))
+        return
+
+    pool = ThreadPool(parallelism)
+    try:
+        windows = iter(windows)
+        pending = collections.deque()
+        for (start_dt, end_dt) in itertools.islice(windows, 2 * parallelism):
+            pending.append((start_dt, end_dt, pool.apply_async(
+                fetch_window,
+                (start_dt, end_dt, appengine_versions, max_retries))))
+        while pending:
+            (start_dt, end_dt, result) = pending.popleft()
+            for (next_start_dt, next_end_dt) in itertools.islice(windows, 1):
+                pending.append((next_start_dt, next_end_dt, pool.apply_async(
+                    fetch_window, (next_start_dt, next_end_dt,
+                                   appengine_versions, max_retries))))
+            yield (start_dt, end_dt, result.get())
+        pool.close()
+    finally:
+        pool.terminate()
 
 
 def main():
@@ -219,41 +317,36 @@ def main():
     print >>sys.stderr, ('Looking at these appengine versions: %s'
                          % [v or '(default)' for v in appengine_versions])
 
-    num_errors = 0
+    windows = []
     while start_dt < end_dt:
         next_dt = min(start_dt + datetime.timedelta(seconds=interval), end_dt)
+        windows.append((start_dt, next_dt))
+        start_dt = next_dt
 
-        print >>sys.stderr, '[%s] Fetching logs from [%s, %s)...' % (
-            datetime.datetime.now(), start_dt, next_dt)
-
-        for tries in xrange(max_retries):
-            try:
-                response = fetch_appengine_logs(start_dt, next_dt,
-                                                appengine_versions)
-            except Exception, why:
-                sleep_secs = 2 ** tries
-                print >>sys.stderr, ('ERROR: %s.\n'
-                                     'Retrying in %s seconds...'
-                                     % (why, sleep_secs))
-                time.sleep(sleep_secs)
-            else:
-                # The 'header' portion of the response goes into the
-                # fetch-log.  The rest goes into the actual logs.
-                (headers, body) = _split_into_headers_and_body(response)
-                sys.stderr.write(headers)
-                # It's nice to give a brief summary of what the logs are like.
-                print >>sys.stderr, ('%s request lines found'
-                                     % _num_requests_in_logs(body))
-                if not body:
-                    print >>sys.stderr, 'WARNING: No logs found'
-                print body,
-                break
-        else:  # for/else: if we get here, we never succeeded in fetching
+    num_errors = 0
+    for (start_dt, next_dt, response) in fetch_windows(
+            windows, appengine_versions, max_retries, options.parallelism):
+        if response is None:  # we never succeeded in fetching
             num_errors += 1
-            print >>sys.stderr, ('SKIPPING logs from %s to %s: error fetching.'
-                                 % (start_dt, next_dt))
-
-        start_dt = next_dt
+            sys.stderr.write('SKIPPING logs from %s to %s: error fetching.\n'
+                             % (start_dt, next_dt))
+            continue
+
+        # The 'header' portion of the response goes into the
+        # fetch-log.  The rest goes into the actual logs.
+        (headers, body_pieces) = response
+        status = 'Logs from [%s, %s):\n%s' % (start_dt, next_dt, headers)
+        # It's nice to give a brief summary of what the logs are like.
+        status += ('%s request lines found\n'
+                   % sum(_num_requests_in_logs(piece)
+                         for piece in body_pieces))
+        if not body_pieces:
+            status += 'WARNING: No logs found\n'
+        sys.stderr.write(status)
+        for piece in body_pieces:
+            sys.stdout.write(piece)
+
+    return num_errors
 
 
 if __name__ == '__main__':
@@ -10,21 +10,34 @@ TODO(yunfang): adding a controldb in mongo to coordinate the fetch and
                db load of gae data
 """
 
+import collections
 import datetime as dt
+import gzip
+import heapq
 import json
+import multiprocessing
 import os
 import pickle
+import Queue
 import re
-import subprocess
 import sys
 import time
 
 from optparse import OptionParser
-from multiprocessing import active_children
 from multiprocessing import Process
 
 import pymongo
 
+# Optional, faster compression codecs for the archives.
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 import gae_util
 gae_util.fix_sys_path()
 
@@ -40,14 +53,25 @@ import ka_download_coordinator as kdc
 
 DEFAULT_DOWNLOAD_SETTINGS = {
     "max_threads": 4,  # max number of parrellel threads
+    "fetch_threads": 1,  # concurrent fetches within each download process
     "max_tries": 8,  # max number of tries to download entities
     "interval": 120,  # data accumulated before writing into mongodb
     "sub_process_time_out": 1800,  # sub process timeout in seconds
+    "max_chunk_retries": 2,  # times to re-run a chunk that failed/timed out
     "max_logs": 1000,  # max number of entities from gae foreach pbuf call
     "dbhost": "localhost",
     "dbport": 28017,
     "default_db": "testdb",  # dbname to write to
-    "archive_dir": "archive"
+    "archive_dir": "archive",
+    "archive_codec": "gzip",  # one of ARCHIVE_CODEC_EXTENSIONS
+    "archive_compression_level": 6
+}
+
+# Compression codecs for the archives, and their file extensions.
+ARCHIVE_CODEC_EXTENSIONS = {
+    "gzip": "gz",
+    "lz4": "lz4",
+    "zstd": "zst",
 }
 
 g_logger = get_logger()
@@ -69,6 +93,9 @@ def get_cmd_line_args():
              "override the value in the JSON config if specified.")
     parser.add_option("-p", "--proc_interval", default=3600,
         help="process interval if no start_date end_date specified")
+    parser.add_option("-r", "--resume", action="store_true", default=False,
+        help="Skip chunks the download control db has recorded as saved, "
+             "and retry any unfinished chunks it has in the date range.")
 
     options, _ = parser.parse_args()
     if not options.config:
@@ -96,6 +123,126 @@ def get_archive_file_name(config, kind, start_dt, end_dt, ftype='pickle'):
     return filename
 
 
+class PickledListWriter(object):
+    """Writes a pickled list to a file one batch of items at a time.
+
+    The resulting file unpickles (with pickle.load) to a single list, exactly
+    as if the whole list had been handed to pickle.dump, but only the batch
+    currently being written is ever referenced by the writer.
+
+    The stream only unpickles once close() has written its STOP opcode, so
+    callers should discard the file if writing it fails partway (as
+    ArchiveWriter does).
+    """
+
+    def __init__(self, f, protocol=pickle.HIGHEST_PROTOCOL):
+        self._f = f
+        self._pickler = pickle.Pickler(f, protocol)
+        if protocol >= 2:
+            f.write(pickle.PROTO + chr(protocol))
+        f.write(pickle.EMPTY_LIST)
+
+    def extend(self, items):
+        """Append a batch of items to the pickled list."""
+        if not items:
+            return
+        self._f.write(pickle.MARK)
+        for item in items:
+            self._pickler.save(item)
+        self._f.write(pickle.APPENDS)
+        # The memo holds a reference to everything pickled so far.  Nothing
+        # in later batches refers back to earlier ones, so it is safe to
+        # drop it and keep memory bounded by a single batch.
+        self._pickler.clear_memo()
+
+    def close(self):
+        """Terminate the pickle stream.  Does not close the file."""
+        self._f.write(pickle.STOP)
+
+
+def get_archive_codec(config):
+    """Return the configured archive codec, or gzip if it's unavailable."""
+    codec = config['archive_codec']
+    if codec not in ARCHIVE_CODEC_EXTENSIONS:
+        raise ValueError("Unknown archive_codec: %s" % codec)
+    if ((codec == 'lz4' and lz4 is None) or
+            (codec == 'zstd' and zstandard is None)):
+        g_logger.warning("%s is not installed, using gzip instead" % codec)
+        codec = 'gzip'
+    return codec
+
+
+def open_archive_file(filename, codec, level):
+    """Open filename for writing, compressing as it's written."""
+    if codec == 'lz4':
+        return lz4.frame.open(filename, 'wb', compression_level=level)
+    elif codec == 'zstd':
+        return zstandard.open(filename, 'wb',
+                              cctx=zstandard.ZstdCompressor(level=level))
+    return gzip.GzipFile(filename, 'wb', compresslevel=level)
+
+
+class ArchiveWriter(object):
+    """Writes the compressed pickle and json archives of a chunk in one pass.
+
+    Usage:
+        with ArchiveWriter(config, kind, start_dt, end_dt) as archive:
+            for entity_list in entity_pages:
+                archive.write(entity_list)
+
+    The pickle archive holds a single list of all the protobufs written,
+    and the json archive holds a "<json key>\t<json>" line per entity.
+    Both are written to "<filename>.tmp" and only renamed into place if
+    the with block completes; otherwise the partial files are removed.
+    """
+
+    def __init__(self, config, kind, start_dt, end_dt):
+        codec = get_archive_codec(config)
+        level = int(config['archive_compression_level'])
+        ext = ARCHIVE_CODEC_EXTENSIONS[codec]
+        self.pickle_filename = get_archive_file_name(config, kind,
+            start_dt, end_dt, 'pickle.' + ext)
+        self.json_filename = get_archive_file_name(config, kind,
+            start_dt, end_dt, 'json.' + ext)
+        self.num_rows = 0
+        self._json_key = config['kinds'][kind][4]
+        self._pickle_f = open_archive_file(self.pickle_filename + '.tmp',
+                                           codec, level)
+        self._json_f = open_archive_file(self.json_filename + '.tmp',
+                                         codec, level)
+        self._pickle_writer = PickledListWriter(self._pickle_f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._pickle_writer.close()
+            self._pickle_f.close()
+            self._json_f.close()
+        except:
+            exc_type = sys.exc_info()[0]
+            raise
+        finally:
+            for filename in (self.pickle_filename, self.json_filename):
+                if exc_type is None:
+                    os.rename(filename + '.tmp', filename)
+                elif os.path.exists(filename + '.tmp'):
+                    os.unlink(filename + '.tmp')
+
+    def write(self, entity_list):
+        """Append a page of protobufs to both archives."""
+        self._pickle_writer.extend(entity_list)
+        lines = []
+        for pb in entity_list:
+            doc = load_pbufs_to_hive.fast_pb_to_dict(pb)
+            json_str = json.dumps(doc)
+            lines.append("%s\t%s\n" % (doc[self._json_key], json_str))
+        self._json_f.write(''.join(lines))
+        self.num_rows += len(entity_list)
+
+
 def fetch_and_process_data(kind, start_dt_arg, end_dt_arg,
     fetch_interval, config):
     """Main function: fetching data and load it to mongodb."""
@@ -103,54 +250,34 @@ def fetch_and_process_data(kind, start_dt_arg, end_dt_arg,
     kdc.record_progress(mongo, config['coordinator_cfg'],
         kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.STARTED)
 
-    # fetch
+    # fetch, a page at a time, writing each page to the compressed pickle
+    # and json archives before fetching the next one so that we never hold
+    # the whole interval in memory.
+    # TODO(yunfang): revisit if we should save the pickled pb
     g_logger.info("Downloading data for %s from %s to %s starts" % (
         kind, start_dt_arg, end_dt_arg))
     is_ndb = bool(config['kinds'][kind][3])
-    entity_list = fetch_entities.download_entities(
-                      kind,
-                      is_ndb,
-                      start_dt_arg, end_dt_arg,
-                      fetch_interval,
-                      config['max_logs'], config['max_tries'],
-                      "backup_timestamp",  # TODO(jace): make configurable
-                      verbose=False)
+    entity_pages = fetch_entities.download_entity_pages(
+                       kind,
+                       is_ndb,
+                       start_dt_arg, end_dt_arg,
+                       fetch_interval,
+                       config['max_logs'], config['max_tries'],
+                       "backup_timestamp",  # TODO(jace): make configurable
+                       verbose=False,
+                       num_threads=int(config['fetch_threads']))
+    with ArchiveWriter(config, kind, start_dt_arg, end_dt_arg) as archive:
+        for entity_list in entity_pages:
+            archive.write(entity_list)
+    num_rows = archive.num_rows
     g_logger.info(
         "Data downloaded for %s from %s to %s.# rows: %d finishes" % (
-            kind, start_dt_arg, end_dt_arg, len(entity_list)))
+            kind, start_dt_arg, end_dt_arg, num_rows))
     kdc.record_progress(mongo, config['coordinator_cfg'],
         kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.FETCHED)
 
-    # save to a file
-    # TODO(yunfang): revisit if we should save the pickled pb
-    archived_file = get_archive_file_name(config, kind,
-        start_dt_arg, end_dt_arg, 'pickle')
-    with open(archived_file, 'wb') as f:
-        pickle.dump(entity_list, f)
-    ret = subprocess.call(["gzip", "-f", archived_file])
-    if ret == 0:
-        g_logger.info("%s rows saved to %s.gz" % (len(entity_list),
-            archived_file))
-    else:
-        g_logger.error("Cannot gzip %s" % (archived_file))
-
-    #jsonize the entities
-    json_filename = get_archive_file_name(config, kind,
-        start_dt_arg, end_dt_arg, 'json')
-    json_key = config['kinds'][kind][4]
-    f = open(json_filename, 'wb')
-    for pb in entity_list:
-        doc = load_pbufs_to_hive.pb_to_dict(pb)
-        json_str = json.dumps(doc)
-        print >>f, "%s\t%s" % (doc[json_key], json_str)
-    f.close()
-    ret = subprocess.call(["gzip", "-f", json_filename])
-    if ret == 0:
-        g_logger.info("%s rows saved to %s.gz" % (len(entity_list),
-            json_filename))
-    else:
-        g_logger.error("Cannot gzip %s" % (json_filename))
-
+    g_logger.info("%s rows saved to %s and %s" % (num_rows,
+        archive.pickle_filename, archive.json_filename))
     kdc.record_progress(mongo, config['coordinator_cfg'],
         kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.SAVED)
 
@@ -158,6 +285,8 @@ def fetch_and_process_data(kind, start_dt_arg, end_dt_arg,
     kdc.record_progress(mongo, config['coordinator_cfg'],
         kind, start_dt_arg, end_dt_arg, kdc.DownloadStatus.LOADED)
 
+    return num_rows
+
 
 def open_db_conn(config):
     """Get a mongodb connection (and reuse it)"""
@@ -167,53 +296,197 @@ def open_db_conn(config):
     return func(config)
 
 
-def monitor(config, processes):
-    """Monitor the concurrent processes"""
-    remaining = []
-    now = time.time()
-    for (process, params) in processes:
-        if process.is_alive():
-            if (now - params['start']) > int(config["sub_process_time_out"]):
-                #timeout
-                process.terminate()
-                #NOTE: Although it get terminated. The duration should be
-                # re-scheduled with the upcoming control-db implementation.
-                g_logger.error(
-                    "Process hung with kind: %s start_dt: %s end_dt: %s" % (
-                    params["kind"], params["start_dt"], params["end_dt"]))
-            else:
-                remaining.append((process, params))
-    processes = remaining
-
-
-def start_data_process(config, start_dt_arg, end_dt_arg):
-    """Loop through the entity types and perform the main function """
-    g_logger.info("Start processing data from %s to %s" %
-                  (str(start_dt_arg), str(end_dt_arg)))
+def download_worker(config, worker_id, task_queue, result_queue):
+    """Worker process loop: download chunks from task_queue until None.
 
-    processes = []
+    For each (kind, start_dt, end_dt) chunk, puts
+    (worker_id, chunk, num_rows, elapsed_secs) on result_queue, with
+    num_rows None if the chunk failed.
+    """
+    for chunk in iter(task_queue.get, None):
+        kind, start_dt, end_dt = chunk
+        fetch_interval = config['kinds'][kind][1]
+        start = time.time()
+        try:
+            num_rows = fetch_and_process_data(kind, start_dt, end_dt,
+                                              fetch_interval, config)
+        except Exception:
+            g_logger.exception(
+                "Download failed with kind: %s start_dt: %s end_dt: %s" % (
+                kind, start_dt, end_dt))
+            num_rows = None
+        result_queue.put((worker_id, chunk, num_rows, time.time() - start))
+
+
+class DownloadWorker(object):
+    """A persistent download process, fed one chunk at a time."""
+
+    def __init__(self, config, worker_id, result_queue):
+        self.task_queue = multiprocessing.Queue()
+        self.process = Process(target=download_worker,
+            args=(config, worker_id, self.task_queue, result_queue))
+        self.process.start()
+        self.entry = None  # the queue entry of the chunk being downloaded
+        self.started = None
+
+    def assign(self, entry):
+        self.entry = entry
+        self.started = time.time()
+        self.task_queue.put(get_chunk(entry))
+
+    def finish(self):
+        entry = self.entry
+        self.entry = None
+        self.started = None
+        return entry
+
+    def stop(self):
+        self.task_queue.put(None)
+
+
+def get_chunk(entry):
+    """Return the (kind, start_dt, end_dt) chunk of a download queue entry."""
+    return entry[2:]
+
+
+def get_download_chunks(config, start_dt_arg, end_dt_arg):
+    """Split [start_dt_arg, end_dt_arg) into (kind, start_dt, end_dt) chunks
+    of each kind's save interval.
+    """
+    chunks = []
     for kind, fetch_intervals in config['kinds'].iteritems():
         interval = dt.timedelta(seconds=int(fetch_intervals[0]))
-        fetch_interval = fetch_intervals[1]
         start_dt = start_dt_arg
-        end_dt = end_dt_arg
-        while start_dt < end_dt:
-            if len(active_children()) < config['max_threads']:
-                next_dt = min(start_dt + interval, end_dt)
-                p = Process(target=fetch_and_process_data,
-                    args=(kind, start_dt, next_dt, fetch_interval, config))
-                p.start()
-                download_params = {"kind": kind, "start_dt": start_dt,
-                                   "end_dt": end_dt, "start": time.time()}
-                processes.append((p, download_params))
-                start_dt = next_dt
-            else:
-                monitor(config, processes)
-            #wait for 2 secs to space out the queries
-            time.sleep(2)
-    while len(active_children()) > 0:
-        monitor(config, processes)
-        time.sleep(10)
+        while start_dt < end_dt_arg:
+            next_dt = min(start_dt + interval, end_dt_arg)
+            chunks.append((kind, start_dt, next_dt))
+            start_dt = next_dt
+    return chunks
+
+
+def run_download_chunks(config, chunks):
+    """Download chunks with a pool of config['max_threads'] processes.
+
+    Chunks are kept in a priority queue ordered by deadline (the end of the
+    chunk's time range), so the oldest data is always downloaded first.
+    A chunk that fails, or whose worker runs for longer than
+    sub_process_time_out, is put back on the queue (with its original
+    deadline) up to max_chunk_retries times; a timed out worker is
+    terminated and replaced.  Per-kind throughput is logged at the end.
+    """
+    time_out = int(config['sub_process_time_out'])
+    max_retries = int(config['max_chunk_retries'])
+
+    # entries are (deadline, attempt, kind, start_dt, end_dt)
+    queue = [(end_dt, 0, kind, start_dt, end_dt)
+             for (kind, start_dt, end_dt) in chunks]
+    heapq.heapify(queue)
+
+    result_queue = multiprocessing.Queue()
+    num_workers = min(int(config['max_threads']), len(queue))
+    workers = [DownloadWorker(config, i, result_queue)
+               for i in range(num_workers)]
+
+    stats = collections.defaultdict(lambda: {'chunks': 0, 'rows': 0,
+                                             'secs': 0.0, 'failures': 0})
+
+    def retry(entry, reason):
+        deadline, attempt, kind, start_dt, end_dt = entry
+        stats[kind]['failures'] += 1
+        if attempt < max_retries:
+            g_logger.error("Download %s with kind: %s start_dt: %s "
+                "end_dt: %s. Retrying." % (reason, kind, start_dt, end_dt))
+            heapq.heappush(queue,
+                (deadline, attempt + 1, kind, start_dt, end_dt))
+        else:
+            g_logger.error("Download %s with kind: %s start_dt: %s "
+                "end_dt: %s. Giving up after %d attempts." % (
+                reason, kind, start_dt, end_dt, attempt + 1))
+
+    while queue or any(w.entry for w in workers):
+        for worker in workers:
+            if worker.entry is None and queue:
+                worker.assign(heapq.heappop(queue))
+
+        try:
+            worker_id, chunk, num_rows, secs = result_queue.get(timeout=5)
+        except Queue.Empty:
+            pass
+        else:
+            worker = workers[worker_id]
+            # Ignore late results from a worker we already gave up on.
+            if worker.entry and get_chunk(worker.entry) == chunk:
+                entry = worker.finish()
+                if num_rows is None:
+                    retry(entry, "failed")
+                else:
+                    kind_stats = stats[chunk[0]]
+                    kind_stats['chunks'] += 1
+                    kind_stats['rows'] += num_rows
+                    kind_stats['secs'] += secs
+
+        now = time.time()
+        for i, worker in enumerate(workers):
+            if worker.entry is None:
+                continue
+            timed_out = (now - worker.started) > time_out
+            if timed_out or not worker.process.is_alive():
+                worker.process.terminate()
+                retry(worker.finish(), "hung" if timed_out else "died")
+                workers[i] = DownloadWorker(config, i, result_queue)
+
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.process.join()
+
+    for kind, kind_stats in sorted(stats.iteritems()):
+        g_logger.info("%s: %d rows in %d chunks (%d failed attempts), "
+            "%.1f rows/sec" % (kind, kind_stats['rows'], kind_stats['chunks'],
+            kind_stats['failures'],
+            kind_stats['rows'] / max(kind_stats['secs'], 1e-3)))
+
+
+def get_resumed_chunks(config, chunks, start_dt_arg, end_dt_arg):
+    """Filter chunks against the progress recorded in the download control
+    db, to resume an interrupted download.
+
+    Chunks already SAVED are dropped and every other chunk is kept.
+    Unfinished (STARTED/FETCHED) records whose boundaries don't line up
+    with the current chunks (e.g. if a save interval in the config has
+    changed since) are not re-enqueued: any part of them still missing
+    falls inside a current chunk that isn't SAVED, and adding them back
+    would archive the same rows twice.
+    """
+    mongo = open_db_conn(config)
+    progress = kdc.get_progress(mongo, config['coordinator_cfg'],
+                                start_dt_arg, end_dt_arg)
+    statuses = {}
+    for doc in progress:
+        statuses[doc['_id']] = doc['status']
+
+    resumed = []
+    num_saved = 0
+    for (kind, start_dt, end_dt) in chunks:
+        if statuses.get(kdc.get_key(kind, start_dt, end_dt),
+                        kdc.DownloadStatus.NONE) >= kdc.DownloadStatus.SAVED:
+            num_saved += 1
+        else:
+            resumed.append((kind, start_dt, end_dt))
+
+    g_logger.info("Resuming: skipping %d saved chunks, %d chunks to go" % (
+        num_saved, len(resumed)))
+    return resumed
+
+
+def start_data_process(config, start_dt_arg, end_dt_arg, resume=False):
+    """Loop through the entity types and perform the main function """
+    g_logger.info("Start processing data from %s to %s" %
+                  (str(start_dt_arg), str(end_dt_arg)))
+    chunks = get_download_chunks(config, start_dt_arg, end_dt_arg)
+    if resume:
+        chunks = get_resumed_chunks(config, chunks, start_dt_arg, end_dt_arg)
+    run_download_chunks(config, chunks)
 
 
 def main():
@@ -234,7 +507,7 @@ def main():
     if options.archive_dir:
         # Override the archive directory, if specified.
         config['archive_dir'] = options.archive_dir
-    start_data_process(config, start_dt, end_dt)
+    start_data_process(config, start_dt, end_dt, options.resume)
 
 
 if __name__ == '__main__':
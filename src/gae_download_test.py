@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import datetime
+import gzip
+import os
+import pickle
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import gae_download
+import ka_download_coordinator as kdc
+
+
+class TestPickledListWriter(unittest.TestCase):
+    def assertRoundTrips(self, pages, protocol):
+        f = StringIO.StringIO()
+        writer = gae_download.PickledListWriter(f, protocol)
+        for page in pages:
+            writer.extend(page)
+        writer.close()
+
+        expected = StringIO.StringIO()
+        pickle.dump([item for page in pages for item in page], expected,
+                    protocol)
+        self.assertEquals(pickle.loads(f.getvalue()),
+                          pickle.loads(expected.getvalue()))
+
+    def test_round_trip(self):
+        pages_list = [
+            [],
+            [[]],
+            [[1, 'a', {'key': (1, 2)}]],
+            [[1, 2], [], ['a', u'b', 3.5, None], [{'key': [1]}] * 3],
+        ]
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            for pages in pages_list:
+                self.assertRoundTrips(pages, protocol)
+
+
+class TestArchiveWriter(unittest.TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.config = {'archive_dir': self.archive_dir,
+                       'archive_codec': 'gzip',
+                       'archive_compression_level': 6,
+                       'kinds': {'Foo': [3600, 3600, 1, 0, 'key']}}
+        self.start = datetime.datetime(2012, 6, 17)
+        self.end = datetime.datetime(2012, 6, 18)
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def archived_files(self):
+        return sorted(filename
+                      for (_, _, filenames) in os.walk(self.archive_dir)
+                      for filename in filenames)
+
+    def test_success(self):
+        with gae_download.ArchiveWriter(self.config, 'Foo', self.start,
+                                        self.end) as archive:
+            archive.write([])
+        self.assertEquals(self.archived_files(), sorted(
+            [os.path.basename(archive.json_filename),
+             os.path.basename(archive.pickle_filename)]))
+        f = gzip.open(archive.pickle_filename)
+        self.assertEquals(pickle.load(f), [])
+        f.close()
+
+    def test_failure(self):
+        try:
+            with gae_download.ArchiveWriter(self.config, 'Foo', self.start,
+                                            self.end):
+                raise IOError("fetch failed")
+        except IOError:
+            pass
+        self.assertEquals(self.archived_files(), [])
+
+
+class TestGetResumedChunks(unittest.TestCase):
+    def setUp(self):
+        self.progress = []
+        self.orig_open_db_conn = gae_download.open_db_conn
+        self.orig_get_progress = kdc.get_progress
+        gae_download.open_db_conn = lambda config: None
+        kdc.get_progress = lambda mongo, config, start_dt, end_dt: (
+            self.progress)
+
+    def tearDown(self):
+        gae_download.open_db_conn = self.orig_open_db_conn
+        kdc.get_progress = self.orig_get_progress
+
+    def add_progress(self, kind, start_dt, end_dt, status):
+        self.progress.append({'_id': kdc.get_key(kind, start_dt, end_dt),
+                              'kind': kind, 'start_dt': start_dt,
+                              'end_dt': end_dt, 'status': status})
+
+    def test_resume(self):
+        hour = datetime.timedelta(hours=1)
+        start = datetime.datetime(2012, 6, 17)
+        end = start + 4 * hour
+        config = {'kinds': {'Foo': [3600]}, 'coordinator_cfg': {}}
+        chunks = gae_download.get_download_chunks(config, start, end)
+
+        self.add_progress('Foo', start, start + hour,
+                          kdc.DownloadStatus.SAVED)
+        self.add_progress('Foo', start + hour, start + 2 * hour,
+                          kdc.DownloadStatus.LOADED)
+        self.add_progress('Foo', start + 2 * hour, start + 3 * hour,
+                          kdc.DownloadStatus.FETCHED)
+        # Recorded with an older, longer save interval: the chunks it
+        # overlaps are SAVED, so it must not be downloaded again.
+        self.add_progress('Foo', start, start + 2 * hour,
+                          kdc.DownloadStatus.STARTED)
+
+        resumed = gae_download.get_resumed_chunks(config, chunks, start, end)
+        self.assertEquals(resumed,
+                          [('Foo', start + 2 * hour, start + 3 * hour),
+                           ('Foo', start + 3 * hour, end)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,18 +15,49 @@ Example uses:
   # Returns the column names and types for a table
   $ ./hive_mysql_connector.py --ssh_keyfile ~/.ssh/analytics.pem \
          table_columns <table_name>
+
+  # Returns the locations and columns of several tables, in one query
+  $ ./hive_mysql_connector.py ka-hive tables_info <table_name> ...
+
+All the SSH commands of a process share one SSH connection, and the
+locations and columns of tables are cached, in memory and on disk (in a
+file under ~/.cache readable only by the user), for cache_ttl seconds.
 """
 
+import atexit
+import json
 import optparse
+import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+
+# How long to cache table info, and to keep the SSH connection open after
+# it was last used, in seconds.
+DEFAULT_CACHE_TTL = 15 * 60
+CONTROL_PERSIST_SECS = 5 * 60
 
+_CACHE_FILENAME = os.path.join(os.path.expanduser('~'), '.cache',
+                               'hive_mysql_connector_cache.json')
+_CONTROL_PATH = os.path.join(tempfile.gettempdir(),
+                             'hive-mysql-%d-%%r@%%h:%%p' % os.getpid())
 
 _hive_hostname = None
 _ssh_keyfile = None
+_cache_ttl = DEFAULT_CACHE_TTL
+_ssh_used = False
 
+# Maps a table name to (time fetched, location, columns), for
+# _hive_hostname.  None until it is loaded from _CACHE_FILENAME.
+_table_info = None
+_lock = threading.Lock()
 
-def configure(hive_hostname, ssh_keyfile=None):
+
+def configure(hive_hostname, ssh_keyfile=None,
+              cache_ttl=DEFAULT_CACHE_TTL):
     """Configures the connection to the Hive masternode for the MySQL queries.
     
     Arguments:
@@ -34,10 +65,16 @@ def configure(hive_hostname, ssh_keyfile=None):
         ssh_keyfile - the location of the SSH key to use. If unspecified, will
             not provide a key location in the SSH command (and will rely on
             $HOME/.ssh/config to have the proper information for the host)
+        cache_ttl - the number of seconds to cache table info for, or 0 to
+            always query the masternode.
     """
-    global _hive_hostname, _ssh_keyfile
-    _hive_hostname = hive_hostname
-    _ssh_keyfile = ssh_keyfile
+    global _hive_hostname, _ssh_keyfile, _cache_ttl, _table_info
+    with _lock:
+        if hive_hostname != _hive_hostname:
+            _table_info = None
+        _hive_hostname = hive_hostname
+        _ssh_keyfile = ssh_keyfile
+        _cache_ttl = cache_ttl
 
     
 def is_configured():
@@ -49,6 +86,36 @@ def _popen_results(args):
     return proc.communicate()[0]
 
 
+def _ssh_command():
+    """Returns the command to run a command on the Hive masternode.
+
+    The first command opens a master SSH connection, which later commands
+    reuse, and which is closed on exit.
+    """
+    global _ssh_used
+    _ssh_used = True
+    base_command = ['ssh', _hive_hostname,
+                    '-o', 'ControlMaster=auto',
+                    '-o', 'ControlPath=%s' % _CONTROL_PATH,
+                    '-o', 'ControlPersist=%d' % CONTROL_PERSIST_SECS]
+    if _ssh_keyfile:
+        base_command = base_command + ['-i', _ssh_keyfile]
+    return base_command
+
+
+def close():
+    """Closes the master SSH connection, if it is open."""
+    if not _ssh_used:
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['ssh', _hive_hostname, '-O', 'exit',
+                         '-o', 'ControlPath=%s' % _CONTROL_PATH],
+                        stdout=devnull, stderr=devnull)
+
+
+atexit.register(close)
+
+
 def _run_mysql_query_over_ssh(query):
     """Runs the MySQL query over SSH.
     Note that query will be wrapped in single quotes, so it must be semi-sane.
@@ -57,16 +124,10 @@ def _run_mysql_query_over_ssh(query):
     if not is_configured():
         raise Exception("Connection to Hive master not configured yet.")
     
-    global _hive_hostname, _ssh_keyfile
-
-    base_command = ['ssh', _hive_hostname]
-    if _ssh_keyfile:
-        base_command = base_command + ['-i', _ssh_keyfile]
-
     # Encase the query in quotes.
     query = "'%s'" % query
-    raw_results = _popen_results(base_command + ['sudo', 'mysql', 'hive_081',
-                                                 '-e', query])
+    raw_results = _popen_results(_ssh_command() + ['sudo', 'mysql', 'hive_081',
+                                                   '-e', query])
     if not raw_results:
         return []
     
@@ -78,21 +139,116 @@ def _run_mysql_query_over_ssh(query):
     return [tuple(row.strip().split("\t")) for row in raw_results[1:] if row]
 
 
+def _read_cache_file():
+    """Returns the contents of the cache file, a dict mapping masternodes
+    to their table info.
+
+    The file is ignored if it's owned by another user, who could
+    otherwise redirect the table locations read.
+    """
+    try:
+        with open(_CACHE_FILENAME) as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return {}
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _load_cache():
+    """Returns the table info cached on disk for _hive_hostname."""
+    cache = _read_cache_file()
+    return dict((table_name, (fetched, location, map(tuple, columns)))
+                for (table_name, (fetched, location, columns))
+                in cache.get(_hive_hostname, {}).iteritems())
+
+
+def _save_cache():
+    """Writes _table_info to disk, keeping that of other masternodes.
+
+    The cache is only an optimization, so failing to write it is ignored.
+    """
+    cache = _read_cache_file()
+    cache[_hive_hostname] = _table_info
+    cache_dir = os.path.dirname(_CACHE_FILENAME)
+    tmp_filename = None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        # Write a new file (mkstemp creates it with mode 0600) and rename
+        # it, so other processes never read a partial file.
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=cache_dir, prefix=os.path.basename(_CACHE_FILENAME))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_filename, _CACHE_FILENAME)
+    except (IOError, OSError):
+        if tmp_filename and os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+
+
+def clear_cache():
+    """Forgets the cached table info for the Hive masternode."""
+    global _table_info
+    with _lock:
+        _table_info = {}
+        if _cache_ttl:
+            _save_cache()
+
+
+def get_tables_info(table_names, refresh=False):
+    """Returns a dict of the location and columns of each table found.
+
+    The values are (location, columns) tuples, as returned by
+    get_table_location and get_table_columns.  Tables not cached, or all
+    of them if refresh is True, are looked up in a single query.
+    """
+    global _table_info
+    with _lock:
+        if _table_info is None:
+            _table_info = _load_cache() if _cache_ttl else {}
+        now = time.time()
+        missing = [table_name for table_name in set(table_names)
+                   if refresh or table_name not in _table_info
+                   or now - _table_info[table_name][0] >= _cache_ttl]
+
+    if missing:
+        query = """
+            SELECT t.TBL_NAME, meta.LOCATION,
+                   c.COLUMN_NAME, c.TYPE_NAME, c.COMMENT
+            FROM TBLS t
+            INNER JOIN SDS meta
+            ON t.SD_ID = meta.SD_ID
+            LEFT OUTER JOIN COLUMNS_V2 c
+            ON meta.CD_ID = c.CD_ID
+            WHERE t.TBL_NAME IN (%s)
+            ORDER BY t.TBL_NAME, c.INTEGER_IDX;
+            """ % ', '.join('"%s"' % table_name for table_name in missing)
+        fetched = {}
+        for row in _run_mysql_query_over_ssh(query):
+            # Trailing empty fields are stripped off of the row.
+            row += ('',) * (5 - len(row))
+            (table_name, location, column) = row[0], row[1], row[2:]
+            columns = fetched.setdefault(table_name, (location, []))[1]
+            if column[0] != 'NULL':
+                columns.append(column)
+        with _lock:
+            for (table_name, (location, columns)) in fetched.iteritems():
+                _table_info[table_name] = (now, location, columns)
+            if fetched and _cache_ttl:
+                _save_cache()
+
+    with _lock:
+        return dict((table_name, _table_info[table_name][1:])
+                    for table_name in table_names
+                    if table_name in _table_info)
+
+
 def get_table_location(table_name):
     """Returns a single string for the table location, or None if not found."""
-    args = {
-        'table_name': table_name
-    }
-    query = """
-        SELECT meta.LOCATION
-        FROM TBLS t
-        INNER JOIN SDS meta
-        ON t.SD_ID = meta.SD_ID
-        WHERE t.TBL_NAME = "%(table_name)s";
-        """ % args
-    results = _run_mysql_query_over_ssh(query)
-    if results:
-        return results[0][0]
+    info = get_tables_info([table_name]).get(table_name)
+    if info:
+        return info[0]
 
 
 def get_table_columns(table_name):
@@ -100,18 +256,10 @@ def get_table_columns(table_name):
     Each tuple has the info on a column in (name, type, comment) format, where
     each item is a string and comment may be string "NULL"
     """
-    args = {
-        'table_name': table_name
-    }
-    query = """
-        SELECT c.COLUMN_NAME, c.TYPE_NAME, c.COMMENT
-        FROM COLUMNS_V2 c
-        LEFT OUTER JOIN TBLS t
-        ON t.TBL_ID = c.CD_ID
-        WHERE t.TBL_NAME = "%(table_name)s"
-        ORDER BY c.INTEGER_IDX;
-        """ % args
-    return _run_mysql_query_over_ssh(query)
+    info = get_tables_info([table_name]).get(table_name)
+    if info:
+        return list(info[1])
+    return []
 
 
 def run_hive_init(remote_command=None):
@@ -124,16 +272,15 @@ def run_hive_init(remote_command=None):
             '-d INPATH=s3://ka-mapreduce/entity_store '
             '-f s3://ka-mapreduce/code/hive/ka_hive_init.q')
 
-    base_command = ['ssh', _hive_hostname]
-    if _ssh_keyfile:
-        base_command += ['-i', _ssh_keyfile]
-    
-    subprocess.call(base_command + [remote_command])
+    subprocess.call(_ssh_command() + [remote_command])
+    # The init may have changed the tables.
+    clear_cache()
 
 
 command_map = {
     'table_location': get_table_location,
     'table_columns': get_table_columns,
+    'tables_info': lambda *table_names: get_tables_info(table_names),
 }
 
 
@@ -157,12 +304,14 @@ if __name__ == '__main__':
     parser.add_option('--ssh_keyfile',
         help='A location of an SSH pem file to use for SSH connections ' +
              'to the specified Hive machine')
+    parser.add_option('--cache_ttl', type='int', default=DEFAULT_CACHE_TTL,
+        help='Seconds to cache table info for, or 0 to not use the cache')
 
     options, args = parser.parse_args()
     if len(args) < 2:
         print >> sys.stderr, USAGE
         sys.exit(-1)
 
-    configure(args[0], options.ssh_keyfile)
+    configure(args[0], options.ssh_keyfile, options.cache_ttl)
     run_command(args[1], args[2:])
     
@@ -1,6 +1,8 @@
 """Library to monitor and coordinate the loading of datastore entities from GAE.
 The record_progress() function records the GAE download progress.
 The get_failed_jobs() function gets the failed download tasks for reprocessing.
+The get_progress() function gets the download status of a time range, so an
+interrupted download can be resumed.
 """
 import datetime as dt
 import re
@@ -28,6 +30,18 @@ def get_failed_jobs(mongo, config):
     return func(mongo, config)
 
 
+def get_progress(mongo, config, start_dt, end_dt):
+    """Get the progress records of all chunks within [start_dt, end_dt)."""
+    def _get_progress(mongo, config, start_dt, end_dt):
+        mongo_db = mongo[config['control_db']]
+        mongo_collection = mongo_db['ProgressLogs']
+        query = {"start_dt": {"$gte": start_dt}, "end_dt": {"$lte": end_dt}}
+        fields = ["kind", "start_dt", "end_dt", "status"]
+        return list(mongo_collection.find(query, fields=fields))
+    func = db_decorator(5, _get_progress)
+    return func(mongo, config, start_dt, end_dt)
+
+
 def get_key(kind, start_dt, end_dt):
     key = "%s%s%s" % (kind, start_dt, end_dt)
     return re.sub(r'[^a-zA-Z0-9]', '', key)
@@ -54,13 +68,11 @@ def record_progress(mongo, config, kind, start_dt, end_dt, status):
         key = get_key(kind, start_dt, end_dt)
         mongo_db = mongo[config['control_db']]
         mongo_collection = mongo_db['ProgressLogs']
-        db_doc = mongo_collection.find_one(key)
-        history = {}
-        if db_doc and 'history' in db_doc:
-            history = db_doc['history']
-        history[str(status)] = dt.datetime.now()
-        doc = {'_id': key, 'kind': kind, 'start_dt': start_dt,
-               'end_dt': end_dt, 'status': status, 'history': history}
-        mongo_collection.save(doc)
+        # A single upsert, which adds this status to the history of any
+        # existing doc without having to read it first.
+        update = {'$set': {'kind': kind, 'start_dt': start_dt,
+                           'end_dt': end_dt, 'status': status,
+                           'history.%s' % status: dt.datetime.now()}}
+        mongo_collection.update({'_id': key}, update, upsert=True)
     func = db_decorator(max_tries=5, func=_record_progress)
     func(mongo, config, kind, start_dt, end_dt, status)
@@ -1,13 +1,25 @@
 """This script trains, and then emits features generated using,
 a multidimensional item response theory model.
+
+The responses of all users are packed into flat arrays, and the likelihood
+and its gradient are computed a minibatch of users at a time.  The couplings
+and abilities being trained are kept in shared memory, which the worker
+processes see without them being pickled for every task.
+
+The parsed responses are cached next to the source file, and memory mapped
+by later runs on the same file.  The model (and the abilities of the users)
+are checkpointed every --checkpoint_every epochs, and a run with --resume
+continues from the latest checkpoint.
 """
 
+import ctypes
 import multiprocessing
 from multiprocessing import Pool
 import fileinput
+import json
 import numpy as np
-from collections import defaultdict
 import optparse
+import os
 import sys
 import time
 import scipy
@@ -22,49 +34,53 @@ import accuracy_model_util as acc_util
 # the maximum number of exercises that might exist
 MAX_EXERCISES = 10000
 
+# The packed responses of all users (see read_responses), and the
+# couplings and abilities being trained, in shared memory (see
+# shared_array).  The worker processes inherit these when the pool is
+# created, so they are set up before that.
+_training_data = {}
+
 # used to index the fields in with a line of text in the input data file
 linesplit = acc_util.linesplit
 idx_pl = acc_util.FieldIndexer(acc_util.FieldIndexer.plog_fields)
 
 
-# current_ind and generate_exercise_ind are used in the creation of a
-# defaultdict for mapping exercise names to an unique integer index
-current_ind = 0
-
-
-def generate_exercise_ind():
-    """Assign the next available index to an exercise name."""
-    global current_ind
-    current_ind += 1
-    return current_ind - 1
-
+def sample_abilities_shard(args):
+    """Sample the ability vectors of the users in [start, end), from the
+    posterior over user ability conditioned on the observed exercise
+    performance.  use Metropolis-Hastings with Gaussian proposal
+    distribution.
 
-def sample_abilities_diffusion(args):
-    """Sample the ability vector for this user, from the posterior over user
-    ability conditioned on the observed exercise performance.
-    use Metropolis-Hastings with Gaussian proposal distribution.
-
-    This is just a wrapper around the corresponding function in mirt_util.
+    The new abilities are written to the shared abilities array, and the
+    sum of the users' energies is returned.  The sampling for each user is
+    done by the corresponding function in mirt_util.
     """
+    user_range, num_steps = args
+    start, end = user_range
 
-    # make sure each student gets a different random sequence
+    # make sure each shard gets a different random sequence
+    seed = int(time.time() * 1e9) % (2 ** 32)
     id = multiprocessing.current_process()._identity
     if len(id) > 0:
-        np.random.seed([id[0], time.time() * 1e9])
+        np.random.seed([id[0], start, seed])
     else:
-        np.random.seed([time.time() * 1e9])
-
-    couplings, state, options, user_index = args
-    abilities = state['abilities']
-    correct = state['correct']
-    exercises_ind = state['exercises_ind']
-
-    num_steps = options.sampling_num_steps
-
-    abilities, Eabilities, _, _ = mirt_util.sample_abilities_diffusion(
-            couplings, exercises_ind, correct, abilities, num_steps)
-
-    return abilities, Eabilities, user_index
+        np.random.seed([start, seed])
+
+    user_offsets = _training_data['user_offsets']
+    couplings = _training_data['couplings']
+    shared_abilities = _training_data['abilities']
+    E_sum = 0.
+    for ind in range(start, end):
+        first, last = user_offsets[ind], user_offsets[ind + 1]
+        abilities, Eabilities, _, _ = mirt_util.sample_abilities_diffusion(
+                couplings,
+                _training_data['exercises_ind'][first:last],
+                _training_data['correct'][first:last],
+                shared_abilities[ind].reshape((-1, 1)),
+                num_steps)
+        shared_abilities[ind] = abilities[:, 0]
+        E_sum += Eabilities
+    return E_sum
 
 
 def get_cmd_line_options():
@@ -92,85 +108,266 @@ def get_cmd_line_options():
     # The number of processes to use to parallelize this.  Set this to 0 to
     # use one process, and make debugging easier.
     parser.add_option("-w", "--workers", type=int, default=6)
+    # The number of users whose likelihood and gradient are computed at a
+    # time, in a single task.
+    parser.add_option("-b", "--minibatch_size", type=int, default=1000)
+    # The number of shards of users to sample the abilities of, per worker.
+    # Each shard is sampled in a single task, on every epoch.
+    parser.add_option("--shards_per_worker", type=int, default=4)
     # the source data file
     parser.add_option("-f", "--file", type=str,
             default='user_assessment.responses')
+    # the directory to cache the parsed source data in, which defaults to
+    # the source data file with .cache appended.  Set this to 'none' to not
+    # cache the data.
+    parser.add_option("-c", "--cache", type=str, default='')
     # the root filename for output
     parser.add_option("-o", "--output", type=str, default='')
+    # The number of epochs between saving the model.  The model after the
+    # last epoch is always saved.
+    parser.add_option("-k", "--checkpoint_every", type=int, default=10)
+    # Continue training from the latest saved epoch, instead of from scratch.
+    parser.add_option("-r", "--resume", action="store_true", default=False)
     options, _ = parser.parse_args()
 
     if options.output == '':
         # default filename
         options.output = "mirt_file=%s_abilities=%d" % (
                 options.file, options.num_abilities)
+    if options.cache == '':
+        options.cache = options.file + '.cache'
+    if options.file == '-' or options.cache == 'none':
+        options.cache = None
+    if options.checkpoint_every < 1:
+        parser.error("--checkpoint_every must be at least 1")
 
     return options
 
 
-def create_user_state(lines, exercise_ind_dict, options):
-    """Create a dictionary to hold training information for a single user."""
-    correct = np.asarray([line[idx_pl.correct] for line in lines]
-            ).astype(int)
-    exercises = [line[idx_pl.exercise] for line in lines]
-    exercises_ind = [exercise_ind_dict[ex] for ex in exercises]
-    exercises_ind = np.array(exercises_ind)
-    abilities = np.random.randn(options.num_abilities, 1)
-    state = {'correct': correct,
-             'abilities': abilities,
-             'exercises_ind': exercises_ind}
-    return state
+def read_responses(filename):
+    """Read the problem logs of all users, packed into flat arrays.
+
+    Returns (exercises_ind, correct, user_offsets, exercise_ind_dict), where
+    the responses of user i are exercises_ind[user_offsets[i]:
+    user_offsets[i + 1]], and the same range of correct, and
+    exercise_ind_dict maps exercise names to their index.
+    """
+    exercise_ind_dict = {}
+    exercises_ind = []
+    correct = []
+    user_offsets = [0]
+    prev_user = None
+
+    for line in fileinput.input(filename):
+        # split on either tab or \x01 so the code works via Hive or pipe
+        row = linesplit.split(line.strip())
+        # the user and timestamp are shared by all row types.
+        # load the user
+        user = row[idx_pl.user]
+        if user != prev_user and len(correct) > user_offsets[-1]:
+            # We're getting a new user, so end our previous user
+            user_offsets.append(len(correct))
+        prev_user = user
+        if row[idx_pl.rowtype] == 'problemlog':
+            exercises_ind.append(exercise_ind_dict.setdefault(
+                    row[idx_pl.exercise], len(exercise_ind_dict)))
+            correct.append(row[idx_pl.correct] == 'true')
+
+    if len(correct) > user_offsets[-1]:
+        # end the final user, too
+        user_offsets.append(len(correct))
+
+    fileinput.close()
+
+    return (np.array(exercises_ind, dtype=int), np.array(correct, dtype=int),
+            np.array(user_offsets, dtype=int), exercise_ind_dict)
+
+
+def load_responses(filename, cache_dir):
+    """Return read_responses(filename), using the cache in cache_dir.
+
+    If the cache was made from the current filename, the arrays are memory
+    mapped from it.  Otherwise the file is read, and the cache made.
+    """
+    if cache_dir is None:
+        return read_responses(filename)
+
+    stat = os.stat(filename)
+    source = {'filename': os.path.abspath(filename),
+              'size': stat.st_size,
+              'mtime': stat.st_mtime}
+    names = ('exercises_ind', 'correct', 'user_offsets')
+    index_filename = os.path.join(cache_dir, 'exercise_ind_dict.json')
+
+    try:
+        with open(index_filename) as f:
+            index = json.load(f)
+        if index['source'] == source:
+            print >>sys.stderr, "loading data from %s" % cache_dir
+            arrays = [np.load(os.path.join(cache_dir, name + '.npy'),
+                              mmap_mode='r')
+                      for name in names]
+            return tuple(arrays) + (index['exercise_ind_dict'],)
+    except (IOError, ValueError, KeyError):
+        pass
+
+    responses = read_responses(filename)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for name, array in zip(names, responses):
+        np.save(os.path.join(cache_dir, name + '.npy'), array)
+    # the index is written last, so that it is only there if the arrays are
+    with open(index_filename + '.tmp', 'w') as f:
+        json.dump({'source': source, 'exercise_ind_dict': responses[3]}, f)
+    os.rename(index_filename + '.tmp', index_filename)
+
+    return responses
+
+
+def replicate_responses(exercises_ind, correct, user_offsets, num_replicas):
+    """Return the packed responses repeated for num_replicas copies of each
+    user, as (exercises_ind, correct, user_offsets)."""
+    if num_replicas == 1:
+        return exercises_ind, correct, user_offsets
+    num_responses = user_offsets[-1]
+    return (np.tile(exercises_ind, num_replicas),
+            np.tile(correct, num_replicas),
+            np.concatenate([user_offsets[:-1] + replica * num_responses
+                            for replica in range(num_replicas)] +
+                           [[num_replicas * num_responses]]))
+
+
+def checkpoint_filename(output, epoch, extension='npz'):
+    return "%s_epoch=%d.%s" % (output, epoch, extension)
+
+
+def find_latest_checkpoint(output):
+    """Return the last epoch saved with the output filename root, or None."""
+    dirname, prefix = os.path.split(output)
+    prefix += '_epoch='
+    epochs = [name[len(prefix):-len('.npz')]
+              for name in os.listdir(dirname or '.')
+              if name.startswith(prefix) and name.endswith('.npz')]
+    epochs = [int(epoch) for epoch in epochs if epoch.isdigit()]
+    return max(epochs) if epochs else None
+
+
+def save_checkpoint(output, epoch, couplings, abilities, exercise_ind_dict):
+    """Save the model, and the abilities of the users, after an epoch."""
+    exercise_names = sorted(exercise_ind_dict, key=exercise_ind_dict.get)
+
+    # save state as a .npz.  It is written under another name first, so
+    # that a crash while writing it doesn't leave a partial checkpoint.
+    filename = checkpoint_filename(output, epoch)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f,
+                 couplings=couplings,
+                 exercise_ind_dict=dict(exercise_ind_dict),
+                 exercise_names=np.array(exercise_names),
+                 abilities=abilities)
+    os.rename(filename + '.tmp', filename)
+
+    # save state as .csv - just for easy debugging inspection
+    f1 = open(checkpoint_filename(output, epoch, 'csv'), 'w+')
+    tt = [(couplings[exercise_ind_dict[nm], :-1],
+            couplings[exercise_ind_dict[nm], -1], nm)
+            for nm in exercise_ind_dict.keys()]
+    tt = sorted(tt, key=lambda tl: tl[1])
+    print >>f1, 'bias, ',
+    for ii in range(tt[0][0].shape[0]):
+        print >>f1, "coupling %d, " % ii,
+    print >>f1, 'exercise name'
+    for t in tt:
+        print >>f1, t[1], ',',
+        for ii in range(tt[0][0].shape[0]):
+            print >>f1, t[0][ii], ',',
+        print >>f1, t[2]
+    f1.close()
 
 
-def L_dL_singleuser(arg):
+def load_checkpoint(output, epoch, couplings, abilities, exercise_ind_dict):
+    """Load the model and abilities saved after epoch into the arrays."""
+    checkpoint = np.load(checkpoint_filename(output, epoch))
+    exercise_names = sorted(exercise_ind_dict, key=exercise_ind_dict.get)
+    if ('exercise_names' not in checkpoint.files or
+            list(checkpoint['exercise_names']) != exercise_names or
+            checkpoint['couplings'].shape != couplings.shape or
+            checkpoint['abilities'].shape != abilities.shape):
+        sys.exit("%s was not saved by a run with the same data and options"
+                 % checkpoint_filename(output, epoch))
+    couplings[:] = checkpoint['couplings']
+    abilities[:] = checkpoint['abilities']
+
+
+def shared_array(shape):
+    """Return an array of zeros in shared memory.  Worker processes created
+    afterwards see any changes made to it, and vice versa."""
+    size = int(np.prod(shape))
+    return np.ctypeslib.as_array(
+            multiprocessing.RawArray(ctypes.c_double, size)).reshape(shape)
+
+
+def get_minibatches(num_users, minibatch_size):
+    """Divide the users into (start, end) ranges of minibatch_size users."""
+    return [(start, min(start + minibatch_size, num_users))
+            for start in range(0, num_users, minibatch_size)]
+
+
+def L_dL_minibatch(user_range):
     """ calculate log likelihood and gradient wrt couplings of mIRT model
-        for single user """
-    couplings, state, options = arg
-    abilities = state['abilities'].copy()
-    correct = state['correct']
-    exercises_ind = state['exercises_ind']
-
-    # pad the abilities vector with a 1 to act as a bias
-    abilities = np.append(abilities.copy(),
-                          np.ones((1, abilities.shape[1])),
-                          axis=0)
-    # the abilities to exercise coupling parameters for this exercise
-    exercise_couplings = couplings[exercises_ind, :]
-
-    # calculate the probability of getting a question in this exercise correct
-    Y = np.dot(exercise_couplings, abilities)
+        for the users in [start, end), summed over the users """
+    start, end = user_range
+    user_offsets = _training_data['user_offsets']
+    first, last = user_offsets[start], user_offsets[end]
+    exercises_ind = _training_data['exercises_ind'][first:last]
+    correct = _training_data['correct'][first:last]
+    couplings = _training_data['couplings']
+
+    # the abilities of the user of each response, padded with a 1 to act
+    # as a bias
+    response_users = np.repeat(np.arange(start, end),
+                               np.diff(user_offsets[start:end + 1]))
+    abilities = np.ones((len(response_users), couplings.shape[1]))
+    abilities[:, :-1] = _training_data['abilities'][response_users]
+
+    # calculate the probability of getting each question correct
+    Y = np.sum(couplings[exercises_ind, :] * abilities, axis=1)
     Z = mirt_util.sigmoid(Y)  # predicted correctness value
-    Zt = correct.reshape(Z.shape)  # true correctness value
+    Zt = correct  # true correctness value
     pdata = Zt * Z + (1 - Zt) * (1 - Z)  # = 2*Zt*Z - Z + const
     dLdY = ((2 * Zt - 1) * Z * (1 - Z)) / pdata
-    dL = np.dot(dLdY, abilities.T)
+    # sum the gradient of each response into its exercise's row, one column
+    # at a time (np.add.at needs numpy >= 1.8)
+    dL = np.zeros(couplings.shape)
+    for col in range(couplings.shape[1]):
+        dL[:, col] = np.bincount(exercises_ind,
+                                 weights=dLdY * abilities[:, col],
+                                 minlength=couplings.shape[0])
     dL /= np.log(2.)
 
     L = np.sum(np.log(pdata))
     L /= np.log(2.)
 
-    return -L, -dL, exercises_ind
+    return -L, -dL
 
 
-def L_dL(couplings_flat, user_states, options, pool):
+def L_dL(couplings_flat, minibatches, options, pool):
     """ calculate log likelihood and gradient wrt couplings of mIRT model """
-    couplings = couplings_flat.copy().reshape((-1, options.num_abilities + 1))
+    couplings = _training_data['couplings']
+    couplings[:] = couplings_flat.reshape(couplings.shape)
+    num_users = len(_training_data['user_offsets']) - 1
 
     L = 0.
     dL = np.zeros(couplings.shape)
 
-    # TODO(jascha) this would be faster if user_states was divided into
-    # minibatches instead of single students
     if pool is None:
-        rslts = map(L_dL_singleuser,
-                    [(couplings, state, options) for state in user_states])
+        rslts = map(L_dL_minibatch, minibatches)
     else:
-        rslts = pool.map(L_dL_singleuser,
-                        [(couplings, state, options) for state in user_states],
-                        chunksize=100)
-    for r in rslts:
-        Lu, dLu, exercise_indu = r
-        L += Lu / float(len(user_states))
-        dL[exercise_indu, :] += dLu / float(len(user_states))
+        rslts = pool.map(L_dL_minibatch, minibatches, chunksize=1)
+    for Lb, dLb in rslts:
+        L += Lb / float(num_users)
+        dL += dLb / float(num_users)
 
     L += options.regularization * sum(couplings_flat ** 2)
     dL += 2. * options.regularization * couplings
@@ -185,86 +382,63 @@ def main():
     # initialize the parameter matrix to zeros (+1 for bias unit)
     couplings = np.zeros((MAX_EXERCISES, options.num_abilities + 1))
 
-    pool = None
-    if options.workers > 0:
-        pool = Pool(options.workers)
-
-    prev_user = None
-    attempts = []
-
-    exercise_ind_dict = defaultdict(generate_exercise_ind)
-
-    user_states = []
-
     print >>sys.stderr, "loading data"
-    for _ in range(options.num_replicas):
-        # loop through all the training data, and create user objects
-        for line in fileinput.input(options.file):
-            # split on either tab or \x01 so the code works via Hive or pipe
-            row = linesplit.split(line.strip())
-            # the user and timestamp are shared by all row types.
-            # load the user
-            user = row[idx_pl.user]
-            if user != prev_user and len(attempts) > 0:
-                # We're getting a new user, so perform the reduce operation
-                # on our previous user
-                user_states.append(create_user_state(
-                        attempts, exercise_ind_dict, options))
-                attempts = []
-            prev_user = user
-            if row[idx_pl.rowtype] == 'problemlog':
-                row[idx_pl.correct] = row[idx_pl.correct] == 'true'
-                row[idx_pl.eventually_correct] = (
-                    row[idx_pl.eventually_correct] == 'true')
-                row[idx_pl.problem_number] = int(row[idx_pl.problem_number])
-                row[idx_pl.number_attempts] = int(row[idx_pl.number_attempts])
-                row[idx_pl.number_hints] = int(row[idx_pl.number_hints])
-                row[idx_pl.time_taken] = float(row[idx_pl.time_taken])
-                attempts.append(row)
-
-        if len(attempts) > 0:
-            # flush the data for the final user, too
-            user_states.append(create_user_state(
-                    attempts, exercise_ind_dict, options))
-
-        fileinput.close()
+    exercises_ind, correct, user_offsets, exercise_ind_dict = (
+            load_responses(options.file, options.cache))
 
     # trim couplings to include only the used rows
-    couplings = couplings[:current_ind, :]
+    couplings = couplings[:len(exercise_ind_dict), :]
+
+    # set up the training data, and the shared memory for the workers
+    (_training_data['exercises_ind'], _training_data['correct'],
+        _training_data['user_offsets']) = replicate_responses(
+            exercises_ind, correct, user_offsets, options.num_replicas)
+    _training_data['couplings'] = shared_array(couplings.shape)
+    num_users = len(_training_data['user_offsets']) - 1
+    abilities = _training_data['abilities'] = shared_array(
+            (num_users, options.num_abilities))
+    abilities[:] = np.random.randn(num_users, options.num_abilities)
+
+    start_epoch = 0
+    if options.resume:
+        last_epoch = find_latest_checkpoint(options.output)
+        if last_epoch is None:
+            print >>sys.stderr, "no checkpoint to resume from, starting over"
+        else:
+            print >>sys.stderr, "resuming after epoch %d" % last_epoch
+            load_checkpoint(options.output, last_epoch, couplings, abilities,
+                            exercise_ind_dict)
+            start_epoch = last_epoch + 1
+
+    minibatches = get_minibatches(num_users, options.minibatch_size)
+    num_shards = max(options.workers, 1) * options.shards_per_worker
+    shards = get_minibatches(num_users,
+                             max(1, -(-num_users // num_shards)))
+
+    pool = None
+    if options.workers > 0:
+        pool = Pool(options.workers)
 
     # now do num_epochs EM steps
-    for epoch in range(options.num_epochs):
+    for epoch in range(start_epoch, options.num_epochs):
         print >>sys.stderr, "epoch %d, " % epoch,
 
         # Expectation step
         # Compute (and print) the energies during learning as a diagnostic.
         # These should decrease.
-        Eavg = 0.
-        # TODO(jascha) this would be faster if user_states was divided into
-        # minibatches instead of single students
+        _training_data['couplings'][:] = couplings
+        shard_args = [(shard, options.sampling_num_steps) for shard in shards]
         if pool is None:
-            rslts = map(sample_abilities_diffusion,
-                        [(couplings, user_states[ind], options, ind)
-                            for ind in range(len(user_states))])
+            rslts = map(sample_abilities_shard, shard_args)
         else:
-            rslts = pool.map(sample_abilities_diffusion,
-                            [(couplings, user_states[ind], options, ind)
-                                for ind in range(len(user_states))],
-                            chunksize=100)
-        for r in rslts:
-            abilities, El, ind = r
-            user_states[ind]['abilities'] = abilities.copy()
-            Eavg += El / float(len(user_states))
+            rslts = pool.map(sample_abilities_shard, shard_args, chunksize=1)
+        Eavg = sum(rslts) / float(num_users)
         print >>sys.stderr, "E joint log L + const %f, " % (
                 -Eavg / np.log(2.)),
 
-        # debugging info -- accumulate mean and covariance of abilities vector
-        mn_a = 0.
-        cov_a = 0.
-        for state in user_states:
-            mn_a += state['abilities'][:, 0].T / float(len(user_states))
-            cov_a += (state['abilities'][:, 0] ** 2).T / (
-                        float(len(user_states)))
+        # debugging info -- mean and covariance of abilities vector
+        mn_a = np.mean(abilities, axis=0)
+        cov_a = np.mean(abilities ** 2, axis=0)
         print >>sys.stderr, "<abilities>", mn_a, 
         print >>sys.stderr, ", <abilities^2>", cov_a, ", ",
 
@@ -273,7 +447,7 @@ def main():
         couplings_flat, L, _ = scipy.optimize.fmin_l_bfgs_b(
             L_dL,
             couplings.copy().ravel(),
-            args=(user_states, options, pool),
+            args=(minibatches, options, pool),
             disp=0,
             maxfun=options.max_pass_lbfgs, m=100)
         couplings = couplings_flat.reshape(couplings.shape)
@@ -285,27 +459,10 @@ def main():
         print >>sys.stderr, "||dcouplings|| %f" % (
                 np.sqrt(np.sum((couplings - old_couplings) ** 2)))
 
-        # save state as a .npz
-        np.savez("%s_epoch=%d.npz" % (options.output, epoch),
-                 couplings=couplings,
-                 exercise_ind_dict=dict(exercise_ind_dict))
-
-        # save state as .csv - just for easy debugging inspection
-        f1 = open("%s_epoch=%d.csv" % (options.output, epoch), 'w+')
-        tt = [(couplings[exercise_ind_dict[nm], :-1],
-                couplings[exercise_ind_dict[nm], -1], nm)
-                for nm in exercise_ind_dict.keys()]
-        tt = sorted(tt, key=lambda tl: tl[1])
-        print >>f1, 'bias, ',
-        for ii in range(tt[0][0].shape[0]):
-            print >>f1, "coupling %d, " % ii,
-        print >>f1, 'exercise name'
-        for t in tt:
-            print >>f1, t[1], ',',
-            for ii in range(tt[0][0].shape[0]):
-                print >>f1, t[0][ii], ',',
-            print >>f1, t[2]
-        f1.close()
+        if ((epoch + 1) % options.checkpoint_every == 0 or
+                epoch == options.num_epochs - 1):
+            save_checkpoint(options.output, epoch, couplings, abilities,
+                            exercise_ind_dict)
 
 if __name__ == '__main__':
     main()
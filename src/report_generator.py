@@ -2,7 +2,8 @@
 """ A script to wrap all the steps for running regular reports, including
     1. Waiting for data partitions
     2. Kick off EMR jobs and wait for completion
-    3. Kick off report importer to load data from Hive to MongoDB
+    3. Kick off report importer to load data from Hive to MongoDB, running
+       imports into different collections concurrently, and email a summary
 
 For example:
   ./report_generator.py -c ../cfg/daily_report.json \
@@ -19,24 +20,40 @@ The parameters have the format of <key>=<value>. It will replece <key> with
 """
 
 
+import collections
 import datetime
 import json
 import optparse
-import subprocess
+import random
 import sys
+import threading
 import time
+import traceback
+from multiprocessing.pool import ThreadPool
 
 import boto
+import pymongo
 
 import boto_util
 import emr
 import hive_mysql_connector
 import notify
+import report_importer
 import util
 
 
 g_logger = util.get_logger()
 
+# Partitions are polled with exponential backoff between these many seconds.
+POLL_MIN_SECS = 30
+POLL_MAX_SECS = 240
+
+# Written by Hadoop to an output directory once all the data is there.
+_SUCCESS_MARKER = '_SUCCESS'
+
+_thread_local = threading.local()
+_mongo_conns_lock = threading.Lock()
+
 
 def parse_command_line_args():
     parser = optparse.OptionParser(USAGE)
@@ -54,6 +71,9 @@ def parse_command_line_args():
     parser.add_option("--skip_report_import", action="store_true",
         dest="skip_report_import", default=False,
         help="Do not execute step 3, loading generated reports into MongoDB")
+    parser.add_option("-p", "--import_parallelism", type="int", default=4,
+        help=("Max # of report imports to run at once.  Imports into the "
+              "same collection are always run one at a time, in order"))
     parser.add_option("-s", '--ssh_keyfile',
         help=('A location of an SSH pem file to use for SSH connections '
               'to the specified Hive machine'))
@@ -75,62 +95,103 @@ def parse_command_line_args():
 
 
 def partition_available(s3bucket, partition_location):
-    """Check if the data partition is available"""
+    """Check if the data partition is available.
+
+    A partition is available once it has a _SUCCESS marker, or, for data
+    written without one, once it has data none of which was written in the
+    last minute.
+    """
     time_delta = datetime.timedelta(seconds=60)
     path_prefix = partition_location[len('s3://ka-mapreduce/'):]
     if path_prefix[-1] != '/':
         path_prefix += '/'
-    now = datetime.datetime.now()
-    s3keys = s3bucket.list(prefix=path_prefix)
-    empty = True
-    for key in s3keys:
-        key_modified = datetime.datetime.strptime(key.last_modified,
-             "%Y-%m-%dT%H:%M:%S.%fZ")
-        if (now - key_modified) < time_delta:
-            # Data is still generating
-            return False
-        empty = False
-    if empty:
+    if s3bucket.get_key(path_prefix + _SUCCESS_MARKER) is not None:
+        return True
+    # S3 times are UTC ISO 8601 strings, which sort by time, so they can be
+    # compared without parsing them.
+    last_modified = None
+    for key in s3bucket.list(prefix=path_prefix):
+        last_modified = max(last_modified, key.last_modified)
+    if last_modified is None:
         # Data is not available yet
         return False
-    return True
+    recent = (datetime.datetime.utcnow() - time_delta).strftime(
+        "%Y-%m-%dT%H:%M:%S")
+    # Data is still generating if it was modified recently
+    return last_modified < recent
+
+
+def check_partition(partition_location):
+    """Call partition_available with an S3 connection for this thread."""
+    if not hasattr(_thread_local, 's3bucket'):
+        _thread_local.s3bucket = boto.connect_s3().get_bucket(
+            'ka-mapreduce', validate=False)
+    return (partition_location,
+            partition_available(_thread_local.s3bucket, partition_location))
 
 
 def wait_for_data(wait_for_config, options):
-    """Wait for data before kicking off hive jobs"""
+    """Wait for data before kicking off hive jobs.
+
+    All the partitions are polled at once.  Each is polled again after a
+    random delay between half and all of a backoff that starts at
+    POLL_MIN_SECS and doubles up to POLL_MAX_SECS.
+    """
     # Step 1 - read meta data.
     hive_mysql_connector.configure(options.hive_masternode,
         options.ssh_keyfile)
 
     if options.hive_init:
         hive_mysql_connector.run_hive_init()
-    # Step 2 - wait for all the data partitions are available
-    boto_util.initialize_creds_from_file()
-    s3conn = boto.connect_s3()
-    s3bucket = s3conn.get_bucket('ka-mapreduce')
-    max_wait = datetime.timedelta(hours=options.max_wait)
-    start = datetime.datetime.now()
+
+    tables_info = hive_mysql_connector.get_tables_info(
+        [d['table_name'] for d in wait_for_config])
+    # Maps each partition we are waiting for to when to poll it next.
+    next_poll = collections.OrderedDict()
     for d in wait_for_config:
-        table = d['table_name']
-        table_location = hive_mysql_connector.get_table_location(table)
+        if d['table_name'] not in tables_info:
+            raise Exception("Can't read info about %s in Hive master %s" %
+                            (d['table_name'], options.hive_masternode))
+        table_location = tables_info[d['table_name']][0]
         for p in d['partitions']:
-            partition_location = table_location + '/' + p
-            #TODO(yunfang): abstract the following to wait_for_partition
-            #               for boto_util
-            while True:
-                if partition_available(s3bucket, partition_location):
+            next_poll[table_location + '/' + p] = 0
+    if not next_poll:
+        return
+    backoff = dict.fromkeys(next_poll, POLL_MIN_SECS)
+
+    # Step 2 - wait for all the data partitions are available
+    boto_util.initialize_creds_from_file()
+    deadline = time.time() + options.max_wait * 60 * 60
+    pool = ThreadPool(min(len(next_poll), 8))
+    try:
+        while True:
+            now = time.time()
+            due = [p for (p, t) in next_poll.iteritems() if t <= now]
+            for (partition_location, available) in pool.imap_unordered(
+                    check_partition, due):
+                if available:
                     g_logger.info("%s is available" % (partition_location))
-                    break
-                if (datetime.datetime.now() - start) > max_wait:
-                    # Wait for a long time already. Can't wait any more
-                    g_logger.fatal("Wait for too long. "
-                                   "Data is still not available."
-                                   "Exiting...")
-                    sys.exit(1)
-                # Wait for a minute to check again
+                    del next_poll[partition_location]
+                    continue
                 g_logger.info("Waiting for %s to be available... " % (
                               partition_location))
-                time.sleep(60)
+                delay = backoff[partition_location]
+                next_poll[partition_location] = (
+                    time.time() + random.uniform(delay / 2.0, delay))
+                backoff[partition_location] = min(delay * 2, POLL_MAX_SECS)
+            if not next_poll:
+                break
+            if time.time() > deadline:
+                # Wait for a long time already. Can't wait any more
+                g_logger.fatal("Wait for too long. "
+                               "Data is still not available."
+                               "Exiting...")
+                sys.exit(1)
+            time.sleep(max(0, min(min(next_poll.values()), deadline) -
+                              time.time()))
+        pool.close()
+    finally:
+        pool.terminate()
 
 
 def run_hive_jobs(jobname, steps, num_instances):
@@ -175,8 +236,84 @@ def run_hive_jobs(jobname, steps, num_instances):
         sys.exit(1)
 
 
-def run_report_importer(hive_masternode, steps):
-    """Import hive results to mongo"""
+def get_mongo_conn(mongo_conns, host, port):
+    """Return the connection in mongo_conns to the mongo server at
+    host:port, opening it if there isn't one yet."""
+    with _mongo_conns_lock:
+        if (host, port) not in mongo_conns:
+            mongo_conns[(host, port)] = pymongo.Connection(host, port=port)
+        return mongo_conns[(host, port)]
+
+
+def import_steps(hive_masternode, steps, mongo_conns):
+    """Run report_importer in this process for each step, in order.
+
+    Each step is a (step, importer_options, importer_args) tuple.  The steps
+    are imported with the connection in mongo_conns to their report db
+    server (opened if there isn't one yet), and hive_mysql_connector must
+    already be configured.
+
+    Returns a list of dicts of stats on each step: the mongo collection,
+    the number of rows saved and skipped with errors, the seconds taken,
+    and the error if it failed.
+    """
+    results = []
+    for (step, importer_options, importer_args) in steps:
+        result = {'collection': step['mongo_collection'],
+                  'saved': 0, 'errors': 0, 'error': None}
+        g_logger.info("Importing %s into %s" % (step['hive_table'],
+                                                step['mongo_collection']))
+        start = time.time()
+        try:
+            mongo_conn = get_mongo_conn(mongo_conns,
+                                        importer_options.report_db_host,
+                                        importer_options.report_db_port)
+            (result['saved'], result['errors']) = report_importer.import_table(
+                hive_masternode=importer_args[0],
+                table_name=importer_args[1],
+                target_db=importer_args[2],
+                target_collection=importer_args[3],
+                partition_cols=importer_args[4:],
+                options=importer_options,
+                mongo_conn=mongo_conn,
+                hive_configured=True)
+        except (Exception, SystemExit):
+            result['error'] = traceback.format_exc()
+            g_logger.error("Importing %s failed:\n%s" % (step['hive_table'],
+                                                         result['error']))
+        result['seconds'] = time.time() - start
+        results.append(result)
+    return results
+
+
+def parse_importer_args(hive_masternode, step):
+    """Return the report_importer (options, args) to import a step with."""
+    argv = ['--quiet']
+    if step.get('drop', False):
+        argv.append('--drop')
+    if step.get('swap', False):
+        argv.append('--swap')
+    if step.get('hive_init', False):
+        argv.append('--hive_init')
+    argv += [hive_masternode, step['hive_table'], 'report',
+             step['mongo_collection']]
+    argv += step['importer_args'].split()
+    g_logger.info("Importing with arguments: \n%s" % ' '.join(argv))
+    return report_importer.parse_command_line_args(argv)
+
+
+def run_report_importer(hive_masternode, steps, jobname, parallelism=1):
+    """Import hive results to mongo, and email a summary of the imports.
+
+    Steps importing into different collections are independent, and up
+    to parallelism of them are run at once, sharing one mongo connection
+    pool per report db server.  A step with bad importer_args fails on its
+    own, without stopping the others.  Returns True if all the imports
+    succeeded.
+    """
+    results = []
+    # Steps importing into the same collection are run in order.
+    steps_by_collection = collections.OrderedDict()
     for step in steps:
         # It's possible to leave out hive_table and mongo_collection,
         # for when the step just wants to run a hive script and not
@@ -184,20 +321,72 @@ def run_report_importer(hive_masternode, steps):
         if ('hive_table' not in step) or ('mongo_collection' not in step):
             continue
 
-        options = ''
-        if step.get('drop', False):
-            options += ' --drop'
-        if step.get('hive_init', False):
-            options += ' --hive_init'
-        #TODO(benkomalo): Make the report_importer callable
-        command = ('python /home/analytics/analytics/src/report_importer.py'
-                   ' %s %s %s report %s %s') % (
-                   options, hive_masternode, step['hive_table'],
-                   step['mongo_collection'], step['importer_args'])
-        g_logger.info("Running command: \n%s" % (command))
-        proc = subprocess.Popen(command.split(),
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print proc.communicate()  # returns a tuple of (stdoutdata, stderrdata)
+        try:
+            importer_options, importer_args = parse_importer_args(
+                hive_masternode, step)
+        except (Exception, SystemExit):
+            # parse_command_line_args exits on bad arguments.
+            error = traceback.format_exc()
+            g_logger.error("Bad importer_args for %s:\n%s" % (
+                step['hive_table'], error))
+            results.append({'collection': step['mongo_collection'],
+                            'saved': 0, 'errors': 0, 'seconds': 0.,
+                            'error': error})
+            continue
+        steps_by_collection.setdefault(step['mongo_collection'], []).append(
+            (step, importer_options, importer_args))
+    if not steps_by_collection and not results:
+        return True
+
+    if steps_by_collection:
+        all_steps = [collection_step
+                     for collection_steps in steps_by_collection.values()
+                     for collection_step in collection_steps]
+        # The hive connection is global, so it's set up once here rather
+        # than by each import.  Then all the tables are looked up at once.
+        # The hive scripts may have just changed them, so the cached info
+        # isn't used.
+        hive_mysql_connector.configure(hive_masternode,
+                                       all_steps[0][1].ssh_keyfile)
+        if any(options.hive_init for (_, options, _) in all_steps):
+            hive_mysql_connector.run_hive_init()
+        hive_mysql_connector.get_tables_info(
+            [step['hive_table'] for (step, _, _) in all_steps], refresh=True)
+
+        mongo_conns = {}
+        pool = ThreadPool(max(1, min(parallelism, len(steps_by_collection))))
+        try:
+            collection_results = pool.map(
+                lambda collection_steps: import_steps(hive_masternode,
+                                                      collection_steps,
+                                                      mongo_conns),
+                steps_by_collection.values(), chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+        results += [result for collection_result in collection_results
+                    for result in collection_result]
+
+    lines = []
+    for result in results:
+        lines.append("%s: %s rows saved, %s with errors, %.1f seconds%s" % (
+            result['collection'], result['saved'], result['errors'],
+            result['seconds'], ', FAILED' if result['error'] else ''))
+    for result in results:
+        if result['error']:
+            lines.append("\n%s failed:\n%s" % (result['collection'],
+                                                result['error']))
+    summary = '\n'.join(lines)
+    g_logger.info("Report import results:\n%s" % summary)
+
+    succeeded = not any(result['error'] for result in results)
+    if succeeded:
+        subject = "Report import SUCCEEDED: %s" % jobname
+    else:
+        subject = "Report import FAILED: %s" % jobname
+        notify.send_hipchat(subject)
+    notify.send_email(subject, summary)
+    return succeeded
 
 
 def main():
@@ -228,7 +417,8 @@ def main():
         g_logger.info("Skipping " + step3)
     else:
         g_logger.info(step3)
-        run_report_importer(options.hive_masternode, config['steps'])
+        run_report_importer(options.hive_masternode, config['steps'],
+                            config['name'], options.import_parallelism)
 
     g_logger.info("Report generation finished.")
 
@@ -32,34 +32,259 @@ Each row will be saved to the reporting table as a document in the specified
 target_collection.
 """
 
+import Queue
 import datetime
 import optparse
 import sys
+import threading
 
 import boto
+import boto.s3.key
 import pymongo
 
 import boto_util
 import hive_mysql_connector
 
 
+# Hive's representation of NULL in table data.
+NULL_STRING = '\N'
+
+# With --swap, the data is imported into the target collection name with
+# this appended, before being renamed to the target collection.
+SWAP_SUFFIX = '_importing'
+
+# Index properties that are not options to create_index.
+_INDEX_INFO_FIELDS = ('key', 'ns', 'v')
+
+
+def parse_row(parts, column_info, key_index):
+    """Return the mongo document for a row of table data, split into parts.
+
+    Returns None for rows with NULL values that can't be parsed.
+    """
+    doc = {}
+    for i, (name, type, _) in enumerate(column_info):
+        # TODO(benkomalo): deal with other types and possible UTF-8
+        #    issues?
+        try:
+            if type == 'int':
+                value = int(parts[i])
+            elif type == 'boolean':
+                value = parts[i] == 'true'
+            elif type in ['double', 'float']:
+                value = float(parts[i])
+            else:
+                value = parts[i]
+        except Exception:
+            if parts[i] == NULL_STRING:
+                # TODO(benkomalo): figure out why our data has this.
+                # It seems that sometimes Hive likes to put in
+                # NULL values for ints and booleans? They don't parse
+                # well. This is unfortunate - just skip the row since
+                # it's pretty rare for now.
+                return None
+            raise
+
+        doc[name] = value
+
+    if key_index > -1:
+        # mongo primary keys are labelled as "_id"
+        doc['_id'] = parts[key_index]
+
+    return doc
+
+
+def read_part(key, partition_values, column_info, key_index, batch_size,
+              put_batch):
+    """Read the docs in an S3 part of a table, streaming it line by line.
+
+    The docs are passed to put_batch in lists of up to batch_size.  Returns
+    the number of rows with errors, or None if put_batch returns False (to
+    stop reading).
+    """
+    # TODO(benkomalo): handle other formats? It may also be compressed, so
+    #    we may have to do more work.
+    # Default row format for the tables are delimited by this control char.
+    # when stored on disk.
+    delimiter = '\01'
+    num_cols = len(column_info)
+    errors = 0
+    docs = []
+
+    for line in boto_util.read_lines(key):
+
+        if not line:
+            # EOF
+            break
+
+        # HACK: some files are '\t' delimited? Switch delimiters.
+        # TODO(benkomalo): read format from metadata in Hive master?
+        if delimiter not in line:
+            delimiter = '\t'
+
+        parts = line.strip().split(delimiter)
+        if len(parts) != num_cols:
+            # TODO(benkomalo): properly handle? shouldn't happen though.
+            sys.stderr.write(
+                "Unexpected number of columns in row (expected [%s]):\n%s\n"
+                % (num_cols, parts))
+            continue
+
+        doc = parse_row(parts, column_info, key_index)
+        if doc:
+            doc.update(partition_values)
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                if not put_batch(docs):
+                    return None
+                docs = []
+        else:
+            errors += 1
+
+    if docs and not put_batch(docs):
+        return None
+    return errors
+
+
+def write_docs(mongo_collection, docs):
+    """Save a batch of docs, upserting any with an _id."""
+    # Only the last doc for each _id is kept, as saving them in turn would
+    # do, since the upserts aren't ordered.
+    keyed_docs = {}
+    docs_to_insert = []
+    for doc in docs:
+        if '_id' in doc:
+            keyed_docs[doc['_id']] = doc
+        else:
+            docs_to_insert.append(doc)
+
+    if docs_to_insert:
+        mongo_collection.insert(docs_to_insert)
+
+    if keyed_docs:
+        if hasattr(mongo_collection, 'initialize_unordered_bulk_op'):
+            bulk = mongo_collection.initialize_unordered_bulk_op()
+            for (doc_id, doc) in keyed_docs.iteritems():
+                bulk.find({'_id': doc_id}).upsert().replace_one(doc)
+            bulk.execute()
+        else:
+            # pymongo before 2.7 has no bulk upserts.
+            for doc in keyed_docs.itervalues():
+                mongo_collection.save(doc)
+
+
+def copy_indexes(from_collection, to_collection):
+    """Create the indexes of from_collection (other than on _id) on
+    to_collection."""
+    for (name, info) in from_collection.index_information().iteritems():
+        if name == '_id_':
+            continue
+        index_options = dict((option, value)
+                             for (option, value) in info.iteritems()
+                             if option not in _INDEX_INFO_FIELDS)
+        to_collection.create_index(info['key'], name=name, **index_options)
+
+
+def create_swap_collection(mongodb, target_collection):
+    """Return a new, empty collection to import into with --swap.
+
+    Any collection left over from an import that failed is dropped.  The
+    new collection is created explicitly, so that it can be renamed even
+    if nothing is imported into it.
+    """
+    name = target_collection + SWAP_SUFFIX
+    mongodb.drop_collection(name)
+    return mongodb.create_collection(name)
+
+
+def swap_collection(new_collection, live_collection):
+    """Replace live_collection with new_collection, indexed the same way.
+
+    The indexes are built on the whole of the new data at once, rather than
+    updated for every insert, and the rename is atomic, so readers of
+    live_collection see either all the old data or all the new data.
+    """
+    print "\nIndexing %s like %s." % (new_collection.name,
+                                      live_collection.name)
+    copy_indexes(live_collection, new_collection)
+    print "Renaming %s to %s." % (new_collection.name, live_collection.name)
+    new_collection.rename(live_collection.name, dropTarget=True)
+
+
+class PartReader(threading.Thread):
+    """A thread reading S3 parts from a queue, and putting batches of their
+    docs on another.
+
+    Each batch is put on the batch queue as ('docs', docs).  When there
+    are no more parts, ('done', rows with errors) is put, or ('error',
+    sys.exc_info()) if reading a part failed.
+    """
+
+    def __init__(self, bucket_name, parts, batches, stop, column_info,
+                 key_index, batch_size):
+        super(PartReader, self).__init__()
+        self.daemon = True
+        self.bucket_name = bucket_name
+        self.parts = parts
+        self.batches = batches
+        self.stop = stop
+        self.column_info = column_info
+        self.key_index = key_index
+        self.batch_size = batch_size
+
+    def put(self, item):
+        """Put an item on the batch queue, returning False if told to stop
+        while it was full."""
+        while not self.stop.is_set():
+            try:
+                self.batches.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(self):
+        errors = 0
+        try:
+            # Each thread has its own S3 connection.
+            bucket = boto.connect_s3().get_bucket(self.bucket_name,
+                                                  validate=False)
+            while not self.stop.is_set():
+                try:
+                    (key_name, partition_values) = self.parts.get_nowait()
+                except Queue.Empty:
+                    break
+                key = boto.s3.key.Key(bucket, key_name)
+                part_errors = read_part(key, partition_values,
+                                        self.column_info, self.key_index,
+                                        self.batch_size,
+                                        lambda docs: self.put(('docs', docs)))
+                if part_errors is None:
+                    return
+                errors += part_errors
+        except Exception:
+            self.put(('error', sys.exc_info()))
+            return
+        self.put(('done', errors))
+
+
 def main(table_location,
          target_db,
          target_collection,
          column_info,
          partition_cols,
-         options):
+         options,
+         mongo_conn=None):
+    """Import the table data at table_location into a mongo collection.
 
+    mongo_conn is the pymongo.Connection to use, or None to connect to
+    options.report_db_host.  Returns the number of documents saved and the
+    number of rows skipped because of errors.
+    """
     boto_util.initialize_creds_from_file()
 
-    # TODO(benkomalo): handle other formats? It may also be compressed, so
-    #    we may have to do more work.
-    # Default row format for the tables are delimited by this control char.
-    # when stored on disk.
-    delimiter = '\01'
     key_index = options.key_index
     num_cols = len(column_info)
-    col_names, col_types, _ = zip(*column_info)
 
     if key_index >= num_cols:
         raise Exception("Invalid key index (there aren't enough columns)")
@@ -71,13 +296,20 @@ def main(table_location,
     table_location += _format_path_from_partition(partition_cols)
 
     # Open our target db connection
-    mongo_conn = pymongo.Connection(options.report_db_host,
-                                    port=options.report_db_port)
+    if mongo_conn is None:
+        mongo_conn = pymongo.Connection(options.report_db_host,
+                                        port=options.report_db_port)
     mongodb = mongo_conn[target_db]
     mongo_collection = mongodb[target_collection]
 
-    # If drop flag was set, nuke any pre-existing data
-    if options.drop:
+    if options.drop and options.swap:
+        # Import into a new collection, which replaces the existing one
+        # when it is complete.
+        live_collection = mongo_collection
+        mongo_collection = create_swap_collection(mongodb, target_collection)
+        print "\nImporting into %s." % mongo_collection.name
+    elif options.drop:
+        # If drop flag was set, nuke any pre-existing data
         print "\nDropping existing data in collection %s." % target_collection
         # Even though the option is called 'drop', I am instead
         # calling 'remove', because it leaves any indexes while deleting data.
@@ -89,19 +321,8 @@ def main(table_location,
     path_prefix = table_location[len('s3://ka-mapreduce/'):] + '/'
     s3keys = bucket.list(prefix=path_prefix)
 
-    # TODO(benkomalo): add a flag to bail on any errors so no partial data is
-    #    saved?
-    # Counts of rows saved, and rows with errors.
-    saved = 0
-    errors = 0
-    NULL_STRING = '\N'
-
-    docs_to_insert = []
-    batch_size = max(1, options.batch_size)
-
-    lines_parsed = 0
-
     # Note: a table's data may be broken down into multiple files on disk.
+    parts = Queue.Queue()
     for key in s3keys:
         if key.name.endswith('_$folder$'):
             # S3 meta data - not useful.
@@ -115,96 +336,60 @@ def main(table_location,
         for partition in path_parts[:-1]:
             name, value = partition.split('=')
             partition_values[name] = value
+        parts.put((key.name, partition_values))
 
-        contents = key.get_contents_as_string()
-        for line in contents.split('\n'):
-
-            if not line:
-                # EOF
-                break
-
-            # HACK: some files are '\t' delimited? Switch delimiters.
-            # TODO(benkomalo): read format from metadata in Hive master?
-            if delimiter not in line:
-                delimiter = '\t'
-
-            parts = line.strip().split(delimiter)
-            if len(parts) != num_cols:
-                # TODO(benkomalo): properly handle? shouldn't happen though.
-                sys.stderr.write(
-                    "Unexpected number of columns in row (expected [%s]):\n" %
-                     num_cols)
-                print >> sys.stderr, parts
-                continue
-
-            doc = {}
-            for i, (name, type) in enumerate(zip(col_names, col_types)):
-                # TODO(benkomalo): deal with other types and possible UTF-8
-                #    issues?
-                try:
-                    if type == 'int':
-                        value = int(parts[i])
-                    elif type == 'boolean':
-                        value = parts[i] == 'true'
-                    elif type in ['double', 'float']:
-                        value = float(parts[i])
-                    else:
-                        value = parts[i]
-                except Exception:
-                    if parts[i] == NULL_STRING:
-                        # TODO(benkomalo): figure out why our data has this.
-                        # It seems that sometimes Hive likes to put in
-                        # NULL values for ints and booleans? They don't parse
-                        # well. This is unfortunate - just skip the row since
-                        # it's pretty rare for now.
-                        doc = None
-                        break
-                    raise
-
-                doc[name] = value
-
-            if key_index > -1:
-                # mongo primary keys are labelled as "_id"
-                doc['_id'] = parts[key_index]
-
-            if doc:
-
-                doc.update(partition_values)
-
-                # If we have doc IDs, perform a single upsert because bulk
-                # upserts are not currently supported by pymongo according to
-                # this old answer: http://stackoverflow.com/questions/5292370
-                if '_id' in doc:
-                    mongo_collection.save(doc)
-                    saved += 1
-                else:
-                    docs_to_insert.append(doc)
+    # TODO(benkomalo): add a flag to bail on any errors so no partial data is
+    #    saved?
+    # Counts of rows saved, and rows with errors.
+    saved = 0
+    errors = 0
 
+    # The parts are read by several threads, which hand the docs to this
+    # one to save through a bounded queue.
+    num_readers = max(1, options.readers)
+    batches = Queue.Queue(maxsize=2 * num_readers)
+    stop = threading.Event()
+    readers = [PartReader(bucket.name, parts, batches, stop, column_info,
+                          key_index, max(1, options.batch_size))
+               for _ in xrange(num_readers)]
+    for reader in readers:
+        reader.start()
+
+    succeeded = False
+    try:
+        while num_readers:
+            item = batches.get()
+            if item[0] == 'docs':
+                write_docs(mongo_collection, item[1])
+                saved += len(item[1])
+                if not options.quiet:
+                    print "\rSaved %s docs with %s errors..." % (saved,
+                                                                 errors),
+                    sys.stdout.flush()
+            elif item[0] == 'done':
+                errors += item[1]
+                num_readers -= 1
             else:
-                errors += 1
-
-            # Bulk insert docs in batches
-            if len(docs_to_insert) >= batch_size:
-                mongo_collection.insert(docs_to_insert)
-                saved += len(docs_to_insert)
-                docs_to_insert = []
-
-            if lines_parsed % 100 == 0:
-                print "\rSaved %s docs with %s errors..." % (saved, errors),
-                sys.stdout.flush()
-
-            lines_parsed += 1
-
-    if docs_to_insert:
-        mongo_collection.insert(docs_to_insert)
-        saved += len(docs_to_insert)
+                (exc_type, exc_value, exc_traceback) = item[1]
+                raise exc_type, exc_value, exc_traceback
+        succeeded = True
+    finally:
+        stop.set()
+        if options.drop and options.swap and not succeeded:
+            # Leave the existing collection as it was.
+            mongo_collection.drop()
+
+    if options.drop and options.swap:
+        swap_collection(mongo_collection, live_collection)
 
     print "\nSummary of results:"
     print "\tSaved [%s] documents" % saved
     print "\tSkipped [%s] documents with errors" % errors
+    return saved, errors
 
 
-def parse_command_line_args():
+def parse_command_line_args(argv=None):
+    """Parse the command line, or the arguments in the list argv."""
     parser = optparse.OptionParser(USAGE)
     parser.add_option('--key_index', type="int",
         default=-1,
@@ -223,13 +408,24 @@ def parse_command_line_args():
         help=('A location of an SSH pem file to use for SSH connections '
               'to the specified Hive machine'))
     parser.add_option('--batch_size', type="int", default=1000,
-        help=('Number of documents to insert in a single database call. '
-              'Will only do bulk inserts if no key index is specified, '
-              'because pymongo does not currently support bulk upserts.'))
+        help=('Number of documents to insert or upsert in a single '
+              'database call.  Upserts are done one at a time with pymongo '
+              'versions before 2.7, which have no bulk upserts.'))
+    parser.add_option('--readers', type="int", default=4,
+        help='Number of S3 files of the table to read at once.')
     parser.add_option("--drop", action="store_true", 
         dest="drop", default=False,
         help=('This flag will delete the entire target collection before '
               'inserting the new data.  Use with caution!'))
+    parser.add_option("--swap", action="store_true",
+        dest="swap", default=False,
+        help=('With --drop, import the new data into a separate collection, '
+              'index it like the target collection, and then rename it to '
+              'the target collection, replacing the existing data.  The '
+              'target collection is never empty or partially imported.'))
+    parser.add_option("-q", "--quiet", action="store_true",
+        dest="quiet", default=False,
+        help="Don't print progress while saving documents.")
     parser.add_option("--hive_init", action="store_true", 
         dest="hive_init", default=False,
         help=('If True, this script will execute ka_hive_init.q on the '
@@ -238,10 +434,12 @@ def parse_command_line_args():
               'date, e.g. if data you want to import was create by an '
               'unknown on-demand cluster.'))
 
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(argv)
     if len(args) < 4:
         print >> sys.stderr, USAGE
         sys.exit(-1)
+    if options.swap and not options.drop:
+        parser.error("--swap can only be used with --drop")
 
     return options, args
 
@@ -275,45 +473,60 @@ def print_locations(table_location, column_info, partition_cols,
     print "\t%s" % mongo_path
 
 
-if __name__ == '__main__':
-    start_dt = datetime.datetime.now()
-
-    options, args = parse_command_line_args()
+def import_table(hive_masternode, table_name, target_db, target_collection,
+                 partition_cols, options, mongo_conn=None,
+                 hive_configured=False):
+    """Import a Hive table into a mongo collection.
 
+    The arguments are those of the command line (see USAGE), with options
+    as returned by parse_command_line_args.  If hive_configured is True,
+    the caller has already configured hive_mysql_connector (and run the
+    hive init, if options.hive_init is set).  Returns the number of
+    documents saved and the number of rows skipped because of errors.
+    """
     # Step 1 - read meta data.
-    hive_masternode = args[0]
-    hive_mysql_connector.configure(hive_masternode, options.ssh_keyfile)
-        
-    if options.hive_init:
-        hive_mysql_connector.run_hive_init()
+    if not hive_configured:
+        hive_mysql_connector.configure(hive_masternode, options.ssh_keyfile)
+
+        if options.hive_init:
+            hive_mysql_connector.run_hive_init()
 
-    table_name = args[1]
     print "Fetching table info..."
     table_location = hive_mysql_connector.get_table_location(table_name)
 
     if not table_location:
         raise Exception("Can't read info about %s in Hive master %s" %
-                        (hive_masternode, table_name))
+                        (table_name, hive_masternode))
     if not table_location.startswith('s3://ka-mapreduce/'):
         raise Exception("Can only import from s3://ka-mapreduce for now")
     column_info = hive_mysql_connector.get_table_columns(table_name)
 
-    target_db = args[2]
-    target_collection = args[3]
-    partition_cols = args[4:]
-
     # TODO(benkomalo): prompt/dry-run flags?
     # Step 2 - print locations
     print_locations(table_location, column_info, partition_cols,
                     target_db, target_collection, options)
 
     # Step 3 - read the data!
-    main(table_location,
-         target_db,
-         target_collection,
-         column_info,
-         partition_cols,
-         options)
+    return main(table_location,
+                target_db,
+                target_collection,
+                column_info,
+                partition_cols,
+                options,
+                mongo_conn)
+
+
+if __name__ == '__main__':
+    start_dt = datetime.datetime.now()
+
+    options, args = parse_command_line_args()
+
+    import_table(hive_masternode=args[0],
+                 table_name=args[1],
+                 target_db=args[2],
+                 target_collection=args[3],
+                 partition_cols=args[4:],
+                 options=options)
 
     time_taken = datetime.datetime.now() - start_dt
     print "\nTotal wall time taken: %s seconds" % time_taken.total_seconds()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import unittest
+
+import pymongo.errors
+
+import report_importer
+
+
+class FakeDatabase(object):
+    """The parts of pymongo.database.Database used by --swap."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+    def create_collection(self, name):
+        if name in self.collections:
+            raise pymongo.errors.CollectionInvalid(
+                "collection %s already exists" % name)
+        self.collections[name] = {'docs': [], 'indexes': {}}
+        return self[name]
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+
+class FakeCollection(object):
+    """The parts of pymongo.collection.Collection used by --swap."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def _data(self):
+        return self.database.collections.setdefault(
+            self.name, {'docs': [], 'indexes': {}})
+
+    def insert(self, docs):
+        self._data()['docs'].extend(docs)
+
+    def find(self):
+        return list(self.database.collections.get(self.name,
+                                                  {'docs': []})['docs'])
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def index_information(self):
+        if self.name not in self.database.collections:
+            return {}
+        info = {'_id_': {'key': [('_id', 1)], 'v': 1}}
+        info.update(self._data()['indexes'])
+        return info
+
+    def create_index(self, key, name, **kwargs):
+        index = dict(kwargs, key=key, v=1)
+        self._data()['indexes'][name] = index
+
+    def rename(self, new_name, dropTarget=False):
+        collections = self.database.collections
+        if self.name not in collections:
+            raise pymongo.errors.OperationFailure(
+                "source namespace does not exist")
+        if new_name in collections and not dropTarget:
+            raise pymongo.errors.OperationFailure(
+                "target namespace exists")
+        collections[new_name] = collections.pop(self.name)
+
+
+class TestSwap(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.live = self.db['report']
+        self.live.insert([{'_id': 'old'}])
+        self.live.create_index([('user', 1)], name='user_1', unique=True)
+
+    def swap(self, docs):
+        new_collection = report_importer.create_swap_collection(self.db,
+                                                                'report')
+        if docs:
+            new_collection.insert(docs)
+        report_importer.swap_collection(new_collection, self.live)
+
+    def test_swap(self):
+        self.swap([{'_id': 'new'}])
+        self.assertEquals(self.live.find(), [{'_id': 'new'}])
+        self.assertEquals(self.live.index_information()['user_1'],
+                          {'key': [('user', 1)], 'unique': True, 'v': 1})
+        self.assertEquals(sorted(self.db.collections), ['report'])
+
+    def test_swap_nothing_imported(self):
+        self.db.drop_collection('report')
+        self.live = self.db['report']
+        self.live.insert([{'_id': 'old'}])
+        self.swap([])
+        self.assertEquals(self.live.find(), [])
+        self.assertEquals(sorted(self.db.collections), ['report'])
+
+    def test_swap_left_over_import(self):
+        self.db['report' + report_importer.SWAP_SUFFIX].insert(
+            [{'_id': 'left over'}])
+        self.swap([{'_id': 'new'}])
+        self.assertEquals(self.live.find(), [{'_id': 'new'}])
+        self.assertEquals(sorted(self.db.collections), ['report'])
+
+
+if __name__ == '__main__':
+    unittest.main()
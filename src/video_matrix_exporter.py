@@ -9,63 +9,291 @@ Reads lines from files representing the Hive table data for video correlations
 as generated by map_reduce/hive/video_recommender.q.
 
 A "score_type" must be specified to tell GAE which scoring algorithm was used.
+
+The table's parts are read in parallel (--parallelism), into a sparse matrix
+of float32 scores.  With --chunk_rows, the matrix is uploaded a chunk of
+rows at a time, and an upload interrupted by errors can be continued by
+running the same command again.
 """
 
+import array
+import collections
 import datetime
+import itertools
 import json
 import optparse
+import os
 import rfc822
 import sys
+import threading
+import time
 import urllib2
+from multiprocessing.pool import ThreadPool
 
 import boto
+import boto.s3.key
 
 import boto_util
 import oauth_util.consts
 import oauth_util.fetch_url as oauth_fetcher
 
 
-class VideoInfo(object):
-    def __init__(self, key, index):
-        self.key = key
-        self.index = index
-        self.best_matches = {}
+# Each thread reading S3 parts has its own S3 connection.
+_thread_local = threading.local()
+
+
+class VideoMatrix(object):
+    """A sparse matrix of scores between videos.
+
+    Videos are numbered in the order they are first seen, and the scores
+    are kept in compressed sparse rows: the scores of video i are in
+    scores[row_starts[i]:row_starts[i + 1]], and the videos they are for
+    are in the same range of cols.  Scores are kept as float32.
+    """
+
+    def __init__(self):
+        self.video_keys = []
+        self.video_indexes = {}
+        self.row_starts = array.array('i', [0])
+        self.cols = array.array('i')
+        self.scores = array.array('f')
+        # Entries added since the last call to sort_rows.
+        self._new_rows = array.array('i')
+        self._new_cols = array.array('i')
+        self._new_scores = array.array('f')
+
+    def video_index(self, vid_key):
+        index = self.video_indexes.get(vid_key)
+        if index is None:
+            index = self.video_indexes[vid_key] = len(self.video_keys)
+            self.video_keys.append(vid_key)
+        return index
+
+    def add_part(self, part):
+        """Add the scores read from an S3 part by read_part."""
+        (part_video_keys, rows, cols, scores) = part
+        indexes = [self.video_index(vid_key) for vid_key in part_video_keys]
+        self._new_rows.extend(indexes[row] for row in rows)
+        self._new_cols.extend(indexes[col] for col in cols)
+        self._new_scores.extend(scores)
+
+    def sort_rows(self):
+        """Move the scores added since the last call into their rows."""
+        num_videos = len(self.video_keys)
+        row_counts = array.array('i', [0]) * (num_videos + 1)
+        for row in xrange(len(self.row_starts) - 1):
+            row_counts[row + 1] = (self.row_starts[row + 1] -
+                                   self.row_starts[row])
+        for row in self._new_rows:
+            row_counts[row + 1] += 1
+        row_starts = row_counts
+        for row in xrange(num_videos):
+            row_starts[row + 1] += row_starts[row]
+
+        # A counting sort, which keeps the scores of a row in the order
+        # they were added.
+        positions = row_starts[:-1]
+        cols = array.array('i', [0]) * row_starts[-1]
+        scores = array.array('f', [0]) * row_starts[-1]
+        entries = itertools.chain(
+            itertools.izip(self.row_indexes(), self.cols, self.scores),
+            itertools.izip(self._new_rows, self._new_cols, self._new_scores))
+        for (row, col, score) in entries:
+            position = positions[row]
+            cols[position] = col
+            scores[position] = score
+            positions[row] = position + 1
+
+        self.row_starts = row_starts
+        self.cols = cols
+        self.scores = scores
+        self._new_rows = array.array('i')
+        self._new_cols = array.array('i')
+        self._new_scores = array.array('f')
+
+    def row_indexes(self):
+        """Yield the row of each entry of cols and scores, in order."""
+        for row in xrange(len(self.row_starts) - 1):
+            for _ in xrange(self.row_starts[row + 1] - self.row_starts[row]):
+                yield row
+
+    def num_pairs(self):
+        return sum(len(set(self.cols[self.row_starts[row]:
+                                     self.row_starts[row + 1]]))
+                   for row in xrange(len(self.row_starts) - 1))
+
+    def matrix_rows(self, start_row, end_row):
+        """Return a list of dicts of the scores of each row in the range,
+        mapping the index of each video to its score.
+
+        """
+        row_dicts = []
+        for row in xrange(start_row, end_row):
+            start = self.row_starts[row]
+            end = self.row_starts[row + 1]
+            # Round off the digits that are just float32 noise.
+            row_dicts.append(dict(
+                (col, float('%.7g' % score)) for (col, score) in
+                itertools.izip(self.cols[start:end], self.scores[start:end])))
+        return row_dicts
+
+
+def read_part(bucket_name, key_name, delimiter='\01'):
+    """Read the scores in an S3 part of a Hive table.
+
+    Returns (video_keys, rows, cols, scores), where video_keys lists the
+    videos in the part in the order they are first seen, and each score
+    is between video_keys[rows[i]] and video_keys[cols[i]].
+    """
+    if not hasattr(_thread_local, 's3conn'):
+        _thread_local.s3conn = boto.connect_s3()
+    bucket = _thread_local.s3conn.get_bucket(bucket_name, validate=False)
+    key = boto.s3.key.Key(bucket, key_name)
+
+    video_keys = []
+    video_indexes = {}
+    rows = array.array('i')
+    cols = array.array('i')
+    scores = array.array('f')
+    for line in boto_util.read_lines(key):
+        if not line:
+            # EOF
+            break
+
+        parts = line.rstrip().split(delimiter)
+        if len(parts) != 3:
+            # TODO(benkomalo): error handling
+            continue
 
+        vid1_key, vid2_key, score = parts
 
-def get_video_info(video_infos, vid_key):
-    if vid_key not in video_infos:
-        index = len(video_infos)
-        video_infos[vid_key] = VideoInfo(vid_key, index)
-    return video_infos[vid_key]
+        try:
+            score = float(score)
+        except ValueError:
+            # Some of the values were invalid - deal with it.
+            # TODO(benkomalo): error handling.
+            continue
 
+        for (vid_key, indexes) in ((vid1_key, rows), (vid2_key, cols)):
+            index = video_indexes.get(vid_key)
+            if index is None:
+                index = video_indexes[vid_key] = len(video_keys)
+                video_keys.append(vid_key)
+            indexes.append(index)
+        scores.append(score)
 
-def add_score(video_infos, vid1_key, vid2_key, score):
-    vid1_info = get_video_info(video_infos, vid1_key)
-    vid2_info = get_video_info(video_infos, vid2_key)
-    vid1_info.best_matches[vid2_info.index] = score
+    return (video_keys, rows, cols, scores)
 
 
-def upload_to_gae(score_type, version, video_infos):
+def read_parts(bucket_name, key_names, parallelism):
+    """Yield read_part for each key, in order, reading parallelism at once."""
+    pool = ThreadPool(parallelism)
     try:
-        video_keys = video_infos.keys()
-        video_keys.sort(key=lambda video_key: video_infos[video_key].index)
-
-        row_dicts = [None] * len(video_keys)
-        for info in video_infos.values():
-            row_dicts[info.index] = info.best_matches
-
-        oauth_fetcher.fetch_url(
-            '/api/v1/dev/videorec_matrix', {
-                'score_type': score_type,
-                'version': version,
-                'data': json.dumps({
-                                    'video_keys': video_keys,
-                                    'matrix_rows': row_dicts,
-                                    }),
-            })
-    except urllib2.URLError as e:
-        print >> sys.stderr, "Unable to access GAE:"
-        print >> sys.stderr, e
+        key_names = iter(key_names)
+        pending = collections.deque()
+        for key_name in itertools.islice(key_names, parallelism):
+            pending.append(pool.apply_async(read_part,
+                                            (bucket_name, key_name)))
+        while pending:
+            result = pending.popleft()
+            for key_name in itertools.islice(key_names, 1):
+                pending.append(pool.apply_async(read_part,
+                                                (bucket_name, key_name)))
+            yield result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+
+
+def _load_progress(progress_filename, upload_params):
+    """Return how many chunks of this upload an earlier run uploaded."""
+    try:
+        with open(progress_filename) as f:
+            progress = json.load(f)
+    except (IOError, ValueError):
+        return 0
+    if progress.get('upload') != upload_params:
+        print >> sys.stderr, ("Ignoring %s, which is for another upload"
+                              % progress_filename)
+        return 0
+    return progress['chunks_done']
+
+
+def _save_progress(progress_filename, upload_params, chunks_done):
+    with open(progress_filename + '.tmp', 'w') as f:
+        json.dump({'upload': upload_params, 'chunks_done': chunks_done}, f)
+    os.rename(progress_filename + '.tmp', progress_filename)
+
+
+def _post_matrix(params, data, max_retries):
+    """POST to the videorec_matrix API, returning whether it succeeded."""
+    post_params = dict(params, data=json.dumps(data))
+    for tries in xrange(max_retries):
+        try:
+            oauth_fetcher.fetch_url('/api/v1/dev/videorec_matrix',
+                                    post_params)
+            return True
+        except urllib2.URLError as e:
+            print >> sys.stderr, "Unable to access GAE:"
+            print >> sys.stderr, e
+            if tries + 1 < max_retries:
+                sleep_secs = 2 ** tries
+                print >> sys.stderr, "Retrying in %s seconds..." % sleep_secs
+                time.sleep(sleep_secs)
+    return False
+
+
+def upload_to_gae(score_type, version, matrix, chunk_rows=0,
+                  progress_filename=None, max_retries=1):
+    """Upload the matrix, returning whether it succeeded.
+
+    If chunk_rows is 0, the whole matrix is sent in one request.  Otherwise
+    it is sent chunk_rows rows at a time, with the range of rows given by
+    the start_row and num_rows parameters, and the video_keys sent with the
+    first chunk only.  After each chunk, the number of chunks sent so far
+    is saved to progress_filename (if given), and an upload of the same
+    matrix later continues from there.
+    """
+    num_rows = len(matrix.video_keys)
+    params = {
+        'score_type': score_type,
+        'version': version,
+    }
+    if not chunk_rows:
+        return _post_matrix(params, {
+                                'video_keys': matrix.video_keys,
+                                'matrix_rows': matrix.matrix_rows(0,
+                                                                  num_rows),
+                            }, max_retries)
+
+    upload_params = dict(params, chunk_rows=chunk_rows, num_rows=num_rows,
+                         num_pairs=len(matrix.cols))
+    chunks_done = 0
+    if progress_filename:
+        chunks_done = _load_progress(progress_filename, upload_params)
+        if chunks_done:
+            print "Resuming the upload after %d chunks" % chunks_done
+    num_chunks = (num_rows + chunk_rows - 1) // chunk_rows
+
+    for chunk in xrange(chunks_done, num_chunks):
+        start_row = chunk * chunk_rows
+        end_row = min(start_row + chunk_rows, num_rows)
+        data = {'matrix_rows': matrix.matrix_rows(start_row, end_row)}
+        if chunk == 0:
+            data['video_keys'] = matrix.video_keys
+        chunk_params = dict(params, start_row=start_row, num_rows=num_rows)
+        if not _post_matrix(chunk_params, data, max_retries):
+            if progress_filename:
+                print >> sys.stderr, ("Uploaded %d of %d chunks; re-run to "
+                                      "upload the rest" % (chunk, num_chunks))
+            return False
+        if progress_filename:
+            _save_progress(progress_filename, upload_params, chunk + 1)
+        print "Uploaded rows [%d, %d) of %d" % (start_row, end_row, num_rows)
+
+    if progress_filename and os.path.exists(progress_filename):
+        os.remove(progress_filename)
+    return True
 
 
 def main(table_location, score_type, options):
@@ -78,64 +306,42 @@ def main(table_location, score_type, options):
     path = table_location[len('s3://ka-mapreduce/'):]
     if not path.endswith('/'):
         path = path + '/'
-    s3keys = bucket.list(path)
-
-    # Mapping of video key to the info on the other videos which best match
-    # that video
-    # vid_key -> VideoInfo
-    video_infos = {}
 
     # Note: a table's data may be broken down into multiple files on disk.
-    delimiter = '\01'
-    lines_read = 0
+    key_names = []
     version = None  # Use a datestamp as a version.
-    for key in s3keys:
+    for key in bucket.list(path):
         if key.name.endswith('_$.folder$'):
             # S3 meta data - not useful.
             continue
-
-        contents = key.get_contents_as_string()
+        key_names.append(key.name)
         version = max(version, key.last_modified)
-        for line in contents.split('\n'):
-
-            if not line:
-                # EOF
-                break
-
-            lines_read += 1
-            parts = line.rstrip().split(delimiter)
-            if len(parts) != 3:
-                # TODO(benkomalo): error handling
-                continue
-
-            vid1_key, vid2_key, score = parts
-
-            try:
-                score = float(score)
-            except ValueError:
-                # Some of the values were invalid - deal with it.
-                # TODO(benkomalo): error handling.
-                continue
-
-            add_score(video_infos, vid1_key, vid2_key, score)
 
-            if lines_read % 1000 == 0:
-                print "Read %s lines..." % lines_read
+    # Scores between each pair of videos, with the other videos which best
+    # match each video.
+    matrix = VideoMatrix()
+    scores_read = 0
+    for part in read_parts(bucket.name, key_names, options.parallelism):
+        matrix.add_part(part)
+        scores_read += len(part[3])
+        print "Read %s scores..." % scores_read
+    matrix.sort_rows()
 
     # Convert version datestamp to a more sane ISO8601 from RFC822
     version = rfc822.parsedate_tz(version)[:6]  # extract YMDHMS from tuple
     version = datetime.datetime(*version).isoformat()
 
-    total_pairs = sum([len(info.best_matches)
-                       for info in video_infos.values()])
     print "\nSummary of collected data:"
     print "\tScore type: [%s]" % score_type
     print "\tVersion: [%s]" % version
     print ("\tDetected %d videos, with a total of %d video pair data" %
-           (len(video_infos), total_pairs))
+           (len(matrix.video_keys), matrix.num_pairs()))
     print "Target: %s" % oauth_util.consts.SERVER_URL
     if raw_input("Proceed to upload? [Y/n]: ").lower() in ['', 'y', 'yes']:
-        upload_to_gae(score_type, version, video_infos)
+        if not upload_to_gae(score_type, version, matrix,
+                             options.chunk_rows, options.progress_file,
+                             options.max_retries):
+            sys.exit(1)
         print "Success!"
         print "Run the following to make it live:"
         print "set_video_matrix_version.py '%s' '%s'" % (
@@ -144,7 +350,20 @@ def main(table_location, score_type, options):
 
 def parse_command_line_args():
     parser = optparse.OptionParser(USAGE)
-    # No actual options yet.
+    parser.add_option("-p", "--parallelism", type="int", default=4,
+                      help="Number of S3 parts to read at once. "
+                           "Defaults to %default.")
+    parser.add_option("-c", "--chunk_rows", type="int", default=0,
+                      help="If set, upload the matrix this many rows (videos) "
+                           "at a time, instead of in one request.")
+    parser.add_option("--progress_file", default="video_matrix_upload.json",
+                      help="With --chunk_rows, where to record how many "
+                           "chunks have been uploaded, so that re-running "
+                           "the same upload after an error continues from "
+                           "there.  Defaults to %default.")
+    parser.add_option("-r", "--max_retries", type="int", default=5,
+                      help="Number of attempts to upload each chunk. "
+                           "Defaults to %default.")
 
     options, args = parser.parse_args()
     if len(args) < 2:
@@ -7,6 +7,9 @@ Pure Python reader for GeoIP Country Edition databases.
 __author__ = 'David Wilson <dw@botanicus.net>'
 
 
+import bisect
+import marshal
+import mmap
 import os
 import struct
 
@@ -210,15 +213,24 @@ class Database(object):
     edition.
     '''
 
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False):
         '''
         Initialize a new GeoIP reader instance.
 
         @param[in]  filename    Path to GeoIP.dat as a string.
+        @param[in]  use_mmap    If True, memory-map the database instead of
+                                reading it all into memory up front.
         '''
 
         self.filename = filename
-        self.cache = open(filename, 'rb').read()
+        fp = open(filename, 'rb')
+        try:
+            if use_mmap:
+                self.cache = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.cache = fp.read()
+        finally:
+            fp.close()
         self._setup_segments()
 
         if self.db_type not in (GEOIP_COUNTRY_EDITION,
@@ -326,15 +338,26 @@ class Database(object):
         return x
 
     def _seek_record(self, ipnum):
-        fp = StringIO(self.cache)
+        # Records are read straight out of the cache (a string or an mmap),
+        # rather than through a file object, since this runs once per level
+        # of the tree for every lookup.
+        cache = self.cache
+        record_length = self.record_length
+        segment = self.segments[0]
         offset = 0
 
         for depth in range(31, -1, -1):
-            fp.seek(self.record_length * 2 * offset)
-            buf = map(ord, fp.read(self.record_length * 2))
-
-            x = self._decode(buf, int(bool(ipnum & (1 << depth))))
-            if x >= self.segments[0]:
+            branch = (ipnum >> depth) & 1
+            if record_length == 3:
+                pos = 3 * (2 * offset + branch)
+                x = (ord(cache[pos]) | (ord(cache[pos+1]) << 8) |
+                     (ord(cache[pos+2]) << 16))
+            else:
+                pos = record_length * 2 * offset
+                buf = map(ord, cache[pos:pos + record_length * 2])
+                x = self._decode(buf, branch)
+
+            if x >= segment:
                 return 32 - depth, x
 
             offset = x
@@ -344,6 +367,50 @@ class Database(object):
             "Perhaps database is corrupt?" % ipnum
 
 
+    def country_ranges(self):
+        '''
+        Walk the whole database, returning the address ranges of each
+        country, for CountryRanges.  Only supports country editions.
+
+        @returns    Two lists: the sorted first address of each range, and
+                    the country id of each range (None if unknown).
+        '''
+
+        if self.db_type not in (GEOIP_COUNTRY_EDITION, GEOIP_PROXY_EDITION,
+                                GEOIP_NETSPEED_EDITION):
+            raise NotImplementedError('Country ranges are only available '
+                                      'for Country databases.')
+
+        cache = self.cache
+        record_length = self.record_length
+        segment = self.segments[0]
+
+        starts = []
+        country_ids = []
+        # (record, depth, first address) of the subtrees left to visit,
+        # with the lowest addresses on top.
+        stack = [(0, 31, 0)]
+        while stack:
+            x, depth, start = stack.pop()
+            if x < segment:
+                assert depth >= 0, \
+                    "Error Traversing Database: Perhaps database is corrupt?"
+                buf = map(ord, cache[record_length * 2 * x:
+                                     record_length * 2 * (x + 1)])
+                stack.append((self._decode(buf, 1), depth - 1,
+                              start | (1 << depth)))
+                stack.append((self._decode(buf, 0), depth - 1, start))
+                continue
+
+            num = x - COUNTRY_BEGIN
+            country_id = num - 1 if num else None
+            # Leaves are visited in address order, so a range can be merged
+            # into the one before it if they're for the same country.
+            if not country_ids or country_ids[-1] != country_id:
+                starts.append(start)
+                country_ids.append(country_id)
+        return starts, country_ids
+
     def _lookup_country(self, ip):
         "Lookup a country db entry."
 
@@ -419,11 +486,60 @@ class Database(object):
             return self._lookup_city(ip)
 
 
+class CountryRanges(object):
+    '''
+    Sorted table of the address range of every country in a country
+    database, searched with bisect.  Much faster than walking the database
+    for each lookup, once built (or loaded from a file saved earlier).
+    '''
+
+    def __init__(self, starts, country_ids):
+        '''
+        @param[in]  starts      Sorted list of the first address of each range.
+        @param[in]  country_ids Country id of each range (None if unknown).
+        '''
+
+        self.starts = starts
+        self.country_ids = country_ids
+
+    @classmethod
+    def from_database(cls, database):
+        return cls(*database.country_ranges())
+
+    @classmethod
+    def load(cls, filename):
+        fp = open(filename, 'rb')
+        try:
+            return cls(*marshal.load(fp))
+        finally:
+            fp.close()
+
+    def save(self, filename):
+        fp = open(filename, 'wb')
+        try:
+            marshal.dump((self.starts, self.country_ids), fp)
+        finally:
+            fp.close()
+
+    def country_code(self, ip):
+        '''
+        Lookup the country of an IP address.
+
+        @param[in]  ip      IPv4 address as a string.
+        @returns            Country code, the same as lookup(ip).country.
+        '''
+
+        idx = bisect.bisect_right(self.starts, addr_to_num(ip)) - 1
+        return safe_lookup(GeoIP_country_code, self.country_ids[idx])
 
 
 if __name__ == '__main__':
     import time, sys
 
+    if len(sys.argv) == 4 and sys.argv[1] == '--save-country-ranges':
+        CountryRanges.from_database(Database(sys.argv[2])).save(sys.argv[3])
+        sys.exit(0)
+
     dbfile = 'GeoIP.dat'
     if len(sys.argv) > 1:
         dbfile = sys.argv[1]